@@ -1,11 +1,50 @@
+import re
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import override_settings
 from django.test.client import RequestFactory
 from django.test.testcases import TestCase
 from django.urls import reverse
 
 
+# Tests never touch a shared cache, e.g. the memcached of the docker settings, which they clear
+@override_settings(CACHES={
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'tests',
+    }
+})
 class BaseTestCase(TestCase):
     factory = RequestFactory()
 
+    def setUp(self):
+        cache.clear()
+
     def _test_view_for_status_code(self, view_name, url_kwargs={}, status_code=200):
         response = self.client.get(reverse(view_name, kwargs=url_kwargs))
         self.assertEqual(response.status_code, status_code)
+
+    def assertNoSequentialScan(self, queryset):
+        """
+        Fails if the query plan of the queryset scans a whole table rather than using an index
+        """
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+            if connection.vendor == 'postgresql':
+                # Test tables fit in a page or two, which PostgreSQL rightly scans whole. Sequential
+                # scans are only kept in the plan when no index can serve the query
+                cursor.execute('SET enable_seqscan = off')
+                try:
+                    plan = queryset.explain()
+                finally:
+                    cursor.execute('RESET enable_seqscan')
+                scans = re.findall(r'Seq Scan on \w+', plan)
+            else:
+                plan = queryset.explain()
+                # SQLite reports full table scans as "SCAN <table>", index scans as "SCAN <table> USING ..."
+                scans = [line for line in plan.splitlines() if re.search(r'\bSCAN (TABLE )?\w+\s*$', line)]
+
+        self.assertFalse(scans, 'Sequential scan in query plan:\n{}'.format(plan))
+        return plan
@@ -0,0 +1,290 @@
+import math
+import random
+import resource
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from html import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from crispy.apps.feed.crawler import Crawler
+from crispy.apps.feed.models import Feed
+
+# Date of the first entry of every synthetic feed
+EPOCH = datetime(2021, 1, 1, tzinfo=timezone.utc)
+
+LOREM = ('Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt '
+         'ut labore et dolore magna aliqua. ')
+
+
+class FeedCorpus(object):
+    """
+    A set of synthetic feeds, alternating RSS 2.0 and Atom 1.0.
+    Each feed holds a sliding window of `entries` entries, one hour apart. Changing a feed
+    publishes a new entry and drops the oldest one, as real feeds do.
+    """
+
+    def __init__(self, feeds: int, entries: int, entry_size: int = 1000) -> None:
+        self.feeds = feeds
+        self.entries = entries
+        self.content = (LOREM * (entry_size // len(LOREM) + 1))[:entry_size]
+        self.versions = [0] * feeds
+        self._documents = {}  # type: Dict[int, Tuple[str, bytes]]
+        self._lock = threading.Lock()
+
+    def _items(self, index: int) -> List[Tuple[str, str, datetime]]:
+        """
+        Returns the (guid, title, date) of the feed's entries, newest first
+        """
+        first = self.versions[index]
+        return [('feed-{}-entry-{}'.format(index, n), 'Entry {} of feed {}'.format(n, index),
+                 EPOCH + timedelta(hours=n))
+                for n in reversed(range(first, first + self.entries))]
+
+    def _render_rss(self, index: int) -> str:
+        items = ''.join(
+            '<item><title>{title}</title><link>http://feed{index}.test/{guid}</link>'
+            '<guid>{guid}</guid><pubDate>{date}</pubDate><author>bench@feed{index}.test</author>'
+            '<description>{content}</description></item>'.format(
+                index=index, guid=guid, title=title, date=format_datetime(date, usegmt=True),
+                content=escape('<p>{}</p>'.format(self.content)))
+            for guid, title, date in self._items(index))
+
+        return ('<?xml version="1.0" encoding="utf-8"?><rss version="2.0"><channel>'
+                '<title>Feed {index}</title><link>http://feed{index}.test/</link>'
+                '<description>Synthetic feed</description>{items}</channel></rss>').format(
+            index=index, items=items)
+
+    def _render_atom(self, index: int) -> str:
+        items = ''.join(
+            '<entry><title>{title}</title><link href="http://feed{index}.test/{guid}"/>'
+            '<id>{guid}</id><updated>{date}</updated><author><name>Bench</name></author>'
+            '<content type="html">{content}</content></entry>'.format(
+                index=index, guid=guid, title=title, date=date.isoformat(),
+                content=escape('<p>{}</p>'.format(self.content)))
+            for guid, title, date in self._items(index))
+
+        return ('<?xml version="1.0" encoding="utf-8"?><feed xmlns="http://www.w3.org/2005/Atom">'
+                '<title>Feed {index}</title><link href="http://feed{index}.test/"/>'
+                '<id>feed-{index}</id><updated>{updated}</updated>{items}</feed>').format(
+            index=index, items=items, updated=self._items(index)[0][2].isoformat())
+
+    def get(self, index: int) -> Tuple[str, bytes]:
+        """
+        Returns the E-Tag and document of a feed
+        """
+        with self._lock:
+            if index not in self._documents:
+                document = self._render_rss(index) if index % 2 == 0 else self._render_atom(index)
+                etag = '"{}-{}"'.format(index, self.versions[index])
+                self._documents[index] = etag, document.encode('utf-8')
+            return self._documents[index]
+
+    def change(self, rate: float, seed: int = 0) -> List[int]:
+        """
+        Publishes a new entry in a fraction of the feeds
+        :param rate: Fraction of the feeds to change
+        :param seed: Random seed
+        :return: Indexes of the changed feeds
+        """
+        changed = random.Random(seed).sample(range(self.feeds), round(self.feeds * rate))
+
+        with self._lock:
+            for index in changed:
+                self.versions[index] += 1
+                self._documents.pop(index, None)
+
+        return changed
+
+
+class BenchmarkRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status: int, headers: Dict[str, str] = None, body: bytes = b'') -> None:
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.started_request()
+        try:
+            self._respond()
+        finally:
+            self.server.finished_request()
+
+    def _respond(self):
+        server = self.server
+        path, _, query = self.path.partition('?')
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        try:
+            index = int(path.strip('/').split('/')[-1].split('.')[0])
+            etag, body = server.corpus.get(index)
+        except (ValueError, IndexError):
+            return self._send(404)
+
+        if server.chance(server.error_rate):
+            return self._send(500)
+
+        if not query and server.chance(server.redirect_rate):
+            return self._send(302, {'Location': '{}?redirected'.format(path)})
+
+        if self.headers.get('If-None-Match') == etag:
+            return self._send(304, {'ETag': etag})
+
+        self._send(200, {'ETag': etag, 'Content-Type': 'application/xml; charset=utf-8'}, body)
+
+
+class BenchmarkServer(ThreadingHTTPServer):
+    """
+    Local HTTP server for a FeedCorpus, honouring E-Tags.
+    Every request is delayed by `latency` seconds, and fails with a 500 or is redirected
+    with the given probabilities. The peak number of requests served at once is kept in
+    `peak_requests`.
+    """
+    daemon_threads = True
+
+    def __init__(self, corpus: FeedCorpus, latency: float = 0.0, error_rate: float = 0.0,
+                 redirect_rate: float = 0.0, seed: int = 0) -> None:
+        super().__init__(('127.0.0.1', 0), BenchmarkRequestHandler)
+        self.corpus = corpus
+        self.latency = latency
+        self.error_rate = error_rate
+        self.redirect_rate = redirect_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._requests = 0
+        self.peak_requests = 0
+
+    def started_request(self) -> None:
+        with self._lock:
+            self._requests += 1
+            self.peak_requests = max(self.peak_requests, self._requests)
+
+    def finished_request(self) -> None:
+        with self._lock:
+            self._requests -= 1
+
+    def chance(self, rate: float) -> bool:
+        with self._lock:
+            return self._random.random() < rate
+
+    def url(self, index: int) -> str:
+        return 'http://127.0.0.1:{}/feeds/{}.xml'.format(self.server_port, index)
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self.serve_forever, name='benchmark-server', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+
+def percentile(values: List[float], percent: float) -> float:
+    """
+    Returns the given percentile of a list of values, using the nearest-rank method
+    """
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+
+def peak_rss() -> Tuple[int, int]:
+    """
+    Returns the peak resident set size, in KB, of this process and of its finished children
+    """
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def run_benchmark(server: BenchmarkServer, cycles: int = 2, change_rate: float = 0.1,
+                  concurrency: Optional[int] = None, parse_processes: Optional[int] = None,
+                  batch_size: int = 500) -> List[Dict]:
+    """
+    Crawls the server's corpus through the same path as update_feeds: feeds are claimed in
+    batches, fetched and parsed by a Crawler, and stored in the database. Between cycles a
+    fraction of the feeds publish a new entry and every feed is made due again.
+
+    All feeds are served from 127.0.0.1 but stand for as many hosts: the per-host connection
+    limit is raised to the crawler's concurrency, otherwise it would bound the run.
+
+    Expects an empty database, as the one of a test run.
+
+    :return: A report per cycle
+    """
+    user, _ = User.objects.get_or_create(username='benchmark')
+    Feed.objects.bulk_create([Feed(added_by=user, feed_url=server.url(index), title='')
+                              for index in range(server.corpus.feeds)])
+    reports = []
+
+    concurrency = concurrency or settings.CRAWLER_CONCURRENCY
+    max_connections = max(concurrency, settings.CRAWLER_MAX_CONNECTIONS_PER_HOST)
+
+    with override_settings(CRAWLER_MAX_CONNECTIONS_PER_HOST=max_connections), \
+            Crawler(concurrency=concurrency, parse_processes=parse_processes) as crawler:
+        for cycle in range(cycles):
+            if cycle:
+                server.corpus.change(change_rate, seed=cycle)
+                Feed.objects.update(next_check_at=None)
+
+            latencies = []
+            outcomes = {'updated': 0, 'not_modified': 0, 'unchanged': 0, 'failed': 0}
+            started_at = time.perf_counter()
+
+            with CaptureQueriesContext(connection) as queries:
+                while True:
+                    feeds = Feed.objects.claim_by_lane('benchmark', batch_size, timedelta(minutes=10))
+                    if not feeds:
+                        break
+
+                    for result in crawler.crawl(feeds):
+                        stored_at = time.perf_counter()
+                        crawler.store(result)
+                        latencies.append(result.elapsed + time.perf_counter() - stored_at)
+
+                        if result.updated:
+                            outcomes['updated'] += 1
+                        elif result.not_modified:
+                            outcomes['not_modified'] += 1
+                        elif result.parsed_feed is not None:
+                            outcomes['unchanged'] += 1
+                        else:
+                            outcomes['failed'] += 1
+
+            elapsed = time.perf_counter() - started_at
+            reports.append(dict(outcomes, **{
+                'cycle': cycle + 1,
+                'feeds': len(latencies),
+                'seconds': elapsed,
+                'feeds_per_second': len(latencies) / elapsed if elapsed else 0.0,
+                'p50': percentile(latencies, 50),
+                'p99': percentile(latencies, 99),
+                'queries_per_feed': len(queries) / len(latencies) if latencies else 0.0,
+            }))
+
+    rss, children_rss = peak_rss()
+    for report in reports:
+        report['peak_rss_kb'] = rss
+        report['peak_children_rss_kb'] = children_rss
+
+    return reports
@@ -0,0 +1,57 @@
+import threading
+import time
+from collections import defaultdict
+from typing import Callable
+
+
+class CircuitBreaker(object):
+    """
+    Per-host circuit breaker.
+
+    A host failing `threshold` fetches in a row is skipped for `cooldown` seconds: its circuit is
+    open. Then a single fetch probes it: a success closes the circuit, a failure opens it again.
+    Thread safe.
+    """
+
+    def __init__(self, threshold: int, cooldown: float, clock: Callable[[], float] = time.monotonic) -> None:
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._failures = defaultdict(int)  # Failed fetches in a row, by host
+        self._open_until = {}  # Clock time until which a host's circuit is open, by host
+        self._probing = set()  # Hosts being probed
+
+    def allow(self, host: str) -> bool:
+        """
+        Whether a fetch from the host may go ahead. Once the cooldown is over, only lets a single probe through.
+        """
+        with self._lock:
+            open_until = self._open_until.get(host)
+            if open_until is None:
+                return True
+            if self.clock() < open_until or host in self._probing:
+                return False
+
+            self._probing.add(host)
+            return True
+
+    def retry_after(self, host: str) -> float:
+        """
+        Returns how long, in seconds, the host's circuit stays open
+        """
+        with self._lock:
+            return max(0.0, self._open_until.get(host, 0.0) - self.clock())
+
+    def record_success(self, host: str) -> None:
+        with self._lock:
+            self._failures.pop(host, None)
+            self._open_until.pop(host, None)
+            self._probing.discard(host)
+
+    def record_failure(self, host: str) -> None:
+        with self._lock:
+            self._failures[host] += 1
+            self._probing.discard(host)
+            if self._failures[host] >= self.threshold:
+                self._open_until[host] = self.clock() + self.cooldown
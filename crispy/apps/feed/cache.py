@@ -0,0 +1,131 @@
+import hashlib
+import time
+from typing import Any, Callable, Dict, List
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+
+# Cached data is keyed by a version, bumped when the data changes, rather than deleted.
+# Outdated keys are never read again and are evicted by the cache backend
+FEED_VERSION_KEY = 'feed:{}:version'
+FEED_LIST_VERSION_KEY = 'feed_list:version'
+FEED_READ_KEY = 'feed:{}:read'
+
+
+def _get_version(key: str) -> int:
+    version = cache.get(key)
+    if version is None:
+        # Starts from the current time, so that a version evicted from the cache is never reused
+        version = time.time_ns()
+        if not cache.add(key, version, None):
+            version = cache.get(key, version)
+    return version
+
+
+def _bump_version(key: str) -> None:
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Not cached anymore, any new version will do
+        cache.set(key, time.time_ns(), None)
+
+
+def get_feed_version(feed_id: int) -> int:
+    """
+    Returns the version of a feed's cached data, bumped when its entries change
+    :param feed_id: Feed id
+    """
+    return _get_version(FEED_VERSION_KEY.format(feed_id))
+
+
+def get_feed_list_version() -> int:
+    """
+    Returns the version of the cached feed listings, bumped when feeds are added or updated
+    """
+    return _get_version(FEED_LIST_VERSION_KEY)
+
+
+def _key(prefix: str, parts: tuple) -> str:
+    if not parts:
+        return prefix
+
+    # Parameters come from requests, hashing them bounds the key length
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        digest.update(str(part).encode('utf-8', 'surrogatepass'))
+        digest.update(b'\0')
+    return '{}:{}'.format(prefix, digest.hexdigest())
+
+
+def feed_key(feed_id: int, name: str, *parts: Any) -> str:
+    """
+    Returns the key of some data of a feed, at the feed's current version
+    :param feed_id: Feed id
+    :param name: Name of the data
+    :param parts: Parameters of the data, e.g. a page token, hashed in the key
+    """
+    return _key('feed:{}:{}:{}'.format(feed_id, get_feed_version(feed_id), name), parts)
+
+
+def feed_list_key(name: str, *parts: Any) -> str:
+    """
+    Returns the key of some data of the feed listings, at their current version
+    :param name: Name of the data
+    :param parts: Parameters of the data, e.g. a page number, hashed in the key
+    """
+    return _key('feed_list:{}:{}'.format(get_feed_list_version(), name), parts)
+
+
+def get_or_set(key: str, default: Callable[[], Any], timeout: int = None) -> Any:
+    """
+    Returns a cached value, computing and caching it when missing. None values aren't cached.
+    :param key: Cache key
+    :param default: Computes the value
+    :param timeout: Timeout in seconds, defaults to FEED_PAGE_CACHE_SECONDS
+    """
+    value = cache.get(key)
+
+    if value is None:
+        value = default()
+        if value is not None:
+            cache.set(key, value, settings.FEED_PAGE_CACHE_SECONDS if timeout is None else timeout)
+
+    return value
+
+
+def get_recent_entries(feed_id: int) -> List[Dict]:
+    """
+    Returns the id, title and date of the latest entries of a feed, cached until new entries
+    are ingested
+    :param feed_id: Feed id
+    :return: A list of dicts
+    """
+    def recent_entries():
+        entry_model = apps.get_model('feed', 'Entry')
+        return list(entry_model.objects.recent(feed_id, settings.FEED_RECENT_ENTRIES))
+
+    return get_or_set(feed_key(feed_id, 'recent_entries'), recent_entries, settings.FEED_RECENT_ENTRIES_CACHE_SECONDS)
+
+
+def invalidate_feed(feed_id: int) -> None:
+    """
+    Outdates the cached data of a feed, once its entries have changed
+    :param feed_id: Feed id
+    """
+    _bump_version(FEED_VERSION_KEY.format(feed_id))
+
+
+def invalidate_feed_list() -> None:
+    """
+    Outdates the cached feed listings, once a feed has been added or updated
+    """
+    _bump_version(FEED_LIST_VERSION_KEY)
+
+
+def track_read(feed_id: int) -> bool:
+    """
+    Whether a read of a feed should be recorded: only the first one per FEED_READ_TRACKING_SECONDS is
+    :param feed_id: Feed id
+    """
+    return cache.add(FEED_READ_KEY.format(feed_id), True, settings.FEED_READ_TRACKING_SECONDS)
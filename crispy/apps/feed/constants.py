@@ -16,4 +16,12 @@ FEED_TYPES = (
     ('atom', 'Atom'),
     ('cdf', 'CDF'),
     ('', 'Unknown')
-)
\ No newline at end of file
+)
+# Feeds are pending until their first check, made by the crawler
+FEED_STATE_PENDING = 'pending'
+FEED_STATE_ACTIVE = 'active'
+
+FEED_STATES = (
+    (FEED_STATE_PENDING, 'Pending'),
+    (FEED_STATE_ACTIVE, 'Active'),
+)
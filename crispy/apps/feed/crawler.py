@@ -0,0 +1,274 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from queue import Queue
+from typing import Callable, Iterable, Iterator, List, NamedTuple, Optional
+from urllib.parse import urlsplit
+
+import feedparser
+from django.conf import settings
+from django.utils import timezone
+
+from crispy.apps.feed import cache, metrics, scheduling
+from crispy.apps.feed.breaker import CircuitBreaker
+from crispy.apps.feed.exceptions import BrokenFeed, FetchError
+from crispy.apps.feed.models import Feed
+from crispy.apps.feed.parsing import ProcessPoolParser
+from crispy.apps.feed.records import EntryRecord
+from crispy.apps.feed.scraper import Scraper
+from crispy.apps.feed.transport import HttpTransport, Transport
+
+logger = logging.getLogger(__name__)
+
+
+class CrawlResult(NamedTuple):
+    """
+    Outcome of checking a single feed
+    """
+    feed: Feed
+    updated: bool
+    parsed_feed: Optional[feedparser.FeedParserDict]
+    not_modified: bool = False
+    elapsed: float = 0.0  # Time spent fetching and parsing, in seconds
+    entries: Optional[List[EntryRecord]] = None  # Normalized entries of the parsed feed
+    retry_after: Optional[float] = None  # Set when skipped, the host's circuit being open, in seconds
+
+
+class Crawler(object):
+    """
+    Crawls feeds concurrently.
+
+    Feeds are scheduled from an asyncio event loop running in a background thread, with at most
+    `concurrency` feeds in flight at once, and at most CRAWLER_MAX_CONNECTIONS_PER_HOST of them
+    from the same host, so a slow host only holds up its own feeds. Each feed is downloaded by the transport in a worker
+    thread, then parsed in a pool of `parse_processes` processes (in the worker thread itself
+    if 0). Results are handed back to the calling thread, which is the only one writing to the
+    database.
+
+    Feeds from hosts failing CRAWLER_CIRCUIT_FAILURES fetches in a row are skipped for
+    CRAWLER_CIRCUIT_COOLDOWN seconds, see CircuitBreaker.
+    """
+
+    def __init__(self,
+                 parse_func: Callable[..., feedparser.FeedParserDict] = feedparser.parse,
+                 transport: Optional[Transport] = None,
+                 concurrency: Optional[int] = None,
+                 parse_processes: Optional[int] = None) -> None:
+        self.parse_func = parse_func
+        self.transport = transport or HttpTransport(settings.CRAWLER_CONNECT_TIMEOUT,
+                                                    settings.CRAWLER_READ_TIMEOUT,
+                                                    settings.CRAWLER_MAX_CONNECTIONS_PER_HOST,
+                                                    settings.CRAWLER_FETCH_TIMEOUT,
+                                                    settings.CRAWLER_MAX_BODY_SIZE)
+        self.concurrency = concurrency or settings.CRAWLER_CONCURRENCY
+        if parse_processes is None:
+            parse_processes = settings.CRAWLER_PARSE_PROCESSES
+        self.parse_processes = parse_processes
+        self.breaker = CircuitBreaker(settings.CRAWLER_CIRCUIT_FAILURES, settings.CRAWLER_CIRCUIT_COOLDOWN)
+        self.stopping = threading.Event()
+        self._loop = None
+        self._thread = None
+        self._executor = None
+        self._parser = None
+
+    def __enter__(self) -> 'Crawler':
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def start(self) -> None:
+        """
+        Starts the event loop and the worker threads. They are kept alive until close() is called,
+        so a long-running process can reuse them across crawl cycles.
+        """
+        if self._loop is not None:
+            return
+
+        self.stopping.clear()
+        if self.parse_processes:
+            self._parser = ProcessPoolParser(self.parse_func, self.parse_processes)
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='fetch')
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='crawler', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stops dispatching feeds. Feeds already being fetched are allowed to finish.
+        Safe to call from a signal handler.
+        """
+        self.stopping.set()
+
+    def close(self) -> None:
+        """
+        Stops the event loop and waits for the worker threads to finish
+        """
+        if self._loop is None:
+            return
+
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._executor.shutdown(wait=True)
+        if self._parser:
+            self._parser.shutdown()
+        self.transport.close()
+        self._loop = self._thread = self._executor = self._parser = None
+
+    def _check_feed(self, feed: Feed) -> CrawlResult:
+        """
+        Fetches and parses a feed. Runs in a worker thread.
+        :param feed: Feed to check
+        :return: A CrawlResult
+        """
+        host = urlsplit(feed.feed_url).hostname
+        if not self.breaker.allow(host):
+            metrics.CHECKS.inc(outcome='circuit_open')
+            return CrawlResult(feed, False, None, retry_after=self.breaker.retry_after(host))
+
+        scraper = Scraper(self._parser or self.parse_func, feed, self.transport)
+        started_at = time.perf_counter()
+        updated, parsed_feed = False, None
+
+        try:
+            updated, parsed_feed = scraper.check_feed()
+        except BrokenFeed as e:
+            logger.warning('Feed %s is broken: %s', feed, e)
+        except Exception:
+            logger.exception('Unexpected error while checking feed %s', feed)
+        finally:
+            # Only network errors count against the host, it answered otherwise
+            if isinstance(scraper.error, FetchError):
+                self.breaker.record_failure(host)
+            else:
+                self.breaker.record_success(host)
+
+        return CrawlResult(feed, updated, parsed_feed, scraper.not_modified, time.perf_counter() - started_at,
+                           scraper.entries)
+
+    async def _crawl_feed(self, feed: Feed, semaphore: asyncio.Semaphore,
+                          host_semaphore: asyncio.Semaphore, results: Queue) -> None:
+        # Waits for the host first, so feeds queued behind a busy host don't hold a crawl slot
+        async with host_semaphore, semaphore:
+            metrics.QUEUE_DEPTH.dec()
+            if self.stopping.is_set():
+                return
+
+            logger.debug('Checking feed %s', feed)
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(self._executor, self._check_feed, feed)
+
+        results.put(result)
+
+    async def _crawl(self, feeds: Iterable[Feed], results: Queue) -> None:
+        semaphore = asyncio.Semaphore(self.concurrency)
+        host_semaphores = defaultdict(lambda: asyncio.Semaphore(settings.CRAWLER_MAX_CONNECTIONS_PER_HOST))
+
+        metrics.QUEUE_DEPTH.inc(len(feeds))
+
+        try:
+            await asyncio.gather(*[
+                self._crawl_feed(feed, semaphore, host_semaphores[urlsplit(feed.feed_url).hostname], results)
+                for feed in feeds
+            ])
+        finally:
+            # Signals the consumer that there are no more results
+            results.put(None)
+
+    def crawl(self, feeds: Iterable[Feed]) -> Iterator[CrawlResult]:
+        """
+        Checks the given feeds concurrently, yielding results as soon as they are ready
+        :param feeds: Feeds to check
+        :return: An iterator of CrawlResult
+        """
+        self.start()
+        results = Queue()
+        future = asyncio.run_coroutine_threadsafe(self._crawl(list(feeds), results), self._loop)
+
+        while True:
+            result = results.get()
+            if result is None:
+                break
+            yield result
+
+        # Raises any error from the event loop
+        future.result()
+
+    def store(self, result: CrawlResult) -> None:
+        """
+        Saves the outcome of a feed check
+        :param result: A CrawlResult
+        """
+        started_at = time.perf_counter()
+        awaiting_check = result.feed.awaiting_check
+        try:
+            self._store(result)
+        finally:
+            metrics.STORE_SECONDS.observe(time.perf_counter() - started_at)
+
+        # Pages showing the progress of a requested check are outdated once it's done
+        if awaiting_check:
+            cache.invalidate_feed(result.feed.pk)
+
+    def _store(self, result: CrawlResult) -> None:
+        feed = result.feed
+
+        if result.retry_after is not None:
+            # Not checked, which isn't a failure of the feed itself: retries once the host's
+            # circuit is closed again. Any requested check is answered with the error
+            logger.info('Skipped feed %s, its host is failing', feed)
+            feed.error = 'Host unavailable, will retry later'
+            feed.next_check_at = (timezone.now() + timedelta(seconds=result.retry_after)
+                                  + scheduling.jitter(timedelta(seconds=settings.FEED_BACKOFF_MIN)))
+            feed.complete_check()
+            feed.release_lease()
+            feed.save(update_fields=['error', 'next_check_at', 'leased_until', 'leased_by', 'requested_at', 'state'])
+            return
+
+        if result.not_modified:
+            # Nothing changed, only the schedule and the cache validators need saving
+            logger.info('Feed %s not modified', feed)
+            feed.schedule_next_check()
+            feed.update_priority()
+            feed.complete_check()
+            feed.release_lease()
+            feed.save(update_fields=['last_checked_at', 'next_check_at', 'priority', 'etag', 'last_modified',
+                                     'failure_count', 'broken', 'error', 'leased_until', 'leased_by',
+                                     'requested_at', 'state'])
+            return
+
+        if result.updated:
+            logger.info('Found updates for feed %s', feed)
+            feed.update_feed_data(result.parsed_feed)
+            feed.update_feed_entries(result.entries)
+        else:
+            logger.info('No updates for feed %s', feed)
+
+        feed.schedule_next_check()
+        feed.update_priority()
+        feed.complete_check()
+        feed.release_lease()
+        feed.save()
+
+    def run(self, feeds: Iterable[Feed]) -> int:
+        """
+        Crawls and stores the given feeds
+        :param feeds: Feeds to crawl
+        :return: Number of feeds checked
+        """
+        count = 0
+
+        for result in self.crawl(feeds):
+            try:
+                self.store(result)
+            except Exception:
+                logger.exception('Unable to store feed %s', result.feed)
+            count += 1
+
+        return count
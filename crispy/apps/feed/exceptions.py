@@ -11,3 +11,31 @@ class BrokenFeed(CrispyException):
 
 class TemporaryFeedError(CrispyException):
     pass
+
+
+class FetchError(TemporaryFeedError):
+    """
+    The feed's host couldn't be reached, or didn't answer
+    """
+    pass
+
+
+class FetchTimeout(FetchError):
+    """
+    The feed's host didn't answer within the fetch deadlines
+    """
+    pass
+
+
+class InvalidEncoding(TemporaryFeedError):
+    """
+    The feed's host answered with a body its Content-Encoding can't decode
+    """
+    pass
+
+
+class ResponseTooLarge(TemporaryFeedError):
+    """
+    The feed document is larger than allowed
+    """
+    pass
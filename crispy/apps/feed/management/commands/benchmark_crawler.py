@@ -0,0 +1,60 @@
+import logging
+
+from django.core.management import BaseCommand
+from django.db import connection
+
+from crispy.apps.feed.benchmark import BenchmarkServer, FeedCorpus, run_benchmark
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks the crawler against synthetic feeds served locally. '
+            'Runs on a throwaway test database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--feeds', type=int, default=500, help='Number of feeds')
+        parser.add_argument('--entries', type=int, default=50, help='Number of entries per feed')
+        parser.add_argument('--entry-size', type=int, default=1000, help='Size of entry contents, in bytes')
+        parser.add_argument('--cycles', type=int, default=2, help='Number of crawl cycles')
+        parser.add_argument('--change-rate', type=float, default=0.1,
+                            help='Fraction of feeds publishing a new entry between cycles')
+        parser.add_argument('--latency', type=float, default=0.0, help='Server latency, in seconds')
+        parser.add_argument('--error-rate', type=float, default=0.0,
+                            help='Fraction of requests failing with a 500')
+        parser.add_argument('--redirect-rate', type=float, default=0.0,
+                            help='Fraction of requests redirected')
+        parser.add_argument('--concurrency', type=int, default=None,
+                            help='Maximum number of feeds fetched at once')
+        parser.add_argument('--parse-processes', type=int, default=None,
+                            help='Number of parser processes, 0 parses in the fetching threads')
+        parser.add_argument('--batch-size', type=int, default=500, help='Number of feeds claimed at once')
+
+    def handle(self, *args, **options):
+        if options['verbosity'] < 2:
+            logging.getLogger('crispy.apps.feed').setLevel(logging.ERROR)
+
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        server = BenchmarkServer(FeedCorpus(options['feeds'], options['entries'], options['entry_size']),
+                                 latency=options['latency'], error_rate=options['error_rate'],
+                                 redirect_rate=options['redirect_rate'])
+        server.start()
+
+        try:
+            reports = run_benchmark(server, cycles=options['cycles'], change_rate=options['change_rate'],
+                                    concurrency=options['concurrency'],
+                                    parse_processes=options['parse_processes'],
+                                    batch_size=options['batch_size'])
+        finally:
+            server.stop()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        for report in reports:
+            self.stdout.write(
+                'Cycle {cycle}: {feeds} feeds in {seconds:.2f}s, {feeds_per_second:.1f} feeds/s, '
+                'p50 {p50_ms:.1f}ms, p99 {p99_ms:.1f}ms, {queries_per_feed:.1f} queries/feed '
+                '({updated} updated, {not_modified} not modified, {unchanged} unchanged, {failed} failed)'.format(
+                    p50_ms=report['p50'] * 1000, p99_ms=report['p99'] * 1000, **report))
+
+        if reports:
+            self.stdout.write('Peak RSS: {peak_rss_kb} KB, parser processes: {peak_children_rss_kb} KB'.format(
+                **reports[-1]))
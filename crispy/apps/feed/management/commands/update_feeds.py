@@ -1,72 +1,125 @@
 #!python3
+import logging
+import os
+import signal
+import socket
 import threading
-from queue import Queue
 import time
+from datetime import timedelta
 
-# lock to serialize console output
-import feedparser
 from django.conf import settings
 from django.core.management import BaseCommand
+from django.db import close_old_connections
 
-from crispy.apps.feed.models import Feed
-from crispy.apps.feed.scraper import Scraper
+from crispy.apps.feed import metrics
+from crispy.apps.feed.crawler import Crawler
+from crispy.apps.feed.models import Feed, WorkerMetrics
 
-lock = threading.Lock()
-
-# Create the queue
-q = Queue()
-
-
-def do_work(feed):
-    print('Starting work on {}'.format(feed))
-    time.sleep(.1)  # pretend to do some lengthy work.
-    # Make sure the whole print completes or threads can mix up output in one line.
-    with lock:
-        print(threading.current_thread().name, feed)
-        scraper = Scraper(feedparser.parse, feed)
-        updated, parsed_feed = scraper.check_feed()
-
-        if updated:
-            print('Found updates for feed {}'.format(feed))
-            feed.update_feed_data(parsed_feed)
-            feed.update_feed_entries(parsed_feed.entries)
-            feed.save()
-        else:
-            print('No updates for feed {}'.format(feed))
-
-        print('Feed {} done'.format(feed))
-
-
-# The worker thread pulls an item from the queue and processes it
-def worker():
-    while True:
-        feed = q.get()
-        do_work(feed)
-        q.task_done()
-
-
-# Create thread pool
-for i in range(settings.NUM_WORKERS):
-    t = threading.Thread(target=worker)
-    t.daemon = True  # thread dies when main thread (only non-daemon thread) exits.
-    t.start()
-
-# stuff work items on the queue
-feeds = Feed.objects.active().all()
-start = time.perf_counter()
-
-for f in feeds:
-    q.put(f)
-
-# block until all tasks are done
-q.join()
+logger = logging.getLogger(__name__)
 
 
 class Command(BaseCommand):
     help = 'Updates feeds every N seconds. Everlasting command.'
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stopping = threading.Event()
+        self.crawler = None
+        # Identifies this process in feed leases
+        self.worker_id = '{}:{}'.format(socket.gethostname(), os.getpid())
+
     def add_arguments(self, parser):
         parser.add_argument('seconds', nargs='?', type=int, default=10)
+        parser.add_argument('--concurrency', type=int, default=None,
+                            help='Maximum number of feeds fetched at once')
+        parser.add_argument('--once', action='store_true',
+                            help='Runs a single crawl cycle and exits')
+        parser.add_argument('--batch-size', type=int, default=settings.CRAWLER_BATCH_SIZE,
+                            help='Number of due feeds claimed at once')
+        parser.add_argument('--metrics-host', default=settings.CRAWLER_METRICS_HOST,
+                            help='Address serving Prometheus metrics')
+        parser.add_argument('--metrics-port', type=int, default=settings.CRAWLER_METRICS_PORT,
+                            help='Port serving Prometheus metrics, 0 disables it')
+
+    def _handle_signal(self, signum, frame):
+        logger.info('Received signal %d, shutting down', signum)
+        self.stopping.set()
+        if self.crawler:
+            self.crawler.stop()
+
+    def run_cycle(self, batch_size: int) -> None:
+        """
+        Claims and crawls batches of due feeds until there are none left. Any number of
+        processes can run cycles at once, each feed is leased to a single one.
+        """
+        # Drops the database connection only if it has gone stale or exceeded CONN_MAX_AGE,
+        # otherwise it is reused across cycles
+        close_old_connections()
+
+        start = time.perf_counter()
+        lease = timedelta(seconds=settings.CRAWLER_LEASE_SECONDS)
+        count = 0
+
+        while not self.stopping.is_set():
+            # Feeds requested by users, e.g. new ones, go ahead of the due ones, which go by
+            # priority. Requests made during a batch are claimed with the next one
+            feeds = Feed.objects.claim_by_lane(self.worker_id, batch_size, lease)
+            if not feeds:
+                break
+            try:
+                count += self.crawler.run(feeds)
+            finally:
+                if self.stopping.is_set():
+                    # Hands the feeds left unchecked back to the other crawlers
+                    released = Feed.objects.release(self.worker_id, feeds)
+                    logger.info('Released %d unchecked feeds', released)
+
+        elapsed = time.perf_counter() - start
+        metrics.CYCLE_SECONDS.observe(elapsed)
+        metrics.CYCLE_FEEDS.inc(count)
+        logger.info('Checked %d feeds in %.2fs', count, elapsed)
+
+        # For the web processes to serve, see MetricsView
+        WorkerMetrics.objects.publish(self.worker_id, metrics.REGISTRY.collect(worker=self.worker_id),
+                                      timedelta(seconds=settings.CRAWLER_METRICS_MAX_AGE))
+
+    def wait(self, seconds: float) -> None:
+        """
+        Waits for the next cycle, which starts early when users request feeds to be checked
+        """
+        deadline = time.monotonic() + seconds
+
+        while not self.stopping.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self.stopping.wait(min(remaining, settings.CRAWLER_REQUEST_POLL_SECONDS)):
+                break
+            if Feed.objects.requested().unleased().exists():
+                break
 
     def handle(self, *args, **options):
-        print('time:', time.perf_counter() - start)
+        previous_handlers = {signum: signal.signal(signum, self._handle_signal)
+                             for signum in (signal.SIGTERM, signal.SIGINT)}
+        metrics_server = None
+        if options['metrics_port']:
+            metrics_server = metrics.start_http_server(options['metrics_port'], options['metrics_host'])
+
+        try:
+            with Crawler(concurrency=options['concurrency']) as self.crawler:
+                while not self.stopping.is_set():
+                    started_at = time.monotonic()
+                    self.run_cycle(options['batch_size'])
+
+                    if options['once']:
+                        break
+
+                    # Cycles start every N seconds; a cycle running late starts the next one right away
+                    self.wait(options['seconds'] - (time.monotonic() - started_at))
+        finally:
+            self.crawler = None
+            if metrics_server:
+                metrics_server.shutdown()
+                metrics_server.server_close()
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+
+        logger.info('Crawler stopped')
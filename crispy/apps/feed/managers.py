@@ -1,15 +1,19 @@
-import time
-from datetime import datetime
-from typing import Dict
+import math
+from datetime import timedelta
+from typing import Dict, List
 
 from django.apps import apps
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from crispy.apps.feed.records import EntryRecord
 
 
 ##################
 # Feed
 ##################
-from django.utils.timezone import make_aware
 
 
 class FeedQuerySet(models.query.QuerySet):
@@ -25,6 +29,20 @@ class FeedQuerySet(models.query.QuerySet):
     def from_user_bookmarks(self, user):
         return self.filter(bookmarks__user=user)
 
+    def for_listing(self):
+        """
+        Leaves out the fields only the crawlers use, e.g. the seen keys, which pages don't need
+        to load nor cache
+        """
+        return self.defer('seen_keys', 'extra_data')
+
+    def unleased(self, now=None):
+        """
+        Filters for feeds not leased to a crawler, or whose lease has expired
+        """
+        now = now or timezone.now()
+        return self.filter(Q(leased_until__isnull=True) | Q(leased_until__lte=now))
+
 
 class FeedManager(models.Manager):
     def active(self):
@@ -34,6 +52,127 @@ class FeedManager(models.Manager):
         """
         return self.get_queryset().filter(broken=False)
 
+    def due(self, now=None):
+        """
+        Returns a QS of active feeds due to be checked, the most overdue first
+        :param now: Reference date, defaults to now
+        :return:
+        """
+        now = now or timezone.now()
+        return self.active().filter(
+            Q(next_check_at__isnull=True) | Q(next_check_at__lte=now)
+        ).order_by(F('next_check_at').asc(nulls_first=True))
+
+    def reprobe_due(self, now=None):
+        """
+        Returns a QS of broken feeds due to be probed again, the most overdue first
+        :param now: Reference date, defaults to now
+        :return:
+        """
+        now = now or timezone.now()
+        return self.get_queryset().filter(broken=True).filter(
+            Q(next_check_at__isnull=True) | Q(next_check_at__lte=now)
+        ).order_by(F('next_check_at').asc(nulls_first=True))
+
+    def requested(self):
+        """
+        Returns a QS of the feeds whose check has been requested by users, the oldest request first
+        :return:
+        """
+        return self.get_queryset().filter(requested_at__isnull=False).order_by('requested_at')
+
+    def request_check(self, pk: int, window: timedelta, now=None) -> bool:
+        """
+        Queues a check of a feed for a user, unless one is already queued or running, or the feed
+        has been checked within `window`. Concurrent requests queue a single check.
+
+        :param pk: Feed id
+        :param window: How long a check stays fresh
+        :param now: Reference date, defaults to now
+        :return: Whether a check has been queued
+        """
+        now = now or timezone.now()
+        return bool(self.get_queryset().filter(pk=pk, requested_at__isnull=True, last_checked_at__lte=now - window)
+                    .unleased(now).update(requested_at=now))
+
+    def claim(self, owner: str, limit: int, lease: timedelta, now=None, requested: bool = False,
+              feeds=None) -> List:
+        """
+        Leases up to `limit` due feeds to a crawler, so that other crawlers skip them.
+        Rows locked by a concurrent claim are skipped (SELECT ... FOR UPDATE SKIP LOCKED) and
+        expired leases, left by crashed crawlers, are claimed again.
+
+        :param owner: Crawler identifier
+        :param limit: Maximum number of feeds to claim
+        :param lease: Lease duration
+        :param now: Reference date, defaults to now
+        :param requested: Claims the requested feeds instead of the due ones
+        :param feeds: QS of the feeds to claim, in order, instead of the due ones
+        :return: List of claimed feeds
+        """
+        now = now or timezone.now()
+        if limit <= 0:
+            return []
+        if feeds is None:
+            feeds = self.requested() if requested else self.due(now)
+
+        with transaction.atomic():
+            feeds = list(feeds.unleased(now).select_for_update(skip_locked=True)[:limit])
+
+            for feed in feeds:
+                feed.leased_by = owner
+                feed.leased_until = now + lease
+
+            self.filter(pk__in=[feed.pk for feed in feeds]).update(leased_by=owner, leased_until=now + lease)
+
+        return feeds
+
+    def claim_by_lane(self, owner: str, limit: int, lease: timedelta, now=None) -> List:
+        """
+        Leases up to `limit` feeds to a crawler, lane by lane:
+        - feeds requested by users, e.g. new ones, the oldest request first
+        - due feeds, and broken ones due to be probed again, overdue by more than
+          CRAWLER_STARVATION_SECONDS, so that no feed starves
+        - due feeds by priority, each priority getting its share of the rest of the batch
+          according to CRAWLER_PRIORITY_WEIGHTS. Shares left unused go to the other due feeds,
+          then to the broken feeds due to be probed again.
+
+        :param owner: Crawler identifier
+        :param limit: Maximum number of feeds to claim
+        :param lease: Lease duration
+        :param now: Reference date, defaults to now
+        :return: List of claimed feeds, by lane
+        """
+        now = now or timezone.now()
+        starving = now - timedelta(seconds=settings.CRAWLER_STARVATION_SECONDS)
+
+        feeds = self.claim(owner, limit, lease, now, requested=True)
+        feeds += self.claim(owner, limit - len(feeds), lease, now,
+                            feeds=self.due(now).filter(next_check_at__lte=starving))
+        feeds += self.claim(owner, limit - len(feeds), lease, now,
+                            feeds=self.reprobe_due(now).filter(next_check_at__lte=starving))
+
+        remaining = limit - len(feeds)
+        weights = settings.CRAWLER_PRIORITY_WEIGHTS
+        total = sum(weights.values())
+        for priority, weight in sorted(weights.items(), reverse=True):
+            share = min(limit - len(feeds), math.ceil(remaining * weight / total))
+            feeds += self.claim(owner, share, lease, now, feeds=self.due(now).filter(priority=priority))
+
+        feeds += self.claim(owner, limit - len(feeds), lease, now)
+        return feeds + self.claim(owner, limit - len(feeds), lease, now, feeds=self.reprobe_due(now))
+
+    def release(self, owner: str, feeds: List) -> int:
+        """
+        Releases the leases a crawler still holds on the given feeds, e.g. those it didn't get to
+        check before stopping, so that other crawlers can claim them right away
+        :param owner: Crawler identifier
+        :param feeds: Claimed feeds
+        :return: Number of released feeds
+        """
+        feeds = self.filter(pk__in=[feed.pk for feed in feeds], leased_by=owner)
+        return feeds.update(leased_by=None, leased_until=None)
+
     def get_queryset(self):
         return FeedQuerySet(self.model)
 
@@ -43,6 +182,9 @@ class FeedManager(models.Manager):
     def from_user_bookmarks(self, user):
         return self.get_queryset().from_user_bookmarks(user)
 
+    def for_listing(self):
+        return self.get_queryset().for_listing()
+
 
 ##################
 # Entry
@@ -79,6 +221,13 @@ class EntryQuerySet(models.query.QuerySet):
         """
         return self.filter(feed=feed)
 
+    def for_listing(self):
+        """
+        Leaves out the full content, listings show the excerpt
+        :return:
+        """
+        return self.defer('content')
+
 
 class EntryManager(models.Manager):
     def from_raw_entry(self, raw_entry: Dict):
@@ -88,47 +237,56 @@ class EntryManager(models.Manager):
         :param raw_entry: A raw entry
         :return: An Entry entity
         """
+        return self.model(**EntryRecord(raw_entry, timezone.now()).values())
 
-        entry = self.model()
-
-        # Get title
-        entry.title = raw_entry.get('title', '')
-
-        # Get content
-        content = raw_entry.get('content', [{'value': ''}])[0]['value']
-
-        if not content:
-            content = raw_entry.get('description', raw_entry.get('summary', ''))
+    def get_queryset(self):
+        """
+        Returns an EntryQuerySet
+        :return:
+        """
+        return EntryQuerySet(self.model)
 
-        entry.content = content
+    def get_from_feed(self, feed):
+        return self.get_query_set().from_feed(feed)
 
-        # Get date
-        date = raw_entry.get('updated_parsed',
-                             raw_entry.get('published_parsed',
-                                           raw_entry.get('created_parsed', None)))
+    def for_listing(self):
+        return self.get_queryset().for_listing()
 
-        if date:
-            entry.date = make_aware(datetime.fromtimestamp(time.mktime(date)))
-        else:
-            entry.date = datetime.now()
+    def recent(self, feed_id: int, limit: int):
+        """
+        Returns the id, title and date of the latest entries of a feed
+        :param feed_id: Feed id
+        :param limit: Maximum number of entries
+        :return: A QS of dicts
+        """
+        return self.get_queryset().filter(feed_id=feed_id).order_by('-date', '-id') \
+            .values('id', 'title', 'date')[:limit]
 
-        # Get URL
-        entry.url = raw_entry.get('link', '')
 
-        # Get GUID, uses URL if not found
-        entry.guid = raw_entry.get('guid', entry.url)
+##################
+# WorkerMetrics
+##################
 
-        # Get author
-        entry.author = raw_entry.get('author', '')
-        entry.comments_url = raw_entry.get('comments', '')
-        return entry
 
-    def get_queryset(self):
+class WorkerMetricsManager(models.Manager):
+    def publish(self, worker: str, samples: Dict, max_age: timedelta, now=None) -> None:
         """
-        Returns an EntryQuerySet
-        :return:
+        Stores the metrics of a crawler, and drops those of crawlers gone for longer than max_age
+        :param worker: Crawler identifier
+        :param samples: Samples of the crawler's metrics, see metrics.Registry.collect
+        :param max_age: Age after which the metrics of a crawler are dropped
+        :param now: Current time
         """
-        return EntryQuerySet(self.model)
+        now = now or timezone.now()
+        self.update_or_create(worker=worker, defaults={'samples': samples, 'updated_at': now})
+        self.filter(updated_at__lt=now - max_age).delete()
 
-    def get_from_feed(self, feed):
-        return self.get_query_set().from_feed(feed)
+    def live(self, max_age: timedelta, now=None):
+        """
+        Returns the metrics of the crawlers which published some within max_age
+        :param max_age: Age after which the metrics of a crawler are left out
+        :param now: Current time
+        :return: A QS of WorkerMetrics
+        """
+        now = now or timezone.now()
+        return self.filter(updated_at__gte=now - max_age).order_by('worker')
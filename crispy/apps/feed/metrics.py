@@ -0,0 +1,222 @@
+import abc
+import threading
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Content type of the Prometheus text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+LabelValues = Tuple[str, ...]
+
+# Samples of the metrics of a process, by metric name, see Registry.collect
+Samples = Dict[str, List[str]]
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+    labels = ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')
+                                       .replace('\n', '\\n'))
+                      for name, value in zip(names, values))
+    return '{{{}}}'.format(labels) if labels else ''
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != float('inf') else '+Inf'
+
+
+class Metric(abc.ABC):
+    """
+    Base class of metrics, optionally split by labels
+    """
+    type = None
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _label_values(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels[name]) for name in self.labels)
+
+    @abc.abstractmethod
+    def samples(self, **labels) -> List[str]:
+        """
+        Returns the sample lines of the metric, with the given labels added to each
+        """
+
+    def header(self) -> List[str]:
+        return ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} {}'.format(self.name, self.type)]
+
+    def render(self) -> str:
+        return '\n'.join(self.header() + self.samples())
+
+
+class Counter(Metric):
+    """
+    A value that only goes up
+    """
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = ()) -> None:
+        super().__init__(name, documentation, labels)
+        self._values = defaultdict(float)  # type: Dict[LabelValues, float]
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] += amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._label_values(labels), 0.0)
+
+    def samples(self, **labels) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        names, extra = tuple(labels), tuple(labels.values())
+        return ['{}{} {}'.format(self.name, _format_labels(names + self.labels, extra + key), _format_value(value))
+                for key, value in values]
+
+
+class Gauge(Counter):
+    """
+    A value that goes up and down
+    """
+    type = 'gauge'
+
+    def set(self, value: float, **labels) -> None:
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values, in cumulative buckets
+    """
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = (),
+                 buckets: Iterable[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'), )
+        self._counts = {}  # type: Dict[LabelValues, List[int]]
+        self._sums = defaultdict(float)  # type: Dict[LabelValues, float]
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._label_values(labels)
+        with self._lock:
+            counts = self._counts.setdefault(key, [0] * len(self.buckets))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self._sums[key] += value
+
+    def count(self, **labels) -> int:
+        return self._counts.get(self._label_values(labels), [0])[-1]
+
+    def samples(self, **labels) -> List[str]:
+        with self._lock:
+            counts = sorted((key, list(values)) for key, values in self._counts.items())
+            sums = dict(self._sums)
+
+        names, extra = tuple(labels) + self.labels, tuple(labels.values())
+        samples = []
+        for key, values in counts:
+            for bound, count in zip(self.buckets, values):
+                bucket = _format_labels(names + ('le', ), extra + key + (_format_value(bound), ))
+                samples.append('{}_bucket{} {}'.format(self.name, bucket, _format_value(count)))
+            labels = _format_labels(names, extra + key)
+            samples.append('{}_sum{} {}'.format(self.name, labels, _format_value(sums[key])))
+            samples.append('{}_count{} {}'.format(self.name, labels, _format_value(values[-1])))
+        return samples
+
+
+class Registry(object):
+    """
+    Holds the metrics of the process
+    """
+
+    def __init__(self) -> None:
+        self.metrics = []  # type: List[Metric]
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def collect(self, **labels) -> Samples:
+        """
+        Returns the samples of all metrics, with the given labels added, e.g. to be rendered by
+        another process
+        """
+        return {metric.name: metric.samples(**labels) for metric in self.metrics}
+
+    def render(self, collected: Optional[Iterable[Samples]] = None) -> str:
+        """
+        Renders all metrics in the Prometheus text format
+        :param collected: Samples collected from other processes, rendered instead of this one's
+        """
+        if collected is None:
+            return '\n'.join(metric.render() for metric in self.metrics) + '\n'
+
+        collected = list(collected)
+        lines = []
+        for metric in self.metrics:
+            lines += metric.header()
+            for samples in collected:
+                lines += samples.get(metric.name, [])
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+FETCH_SECONDS = REGISTRY.register(Histogram(
+    'crispy_feed_fetch_seconds', 'Time spent downloading feeds'))
+PARSE_SECONDS = REGISTRY.register(Histogram(
+    'crispy_feed_parse_seconds', 'Time spent parsing downloaded feeds'))
+STORE_SECONDS = REGISTRY.register(Histogram(
+    'crispy_feed_store_seconds', 'Time spent writing crawl results to the database'))
+DOWNLOADED_BYTES = REGISTRY.register(Counter(
+    'crispy_feed_downloaded_bytes_total', 'Bytes of feed documents downloaded, after decompression'))
+RESPONSES = REGISTRY.register(Counter(
+    'crispy_feed_responses_total', 'Feed responses by HTTP status', ['status']))
+CHECKS = REGISTRY.register(Counter(
+    'crispy_feed_checks_total', 'Feed checks by outcome: updated, unchanged, not_modified, '
+                                'broken, temporary_error or circuit_open', ['outcome']))
+ENTRIES = REGISTRY.register(Counter(
+    'crispy_feed_entries_total', 'Feed entries written, by operation: inserted or updated', ['operation']))
+QUEUE_DEPTH = REGISTRY.register(Gauge(
+    'crispy_crawler_queue_depth', 'Feeds waiting for a crawl slot'))
+CYCLE_SECONDS = REGISTRY.register(Histogram(
+    'crispy_crawler_cycle_seconds', 'Duration of crawl cycles', buckets=(1, 5, 10, 30, 60, 120, 300, 600)))
+CYCLE_FEEDS = REGISTRY.register(Counter(
+    'crispy_crawler_cycle_feeds_total', 'Feeds checked by crawl cycles'))
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        body = REGISTRY.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_http_server(port: int, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+    """
+    Serves the metrics from a background thread, on any path
+    :return: The server, to shut it down
+    """
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.5 on 2026-10-18 19:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feed', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='feed',
+            name='next_check_at',
+            field=models.DateTimeField(blank=True, db_index=True, help_text='Next time the feed is due to be checked', null=True, verbose_name='Next check at'),
+        ),
+    ]
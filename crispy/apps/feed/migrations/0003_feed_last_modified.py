@@ -0,0 +1,23 @@
+# Generated by Django 3.1.5 on 2026-10-18 19:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feed', '0002_feed_next_check_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='feed',
+            name='last_modified',
+            field=models.CharField(blank=True, help_text='Last-Modified header', max_length=64, null=True, verbose_name='Last-Modified'),
+        ),
+        migrations.AlterField(
+            model_name='feed',
+            name='etag',
+            field=models.CharField(blank=True, help_text='E-Tag header', max_length=255, null=True, verbose_name='E-Tag'),
+        ),
+    ]
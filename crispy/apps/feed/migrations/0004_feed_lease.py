@@ -0,0 +1,23 @@
+# Generated by Django 3.1.5 on 2026-10-18 19:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feed', '0003_feed_last_modified'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='feed',
+            name='leased_by',
+            field=models.CharField(blank=True, help_text='Crawler holding the lease', max_length=255, null=True, verbose_name='Leased by'),
+        ),
+        migrations.AddField(
+            model_name='feed',
+            name='leased_until',
+            field=models.DateTimeField(blank=True, help_text='Until when the feed is claimed by a crawler', null=True, verbose_name='Leased until'),
+        ),
+    ]
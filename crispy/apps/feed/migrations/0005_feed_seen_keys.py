@@ -0,0 +1,18 @@
+# Generated by Django 3.1.5 on 2026-10-18 20:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feed', '0004_feed_lease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='feed',
+            name='seen_keys',
+            field=models.JSONField(blank=True, default=list, help_text='Digests of the recently ingested entries', verbose_name='Seen keys'),
+        ),
+    ]
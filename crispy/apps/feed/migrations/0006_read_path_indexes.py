@@ -0,0 +1,73 @@
+# Generated by Django 3.1.5 on 2026-10-18 20:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def create_extra_data_gin_index(apps, schema_editor):
+    """
+    B-tree indexes don't help JSON queries, extra_data gets a GIN index where supported
+    """
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('CREATE INDEX feed_extra_data_gin_idx ON feed_feed USING gin (extra_data jsonb_path_ops)')
+
+
+def drop_extra_data_gin_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS feed_extra_data_gin_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feed', '0005_feed_seen_keys'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='feed',
+            name='extra_data',
+            field=models.JSONField(null=True, verbose_name='Extra data'),
+        ),
+        migrations.AlterField(
+            model_name='feed',
+            name='next_check_at',
+            field=models.DateTimeField(blank=True, help_text='Next time the feed is due to be checked', null=True, verbose_name='Next check at'),
+        ),
+        migrations.AlterField(
+            model_name='feed',
+            name='title',
+            field=models.TextField(help_text='Title of the feed', verbose_name='Title'),
+        ),
+        migrations.AddIndex(
+            model_name='entry',
+            index=models.Index(fields=['feed', '-date', '-id'], name='entry_feed_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='entry',
+            index=models.Index(fields=['feed', 'guid'], name='entry_feed_guid_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='entry',
+            index=models.Index(fields=['feed', 'url'], name='entry_feed_url_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='entry',
+            index=models.Index(fields=['feed', 'title'], name='entry_feed_title_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='feed',
+            index=models.Index(fields=['title', 'last_updated_at'], name='feed_title_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='feed',
+            index=models.Index(condition=models.Q(broken=False), fields=['next_check_at'], name='feed_due_idx'),
+        ),
+        # The composite indexes above replace the foreign key's own index
+        migrations.AlterField(
+            model_name='entry',
+            name='feed',
+            field=models.ForeignKey(db_index=False, help_text='Feed this entry belongs to', on_delete=django.db.models.deletion.CASCADE, related_name='entries', to='feed.feed'),
+        ),
+        migrations.RunPython(create_extra_data_gin_index, drop_extra_data_gin_index),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 3.1.5 on 2026-10-18 20:05
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_rows(related_model, field):
+    return Coalesce(Subquery(
+        related_model.objects.filter(**{field: OuterRef('pk')}).order_by().values(field)
+        .annotate(count=Count('pk')).values('count')
+    ), 0)
+
+
+def backfill_counters(apps, schema_editor):
+    Feed = apps.get_model('feed', 'Feed')
+    Entry = apps.get_model('feed', 'Entry')
+    Comment = apps.get_model('web', 'Comment')
+
+    Feed.objects.update(entry_count=count_rows(Entry, 'feed'))
+    Entry.objects.update(comment_count=count_rows(Comment, 'entry'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feed', '0006_read_path_indexes'),
+        ('web', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='entry',
+            name='comment_count',
+            field=models.PositiveIntegerField(default=0, help_text='Number of comments on this entry'),
+        ),
+        migrations.AddField(
+            model_name='feed',
+            name='entry_count',
+            field=models.PositiveIntegerField(default=0, help_text='Number of entries of the feed', verbose_name='Entry count'),
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 3.1.5 on 2026-10-18 20:15
+
+from django.db import migrations, models
+
+from crispy.apps.feed.records import make_excerpt
+
+BATCH_SIZE = 1000
+
+
+def backfill_excerpts(apps, schema_editor):
+    Entry = apps.get_model('feed', 'Entry')
+    batch = []
+
+    for entry in Entry.objects.only('id', 'content').iterator(chunk_size=BATCH_SIZE):
+        entry.excerpt = make_excerpt(entry.content)
+        batch.append(entry)
+
+        if len(batch) == BATCH_SIZE:
+            Entry.objects.bulk_update(batch, ['excerpt'])
+            batch = []
+
+    if batch:
+        Entry.objects.bulk_update(batch, ['excerpt'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feed', '0007_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='entry',
+            name='excerpt',
+            field=models.TextField(blank=True, help_text='Beginning of the content, as plain text'),
+        ),
+        migrations.RunPython(backfill_excerpts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 3.1.5 on 2026-10-18 20:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feed', '0008_entry_excerpt'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='feed',
+            name='requested_at',
+            field=models.DateTimeField(blank=True, help_text='When a check of the feed has been requested by a user', null=True, verbose_name='Requested at'),
+        ),
+        migrations.AddField(
+            model_name='feed',
+            name='state',
+            field=models.CharField(choices=[('pending', 'Pending'), ('active', 'Active')], default='active', help_text='Pending until the feed is first checked', max_length=30, verbose_name='State'),
+        ),
+        migrations.AddIndex(
+            model_name='feed',
+            index=models.Index(condition=models.Q(requested_at__isnull=False), fields=['requested_at'], name='feed_requested_idx'),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 3.1.5 on 2026-10-18 20:24
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_priorities(apps, schema_editor):
+    Feed = apps.get_model('feed', 'Feed')
+    Bookmark = apps.get_model('web', 'Bookmark')
+
+    Feed.objects.update(bookmark_count=Coalesce(Subquery(
+        Bookmark.objects.filter(feed=OuterRef('pk')).order_by().values('feed')
+        .annotate(count=Count('pk')).values('count')
+    ), 0))
+
+    # As computed by compute_priority, no feed having been read yet
+    Feed.objects.filter(bookmark_count__gt=0).update(priority=1)
+    Feed.objects.filter(bookmark_count__gte=settings.FEED_POPULAR_BOOKMARKS).update(priority=2)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feed', '0009_feed_requests'),
+        ('web', '0002_read_path_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='feed',
+            name='bookmark_count',
+            field=models.PositiveIntegerField(default=0, help_text='Number of users who bookmarked the feed', verbose_name='Bookmark count'),
+        ),
+        migrations.AddField(
+            model_name='feed',
+            name='last_read_at',
+            field=models.DateTimeField(blank=True, help_text='Last time the feed, or one of its entries, has been read', null=True, verbose_name='Last read at'),
+        ),
+        migrations.AddField(
+            model_name='feed',
+            name='priority',
+            field=models.PositiveSmallIntegerField(default=0, help_text='Crawl priority, from bookmarks and reads', verbose_name='Priority'),
+        ),
+        migrations.AddIndex(
+            model_name='feed',
+            index=models.Index(condition=models.Q(broken=False), fields=['priority', 'next_check_at'], name='feed_lane_idx'),
+        ),
+        migrations.RunPython(backfill_priorities, migrations.RunPython.noop),
+    ]
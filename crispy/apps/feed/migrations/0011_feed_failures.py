@@ -0,0 +1,22 @@
+# Generated by Django 3.1.5 on 2026-10-18 20:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feed', '0010_crawl_priority'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='feed',
+            name='failure_count',
+            field=models.PositiveIntegerField(default=0, help_text='Number of failed checks in a row', verbose_name='Failure count'),
+        ),
+        migrations.AddIndex(
+            model_name='feed',
+            index=models.Index(condition=models.Q(broken=True), fields=['next_check_at'], name='feed_reprobe_idx'),
+        ),
+    ]
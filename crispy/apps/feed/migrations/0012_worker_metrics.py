@@ -0,0 +1,25 @@
+# Generated by Django 3.1.5 on 2026-10-18 20:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feed', '0011_feed_failures'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WorkerMetrics',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('worker', models.CharField(help_text='Crawler this snapshot comes from', max_length=255, unique=True)),
+                ('samples', models.JSONField(default=dict, help_text='Sample lines by metric name')),
+                ('updated_at', models.DateTimeField(help_text='Date the crawler last published its metrics')),
+            ],
+            options={
+                'verbose_name_plural': 'Worker metrics',
+            },
+        ),
+    ]
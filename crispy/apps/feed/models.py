@@ -1,13 +1,17 @@
+from collections import defaultdict
 from datetime import datetime
-from typing import List, Dict
+from typing import List, Dict, Set, Union
 
 import feedparser
 
+from django.conf import settings
 from django.core.validators import URLValidator
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone
 
 from crispy.apps.core.exceptions import CrispyException
-from crispy.apps.feed import constants, managers
+from crispy.apps.feed import cache, constants, managers, metrics, scheduling
+from crispy.apps.feed.records import ENTRY_FIELDS, EntryRecord, fingerprint, normalize_entries
 
 
 class Feed(models.Model):
@@ -21,11 +25,17 @@ class Feed(models.Model):
                                  verbose_name="Broken", db_index=True)
     error = models.TextField(blank=True, null=True, help_text="Error when a problem occurs",
                              verbose_name="Error")
+    failure_count = models.PositiveIntegerField(default=0, verbose_name="Failure count",
+                                                help_text="Number of failed checks in a row")
     feed_url = models.TextField(validators=[URLValidator()], help_text="URL of the RSS feed",
                                 verbose_name="Feed URL", unique=True)
     type = models.CharField(choices=constants.FEED_TYPES, db_index=True, max_length=30,
                             verbose_name="Type", help_text="Type of the feed")
-    etag = models.CharField(blank=True, null=True, max_length=100, verbose_name="E-Tag", help_text="E-Tag header")
+    etag = models.CharField(blank=True, null=True, max_length=255, verbose_name="E-Tag", help_text="E-Tag header")
+    last_modified = models.CharField(blank=True, null=True, max_length=64, verbose_name="Last-Modified",
+                                     help_text="Last-Modified header")
+    state = models.CharField(choices=constants.FEED_STATES, default=constants.FEED_STATE_ACTIVE, max_length=30,
+                             verbose_name="State", help_text="Pending until the feed is first checked")
 
     # Dates
     created_at = models.DateTimeField(auto_now_add=True, help_text="Date this feed has been added",
@@ -35,16 +45,41 @@ class Feed(models.Model):
     last_updated_at = models.DateTimeField(blank=True, null=True,
                                            help_text="Last time the feed has been updated",
                                            verbose_name="Last updated at")
+    next_check_at = models.DateTimeField(blank=True, null=True,
+                                         help_text="Next time the feed is due to be checked",
+                                         verbose_name="Next check at")
+    leased_until = models.DateTimeField(blank=True, null=True,
+                                        help_text="Until when the feed is claimed by a crawler",
+                                        verbose_name="Leased until")
+    leased_by = models.CharField(blank=True, null=True, max_length=255,
+                                 help_text="Crawler holding the lease", verbose_name="Leased by")
+    requested_at = models.DateTimeField(blank=True, null=True,
+                                        help_text="When a check of the feed has been requested by a user",
+                                        verbose_name="Requested at")
+    last_read_at = models.DateTimeField(blank=True, null=True,
+                                        help_text="Last time the feed, or one of its entries, has been read",
+                                        verbose_name="Last read at")
+    priority = models.PositiveSmallIntegerField(default=0, verbose_name="Priority",
+                                                help_text="Crawl priority, from bookmarks and reads")
 
     # Required data fields
-    title = models.TextField(help_text="Title of the feed", verbose_name="Title", db_index=True)
+    title = models.TextField(help_text="Title of the feed", verbose_name="Title")
 
     # Optional data fields
     alternate_title = models.TextField(blank=True, null=True, help_text="Alternate title for the feed",
                                        verbose_name="Alternate title")
     site_url = models.TextField(blank=True, null=True, validators=[URLValidator()],
                                 help_text="URL of the feed's website", verbose_name="Site URL")
-    extra_data = models.JSONField(verbose_name="Extra data", db_index=True, null=True)
+    # Indexed with GIN on PostgreSQL, see migration 0006
+    extra_data = models.JSONField(verbose_name="Extra data", null=True)
+    seen_keys = models.JSONField(default=list, blank=True, verbose_name="Seen keys",
+                                 help_text="Digests of the recently ingested entries")
+
+    # Counters, maintained with F() updates as rows are added, never written by save()
+    entry_count = models.PositiveIntegerField(default=0, verbose_name="Entry count",
+                                              help_text="Number of entries of the feed")
+    bookmark_count = models.PositiveIntegerField(default=0, verbose_name="Bookmark count",
+                                                 help_text="Number of users who bookmarked the feed")
 
     # Manager
     objects = managers.FeedManager()
@@ -52,52 +87,169 @@ class Feed(models.Model):
     # Methods and meta
     class Meta:
         ordering = ('title', 'last_updated_at', )
+        indexes = [
+            models.Index(fields=['title', 'last_updated_at'], name='feed_title_updated_idx'),
+            # Due feeds, see FeedManager.due
+            models.Index(fields=['next_check_at'], name='feed_due_idx', condition=models.Q(broken=False)),
+            # Requested feeds, see FeedManager.requested
+            models.Index(fields=['requested_at'], name='feed_requested_idx',
+                         condition=models.Q(requested_at__isnull=False)),
+            # Due feeds by priority, see FeedManager.claim_by_lane
+            models.Index(fields=['priority', 'next_check_at'], name='feed_lane_idx',
+                         condition=models.Q(broken=False)),
+            # Broken feeds due to be probed again, see FeedManager.reprobe_due
+            models.Index(fields=['next_check_at'], name='feed_reprobe_idx', condition=models.Q(broken=True)),
+        ]
+
+    # Fields updated in the database only, as rows are added or the feed is read
+    COUNTER_FIELDS = ('entry_count', 'bookmark_count', 'last_read_at')
 
     def __str__(self):
-        return self.alternate_title or self.title
+        # Pending feeds have no title yet
+        return self.alternate_title or self.title or self.feed_url
 
-    def _update_entries(self, entries: List[Dict]) -> datetime:
+    @property
+    def pending(self) -> bool:
+        return self.state == constants.FEED_STATE_PENDING
+
+    @property
+    def awaiting_check(self) -> bool:
         """
-        Adds or updates the feeds entries given an entry list
-        :param entries:
-        :return: Datetime of the latest entry
+        Whether the feed is pending or a user requested a check, which the crawlers haven't stored yet
         """
-        latest = None  # Keeps track of the latest entry
+        return self.pending or self.requested_at is not None
+
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+
+        # Counters are updated atomically in the database, their in-memory values may be stale
+        if not adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.name not in self.COUNTER_FIELDS]
+        super().save(*args, **kwargs)
+
+        # New feeds show up in the cached listings
+        if adding:
+            cache.invalidate_feed_list()
+
+    def _existing_entries(self, records: List[EntryRecord]) -> models.QuerySet:
+        """
+        Returns a QS of the stored entries matching any of the given records
+        :param records: Incoming entry records
+        """
+        # Only look up each record by its own key, so that each branch of the query uses its index
+        values = defaultdict(set)
+        for record in records:
+            values[record.key[0]].add(record.key[1])
+
+        query = models.Q(pk__in=[])
+        for field, field_values in values.items():
+            query |= models.Q(**{'{}__in'.format(field): field_values})
+
+        return self.entries.filter(query)
 
-        for entry in entries:
-            # Get entry entity
-            entry = Entry.objects.from_raw_entry(entry)
-            entry.feed = self
+    def _find_existing_entries(self, records: List[EntryRecord]) -> Dict[tuple, 'Entry']:
+        """
+        Loads, in a single query, the stored entries matching any of the given records
+        :param records: Incoming entry records
+        :return: Stored entries indexed by their lookup key
+        """
+        existing = {}
 
-            # Try to match by guid, then url, then title and date
+        # Register every stored entry under each key an incoming entry could look it up by.
+        # The first match wins, as ordering by date makes it the newest one
+        for entry in self._existing_entries(records):
+            keys = [('title', entry.title, entry.date)]
+            if entry.url:
+                keys.append(('url', entry.url))
             if entry.guid:
-                query = {'guid': entry.guid}
-            elif entry.url:
-                query = {'url': entry.url}
-            elif entry.title:
-                query = {
-                    'title': entry.title,
-                    'date': entry.date
-                }
-            else:
-                # An Entry must contain at least one of the above
+                keys.append(('guid', entry.guid))
+
+            for key in keys:
+                existing.setdefault(key, entry)
+
+        return existing
+
+    def _is_ingested(self, record: EntryRecord, seen_keys: Set[str]) -> bool:
+        """
+        Whether a record has already been ingested, as is: it's not newer than the feed's
+        high-water mark and has been seen with the same date
+        """
+        return (record.dated and self.last_updated_at is not None and record.date <= self.last_updated_at
+                and record.seen_key() in seen_keys)
+
+    def _update_entries(self, entries: List[Union[Dict, EntryRecord]]) -> datetime:
+        """
+        Adds or updates the feeds entries given an entry list.
+        Entries already ingested are skipped without querying the database. Existing entries are
+        loaded in one query and changes are written in bulk, in one transaction.
+        Entry instances are only built for the entries being created.
+        :param entries: Raw entries or EntryRecords
+        :return: Datetime of the latest entry
+        """
+        latest = None  # Keeps track of the latest entry
+        incoming = {}  # Incoming records by lookup key, newest version only
+        seen_keys = set(self.seen_keys or ())
+
+        for record in normalize_entries(entries):
+            if record.key is None:
+                # An Entry must contain at least one identifier
                 raise CrispyException("Can't find an entry identifier, cannot import")
 
-            # Update existing entries and delete old
-            try:
-                existing = self.entries.get(**query)
-            except models.ObjectDoesNotExist:
-                # Existing entry not found, create it
-                entry.save()
-            else:
-                # Existing entry found
-                # Updates entry if newer
-                if entry.date and entry.date > existing.date:
-                    existing.update(entry)
+            current = incoming.get(record.key)
+            if current is None or record.date > current.date:
+                incoming[record.key] = record
 
             # Update latest tracker
-            if not latest or (entry.date and entry.date > latest):
-                latest = entry.date
+            if not latest or record.date > latest:
+                latest = record.date
+
+        # Remembers the document's entries for the next update, before dropping the ingested ones
+        self.seen_keys = [record.seen_key() for record in incoming.values()][:settings.FEED_SEEN_KEYS_SIZE]
+        incoming = {key: record for key, record in incoming.items() if not self._is_ingested(record, seen_keys)}
+        if not incoming:
+            return latest
+
+        existing = self._find_existing_entries(list(incoming.values()))
+        created = []
+        updated = []
+        updated_fields = set()
+
+        for key, record in incoming.items():
+            current = existing.get(key)
+
+            if current is None:
+                # Existing entry not found, create it
+                created.append(Entry(feed=self, **record.values()))
+            elif record.date > current.date:
+                # Existing entry found, updates it if newer and changed
+                if record.fingerprint != fingerprint(current):
+                    changed_fields = current.update(record, commit=False)
+                elif record.dated:
+                    current.date = record.date
+                    changed_fields = ['date']
+                else:
+                    # Undated entries are dated with the check, their date hasn't changed
+                    changed_fields = []
+
+                if changed_fields:
+                    updated.append(current)
+                    updated_fields.update(changed_fields)
+
+        if created or updated:
+            with transaction.atomic():
+                if created:
+                    Entry.objects.bulk_create(created)
+                    Feed.objects.filter(pk=self.pk).update(entry_count=models.F('entry_count') + len(created))
+                    self.entry_count += len(created)
+                if updated:
+                    Entry.objects.bulk_update(updated, sorted(updated_fields))
+
+            cache.invalidate_feed(self.pk)
+            cache.invalidate_feed_list()
+            metrics.ENTRIES.inc(len(created), operation='inserted')
+            metrics.ENTRIES.inc(len(updated), operation='updated')
+
         return latest
 
     def _update_feed_data(self, feed_data_obj: feedparser.FeedParserDict) -> None:
@@ -119,15 +271,90 @@ class Feed(models.Model):
         # Update feed data
         self._update_feed_data(parsed_feed.feed)
 
-    def update_feed_entries(self, entries: List[Dict]):
+    def record_read(self, now=None) -> None:
+        """
+        Records that the feed, or one of its entries, is being read, which raises its crawl priority.
+        Only written once per FEED_READ_TRACKING_SECONDS.
+        """
+        if not cache.track_read(self.pk):
+            return
+
+        now = now or timezone.now()
+        self.last_read_at = now
+        self.priority = scheduling.compute_priority(self.bookmark_count, now, now)
+        Feed.objects.filter(pk=self.pk).update(last_read_at=now, priority=self.priority)
+
+    def update_priority(self, now=None) -> None:
+        """
+        Computes the crawl priority of the feed, which decays as reads get older. Saved along with the feed.
+        """
+        self.priority = scheduling.compute_priority(self.bookmark_count, self.last_read_at, now or timezone.now())
+
+    def request_check(self, now=None) -> None:
+        """
+        Queues the feed to be checked by the crawlers ahead of the due feeds. Saved along with the feed.
+        """
+        self.requested_at = now or timezone.now()
+
+    def complete_check(self) -> None:
+        """
+        Marks the feed as checked: it's no longer pending and any requested check is done.
+        Saved along with the feed.
+        """
+        self.requested_at = None
+        self.state = constants.FEED_STATE_ACTIVE
+
+    def release_lease(self) -> None:
+        """
+        Gives the feed back to other crawlers. Saved along with the feed.
+        """
+        self.leased_until = None
+        self.leased_by = None
+
+    def record_success(self) -> None:
+        """
+        Records a successful check: the feed is neither failing nor broken anymore. Saved along with the feed.
+        """
+        self.failure_count = 0
+        self.broken = False
+        self.error = None
+
+    def record_failure(self, error: Exception, permanent: bool = False) -> None:
+        """
+        Records a failed check, retried with an exponential backoff. Permanent failures (404, 410)
+        break the feed once they happened FEED_BROKEN_AFTER_FAILURES times in a row.
+        Saved along with the feed.
+        """
+        self.failure_count += 1
+        self.error = error
+        if permanent and self.failure_count >= settings.FEED_BROKEN_AFTER_FAILURES:
+            self.broken = True
+
+    def schedule_next_check(self) -> None:
+        """
+        Sets the next check date according to the feed's publishing cadence, or backs off failing
+        feeds. Broken feeds are probed again once in a while, in case they came back.
+        """
+        last_checked_at = self.last_checked_at or timezone.now()
+
+        if self.broken:
+            self.next_check_at = last_checked_at + scheduling.compute_reprobe_interval()
+            return
+        if self.failure_count:
+            self.next_check_at = last_checked_at + scheduling.compute_backoff(self.failure_count)
+            return
+
+        entry_dates = list(self.entries.order_by('-date').values_list('date', flat=True)
+                           [:settings.FEED_CADENCE_SAMPLE_SIZE])
+        interval = scheduling.compute_check_interval(entry_dates, self.last_updated_at, last_checked_at)
+        self.next_check_at = last_checked_at + interval
+
+    def update_feed_entries(self, entries: List[Union[Dict, EntryRecord]]):
         # Update entries
         try:
             last_updated = self._update_entries(entries)
         except CrispyException as e:
-            if self.error:
-                self.error += ". \n"
-
-            self.error += "Entry error: {}".format(e)
+            self.error = "{}Entry error: {}".format("{}. \n".format(self.error) if self.error else "", e)
             return False
         else:
             # Update last updated
@@ -136,7 +363,9 @@ class Feed(models.Model):
 
 class Entry(models.Model):
     # Entity control fields
-    feed = models.ForeignKey(Feed, related_name='entries', help_text="Feed this entry belongs to", on_delete=models.CASCADE)
+    # Indexed by the composite indexes below, which all start with the feed
+    feed = models.ForeignKey(Feed, related_name='entries', help_text="Feed this entry belongs to",
+                             on_delete=models.CASCADE, db_index=False)
 
     # Date fields
     date = models.DateTimeField(help_text="Date this entry has been added")
@@ -144,6 +373,7 @@ class Entry(models.Model):
     # Required data fields
     title = models.TextField(blank=True)
     content = models.TextField(blank=True)
+    excerpt = models.TextField(blank=True, help_text="Beginning of the content, as plain text")
 
     # Optional data fields
     author = models.TextField(blank=True, help_text="Author of this entry")
@@ -152,6 +382,9 @@ class Entry(models.Model):
     url = models.TextField(blank=True, validators=[URLValidator()], help_text="URL for the HTML for this entry")
     guid = models.TextField(blank=True, help_text="GUID for the entry, according to the feed")
 
+    # Counters, maintained with F() updates as rows are added
+    comment_count = models.PositiveIntegerField(default=0, help_text="Number of comments on this entry")
+
     # Manager
     objects = managers.EntryManager()
 
@@ -162,17 +395,61 @@ class Entry(models.Model):
     class Meta:
         ordering = ('-date', )
         verbose_name_plural = 'Entries'
+        indexes = [
+            models.Index(fields=['feed', '-date', '-id'], name='entry_feed_date_idx'),
+            # Lookups of stored entries during ingestion, see Feed._find_existing_entries
+            models.Index(fields=['feed', 'guid'], name='entry_feed_guid_idx'),
+            models.Index(fields=['feed', 'url'], name='entry_feed_url_idx'),
+            models.Index(fields=['feed', 'title'], name='entry_feed_title_idx'),
+        ]
 
-    def update(self, entry):
+    @property
+    def lookup_key(self) -> tuple:
+        """
+        Key used to match this entry against stored ones: its guid, then url, then title and date
+        """
+        if self.guid:
+            return 'guid', self.guid
+        elif self.url:
+            return 'url', self.url
+        elif self.title:
+            return 'title', self.title, self.date
+
+        # An Entry must contain at least one of the above
+        raise CrispyException("Can't find an entry identifier, cannot import")
+
+    def update(self, entry, commit: bool = True) -> List[str]:
         """
         An old entry has been re-published; update with new data
+        :param entry: The re-published entry, an Entry or an EntryRecord
+        :param commit: Saves the changed fields
+        :return: Names of the fields that changed
         """
-        fields = [
-            'date', 'title', 'content', 'author', 'comments_url', 'url',
-            'guid',
-        ]
+        changed_fields = [field for field in ENTRY_FIELDS if getattr(self, field) != getattr(entry, field)]
 
-        for field in fields:
+        for field in changed_fields:
             setattr(self, field, getattr(entry, field))
-            
-        self.save()
+
+        if commit and changed_fields:
+            self.save(update_fields=changed_fields)
+
+        return changed_fields
+
+
+class WorkerMetrics(models.Model):
+    """
+    Metrics a crawler publishes after each cycle, for the web processes to serve, see MetricsView
+    """
+    worker = models.CharField(max_length=255, unique=True, help_text="Crawler this snapshot comes from")
+    samples = models.JSONField(default=dict, help_text="Sample lines by metric name")
+    updated_at = models.DateTimeField(help_text="Date the crawler last published its metrics")
+
+    # Manager
+    objects = managers.WorkerMetricsManager()
+
+    # Methods and meta
+    def __str__(self):
+        return self.worker
+
+    class Meta:
+        verbose_name_plural = 'Worker metrics'
@@ -0,0 +1,38 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Optional
+
+import feedparser
+
+# This module is imported by the parser processes, keep it free of Django imports
+
+
+def _parse(parse_func: Callable[..., feedparser.FeedParserDict], *args) -> feedparser.FeedParserDict:
+    parsed_feed = parse_func(*args)
+
+    # Parse errors aren't always picklable, only their message is sent back
+    if 'bozo_exception' in parsed_feed:
+        parsed_feed['bozo_exception'] = str(parsed_feed['bozo_exception'])
+
+    return parsed_feed
+
+
+class ProcessPoolParser(object):
+    """
+    Runs a parse_func (as in feedparser.parse) in a pool of processes, so parsing large
+    feeds isn't bound to a single core. Instances are used as the parse_func itself.
+    """
+
+    def __init__(self, parse_func: Callable[..., feedparser.FeedParserDict] = feedparser.parse,
+                 processes: Optional[int] = None) -> None:
+        self.parse_func = parse_func
+        self.processes = processes or multiprocessing.cpu_count()
+        # Parsers are spawned rather than forked, as the crawler runs threads
+        self._executor = ProcessPoolExecutor(max_workers=self.processes,
+                                             mp_context=multiprocessing.get_context('spawn'))
+
+    def __call__(self, *args) -> feedparser.FeedParserDict:
+        return self._executor.submit(_parse, self.parse_func, *args).result()
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True)
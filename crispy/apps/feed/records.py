@@ -0,0 +1,174 @@
+import hashlib
+from datetime import datetime, timezone
+from html.parser import HTMLParser
+from typing import Dict, Iterable, List, Optional, Union
+
+# This module is free of Django imports, records can be built anywhere
+
+# Entry fields copied from a record to an Entry
+ENTRY_FIELDS = ('date', 'title', 'content', 'excerpt', 'author', 'comments_url', 'url', 'guid')
+
+# Entry fields covered by the content fingerprint
+FINGERPRINT_FIELDS = ('title', 'content', 'author', 'comments_url', 'url', 'guid')
+
+
+def fingerprint(entry) -> str:
+    """
+    Returns a digest of the content fields of an entry, or of anything with the same attributes
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for field in FINGERPRINT_FIELDS:
+        digest.update(getattr(entry, field).encode('utf-8', 'surrogatepass'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+# Maximum length of entry excerpts
+EXCERPT_LENGTH = 280
+
+
+class _TextExtractor(HTMLParser):
+    """
+    Collects the text of an HTML document, leaving out scripts and styles
+    """
+
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        self.parts = []  # type: List[str]
+        self._skipped = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('script', 'style'):
+            self._skipped += 1
+
+    def handle_endtag(self, tag):
+        if tag in ('script', 'style') and self._skipped:
+            self._skipped -= 1
+
+    def handle_data(self, data):
+        if not self._skipped:
+            self.parts.append(data)
+
+
+def make_excerpt(content: str, length: int = EXCERPT_LENGTH) -> str:
+    """
+    Returns the beginning of an entry's content as plain text, cut on a word boundary
+    :param content: HTML content
+    :param length: Maximum length of the excerpt
+    """
+    # The excerpt only needs the beginning of long contents
+    content = content[:length * 50]
+
+    if '<' in content or '&' in content:
+        extractor = _TextExtractor()
+        extractor.feed(content)
+        extractor.close()
+        content = ' '.join(extractor.parts)
+
+    text = ' '.join(content.split())
+    if len(text) <= length:
+        return text
+
+    text = text[:length - 1]
+    space = text.rfind(' ')
+    if space > length // 2:
+        text = text[:space]
+    return text.rstrip(' .,;:') + '\u2026'
+
+
+def parse_date(raw_entry: Dict) -> Optional[datetime]:
+    """
+    Returns the date of a raw entry: its update, publication or creation date, in that order
+    """
+    date = raw_entry.get('updated_parsed',
+                         raw_entry.get('published_parsed',
+                                       raw_entry.get('created_parsed', None)))
+    if not date:
+        return None
+
+    # feedparser normalizes dates to UTC
+    return datetime(*date[:6], tzinfo=timezone.utc)
+
+
+class EntryRecord(object):
+    """
+    A feed entry normalized from a raw (feedparser) entry, in a single pass.
+    Holds the entry's fields, the key it's matched against stored entries by and a fingerprint
+    of its content. Entries without a date are dated with the normalization date.
+    The excerpt is only computed when needed, for the records being written.
+    """
+    __slots__ = ('date', 'title', 'content', 'author', 'comments_url', 'url', 'guid', 'dated', 'key',
+                 'fingerprint', '_excerpt')
+
+    def __init__(self, raw_entry: Dict, default_date: datetime) -> None:
+        date = parse_date(raw_entry)
+        self.dated = date is not None
+        self.date = date or default_date
+
+        self.title = raw_entry.get('title', '')
+
+        content = raw_entry.get('content', [{'value': ''}])[0]['value']
+        self.content = content or raw_entry.get('description', raw_entry.get('summary', ''))
+
+        self.url = raw_entry.get('link', '')
+        # Uses the URL as GUID if not found
+        self.guid = raw_entry.get('guid', self.url)
+        self.author = raw_entry.get('author', '')
+        self.comments_url = raw_entry.get('comments', '')
+
+        if self.guid:
+            self.key = ('guid', self.guid)  # type: Optional[tuple]
+        elif self.url:
+            self.key = ('url', self.url)
+        elif self.title:
+            self.key = ('title', self.title, self.date)
+        else:
+            self.key = None
+
+        self.fingerprint = fingerprint(self)
+        self._excerpt = None
+
+    @property
+    def excerpt(self) -> str:
+        if self._excerpt is None:
+            self._excerpt = make_excerpt(self.content)
+        return self._excerpt
+
+    def __repr__(self) -> str:
+        return '<EntryRecord {!r}>'.format(self.key)
+
+    def seen_key(self) -> str:
+        """
+        Returns a short digest of the record's key and date, remembered once the record is ingested
+        """
+        digest = hashlib.blake2b(digest_size=8)
+        for part in self.key + (self.date.isoformat(), ):
+            digest.update(str(part).encode('utf-8', 'surrogatepass'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def values(self) -> Dict:
+        """
+        Returns the Entry field values of this record
+        """
+        return {field: getattr(self, field) for field in ENTRY_FIELDS}
+
+
+def normalize_entries(raw_entries: Iterable[Union[Dict, EntryRecord]],
+                      default_date: Optional[datetime] = None) -> List[EntryRecord]:
+    """
+    Normalizes raw entries into EntryRecords. Records are passed through.
+    :param raw_entries: Raw (feedparser) entries
+    :param default_date: Date of undated entries, defaults to now
+    :return: A list of EntryRecord
+    """
+    default_date = default_date or datetime.now(timezone.utc)
+    return [raw_entry if isinstance(raw_entry, EntryRecord) else EntryRecord(raw_entry, default_date)
+            for raw_entry in raw_entries]
+
+
+def find_latest(records: Iterable[EntryRecord]) -> Optional[datetime]:
+    """
+    Returns the latest date of the given records, ignoring undated ones
+    """
+    return max((record.date for record in records if record.dated), default=None)
@@ -0,0 +1,94 @@
+import random
+from datetime import datetime, timedelta
+from statistics import median
+from typing import Callable, List, Optional
+
+from django.conf import settings
+
+
+def compute_check_interval(entry_dates: List[datetime],
+                           last_updated_at: Optional[datetime],
+                           last_checked_at: Optional[datetime]) -> timedelta:
+    """
+    Computes how long to wait before checking a feed again, based on how often it publishes.
+
+    The feed is polled twice per its typical gap between entries, and backs off further while
+    it stays silent for longer than usual. The result is clamped to
+    FEED_CHECK_INTERVAL_MIN and FEED_CHECK_INTERVAL_MAX.
+
+    :param entry_dates: Dates of the most recent entries
+    :param last_updated_at: Date of the latest entry
+    :param last_checked_at: Last time the feed was checked
+    :return: timedelta
+    """
+    min_interval = timedelta(seconds=settings.FEED_CHECK_INTERVAL_MIN)
+    max_interval = timedelta(seconds=settings.FEED_CHECK_INTERVAL_MAX)
+
+    dates = sorted(entry_dates, reverse=True)
+    gaps = [newer - older for newer, older in zip(dates, dates[1:]) if newer > older]
+
+    if not gaps:
+        # Not enough history to tell, check it as rarely as allowed
+        return max_interval
+
+    interval = median(gaps) / 2
+
+    # Backs off feeds that have been silent for longer than their usual cadence
+    if last_updated_at and last_checked_at:
+        interval = max(interval, (last_checked_at - last_updated_at) / 4)
+
+    return min(max(interval, min_interval), max_interval)
+
+
+def jitter(interval: timedelta, rand: Callable[[], float] = random.random) -> timedelta:
+    """
+    Returns a random interval between half of the given one and all of it, so that feeds
+    failing together don't retry together
+    """
+    return interval / 2 + interval / 2 * rand()
+
+
+def compute_backoff(failure_count: int, rand: Callable[[], float] = random.random) -> timedelta:
+    """
+    Computes how long to wait before checking a failing feed again: FEED_BACKOFF_MIN, doubled
+    with every failure in a row up to FEED_BACKOFF_MAX, with jitter.
+
+    :param failure_count: Number of failed checks in a row
+    :param rand: Random number generator, between 0 and 1
+    :return: timedelta
+    """
+    # Bounds the exponent, past which the maximum is reached anyway
+    interval = timedelta(seconds=settings.FEED_BACKOFF_MIN * 2 ** min(max(failure_count - 1, 0), 32))
+    return jitter(min(interval, timedelta(seconds=settings.FEED_BACKOFF_MAX)), rand)
+
+
+def compute_reprobe_interval(rand: Callable[[], float] = random.random) -> timedelta:
+    """
+    Computes how long to wait before probing a broken feed again, in case it came back:
+    FEED_BROKEN_REPROBE_INTERVAL, with jitter
+    """
+    return jitter(timedelta(seconds=settings.FEED_BROKEN_REPROBE_INTERVAL), rand)
+
+
+def compute_priority(bookmark_count: int, last_read_at: Optional[datetime], now: datetime) -> int:
+    """
+    Computes the crawl priority of a feed, from 0 to 3: a point for being bookmarked, one for
+    being bookmarked by at least FEED_POPULAR_BOOKMARKS users and one for having been read
+    within FEED_READ_WINDOW_SECONDS. Due feeds are claimed by priority, see
+    FeedManager.claim_by_lane.
+
+    :param bookmark_count: Number of users who bookmarked the feed
+    :param last_read_at: Last time the feed, or one of its entries, has been read
+    :param now: Reference date
+    :return: int
+    """
+    priority = 0
+
+    if bookmark_count:
+        priority += 1
+    if bookmark_count >= settings.FEED_POPULAR_BOOKMARKS:
+        priority += 1
+    if last_read_at and now - last_read_at <= timedelta(seconds=settings.FEED_READ_WINDOW_SECONDS):
+        priority += 1
+
+    return priority
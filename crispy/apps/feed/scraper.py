@@ -1,12 +1,16 @@
 from datetime import datetime, tzinfo
 from typing import Callable, Any, Optional, Iterable, Dict, Tuple, List
+from urllib.parse import urljoin
 
 import time
 
 from django.utils.timezone import make_aware
 
+from crispy.apps.feed import metrics
 from crispy.apps.feed.exceptions import BrokenFeed, TemporaryFeedError
 from crispy.apps.feed.models import Feed
+from crispy.apps.feed.records import EntryRecord, find_latest, normalize_entries
+from crispy.apps.feed.transport import Response, Transport
 
 import feedparser
 
@@ -14,7 +18,10 @@ import feedparser
 class Scraper(object):
     """
     This class scraps feeds.
-    Receives a callable parse_func (as in feedparser.parse) and a feed object
+    Receives a callable parse_func (as in feedparser.parse) and a feed object.
+
+    Given a transport (as in HttpTransport), the feed is downloaded by the transport and
+    parse_func only parses the downloaded document. Otherwise parse_func does both.
     """
 
     def __init__(self,
@@ -27,68 +34,136 @@ class Scraper(object):
                                        Optional[Dict],  # request headers
                                        Optional[Dict]],  # response headers
                                       feedparser.FeedParserDict],
-                 feed: Feed) -> None:
+                 feed: Feed,
+                 transport: Optional[Transport] = None) -> None:
         self.parse_func = parse_func
         self.feed = feed
+        self.transport = transport
+        self.status = None
+        self.error = None  # type: Optional[Exception]
+        self.entries = None  # type: Optional[List[EntryRecord]]
+
+    @property
+    def not_modified(self) -> bool:
+        """
+        Whether the server answered that the feed hasn't changed since our last check
+        """
+        return self.status == 304
+
+    def _store_validators(self, parsed_feed: feedparser.FeedParserDict) -> None:
+        """
+        Keeps the response's cache validators to send them back on the next request
+        :param parsed_feed: a parsed FeedParserDict
+        """
+        etag = parsed_feed.get('etag', None)
+        if etag and len(etag) <= Feed._meta.get_field('etag').max_length:
+            self.feed.etag = etag
+
+        last_modified = parsed_feed.get('modified', None)
+        if last_modified and len(last_modified) <= Feed._meta.get_field('last_modified').max_length:
+            self.feed.last_modified = last_modified
+
+    def fetch(self, force: bool) -> Response:
+        """
+        Downloads the feed with the transport. Set force to true to force updates.
+        :param force: Forces update
+        :return: a Response
+        """
+        if not force:
+            return self.transport.fetch(self.feed.feed_url, self.feed.etag, self.feed.last_modified)
+
+        return self.transport.fetch(self.feed.feed_url)
+
+    def parse_response(self, response: Response) -> feedparser.FeedParserDict:
+        """
+        Parses a downloaded feed. Only successful responses have content to parse.
+        :param response: a Response
+        :return: a parsed FeedParserDict
+        """
+        if response.status == 200:
+            # Relative links are resolved against the document's location, as when feedparser
+            # downloads it. The server may tell it, relative to the URL it was fetched from
+            headers = dict(response.headers)
+            headers['content-location'] = urljoin(response.url, headers.get('content-location', ''))
+            # Positional arguments, as in feedparser.parse, the last one being the response headers
+            parsed_feed = self.parse_func(response.body, None, None, None, None, None, None, headers)
+        else:
+            parsed_feed = feedparser.FeedParserDict()
+
+        parsed_feed['status'] = response.status
+        parsed_feed['href'] = response.url
+
+        if 'etag' in response.headers:
+            parsed_feed['etag'] = response.headers['etag']
+        if 'last-modified' in response.headers:
+            parsed_feed['modified'] = response.headers['last-modified']
+
+        return parsed_feed
 
     def parse(self, force: bool) -> feedparser.FeedParserDict:
         """
         Parses the feed. Set force to true to force updates.
+        Unless forced, the request is conditional on the E-Tag and Last-Modified headers of
+        the previous response, and a 304 response is returned as is, without any content.
         :param force: Forces update
         :return: a parsed FeedParserDict
         """
-        if not force:
+        if self.transport:
+            started_at = time.perf_counter()
+            response = self.fetch(force)
+            metrics.FETCH_SECONDS.observe(time.perf_counter() - started_at)
+            metrics.DOWNLOADED_BYTES.inc(len(response.body))
+
+            started_at = time.perf_counter()
+            parsed_feed = self.parse_response(response)
+            if response.body:
+                metrics.PARSE_SECONDS.observe(time.perf_counter() - started_at)
+        elif not force:
             parsed_feed = self.parse_func(self.feed.feed_url,
                                           self.feed.etag,
-                                          self.feed.last_updated_at)
+                                          self.feed.last_modified)
         else:
             parsed_feed = self.parse_func(self.feed.feed_url)
 
-        status = parsed_feed.status
+        self.status = status = parsed_feed.status
+        metrics.RESPONSES.inc(status=status)
         feed = parsed_feed.get('feed', None)
 
         # Checks if the feed is found (404) or if its gone (410)
         if status in (404, 410):
             raise BrokenFeed('Feed not found')
 
+        # Checks if the feed hasn't changed since the last request
+        if status == 304:
+            self._store_validators(parsed_feed)
+            return parsed_feed
+
         # Checks for valid statuses
-        if status in (200, 301, 302, 304):
+        if status in (200, 301, 302):
             # If feed is None the feed has been parsed but has invalid content
             if not feed or 'title' not in parsed_feed.feed:
                 raise TemporaryFeedError('Invalid feed content')
 
+            self._store_validators(parsed_feed)
             return parsed_feed
 
         raise TemporaryFeedError('Unrecognized status: {}'.format(status))
 
-    def _find_last_updated(self, entries: List[Dict]) -> datetime:
+    def _find_last_updated(self, entries: List[EntryRecord]) -> Optional[datetime]:
         """
-        Returns the last updated entry date given a list of Entries
-        :param entries: entries
+        Returns the last updated entry date given a list of entry records
+        :param entries: entry records
         :return: datetime
         """
-        latest = None
-        for entry in entries:
-            date = entry.get('updated_parsed',
-                             entry.get('published_parsed',
-                                       entry.get('created_parsed', None)))
-            if date:
-                date_obj = make_aware(datetime.fromtimestamp(time.mktime(date)))
-            else:
-                continue
-
-            if not latest or (date_obj and date_obj > latest):
-                latest = date_obj
-
-        return latest
+        return find_latest(entries)
 
-    def _has_updated(self, parsed_feed: feedparser.FeedParserDict, force: bool) -> bool:
+    def _has_updated(self, entries: List[EntryRecord], force: bool) -> bool:
         """
         Checks if the field has been updated since our last record
         :return: bool
         """
         # Get updated time
-        updated = self._find_last_updated(parsed_feed.entries)
+        updated = self._find_last_updated(entries)
 
         # Checks if the field hasn't been updated since our last record
         if not force and updated and self.feed.last_updated_at and updated <= self.feed.last_updated_at:
@@ -100,25 +175,36 @@ class Scraper(object):
         """
         Checks the feed for updates and returns a boolean indicating whether
         the feed has been updated or not and the list of entries.
+        Not modified (304) responses are reported as not updated, without entries.
+        Entries are also kept normalized, as EntryRecords, in `entries`.
+        Failures are recorded on the feed, and their error kept in `error`.
 
         :param force: force update
         :return: A list containing a "changed" boolean and a parsed FeedParserDict
         """
         try:
             parsed_feed = self.parse(force)
-            for e in parsed_feed.entries:
-                if hasattr(e, 'date') and e.date:
-                    e.date = make_aware(e.date)
+            self.feed.record_success()
+            if self.not_modified:
+                metrics.CHECKS.inc(outcome='not_modified')
+                return False, None
         except BrokenFeed as e:  # Checks if the feed is permanently broken
-            self.feed.broken = True
-            self.feed.error = e
+            metrics.CHECKS.inc(outcome='broken')
+            self.error = e
+            self.feed.record_failure(e, permanent=True)
             raise
         except TemporaryFeedError as e:  # Checks if a temporary error occurred
-            self.feed.error = e
+            metrics.CHECKS.inc(outcome='temporary_error')
+            self.error = e
+            self.feed.record_failure(e)
             return False, None  # Returns not updated in case of not-modified responses
         finally:
             # Always update last checked time
             self.feed.last_checked_at = make_aware(datetime.now())
 
-        return self._has_updated(parsed_feed, force), parsed_feed
+        # Normalizes entries once, for both update detection and ingestion
+        self.entries = normalize_entries(parsed_feed.entries)
+        updated = self._has_updated(self.entries, force)
+        metrics.CHECKS.inc(outcome='updated' if updated else 'unchanged')
+        return updated, parsed_feed
 
@@ -1,12 +1,33 @@
+import gzip
+import threading
 from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import skipUnless
+from unittest.mock import Mock, patch
+
 import feedparser
 import time
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import override_settings
+from django.utils import timezone
 from django.utils.timezone import make_aware
 
 from crispy.apps.core.tests import BaseTestCase
-from crispy.apps.feed.exceptions import BrokenFeed, TemporaryFeedError
-from crispy.apps.feed.models import Feed
+from crispy.apps.feed import constants, metrics
+from crispy.apps.feed.benchmark import BenchmarkServer, FeedCorpus, percentile, run_benchmark
+from crispy.apps.feed.cache import get_feed_version, get_recent_entries
+from crispy.apps.feed.crawler import Crawler
+from crispy.apps.feed.breaker import CircuitBreaker
+from crispy.apps.feed.exceptions import BrokenFeed, FetchError, FetchTimeout, InvalidEncoding, ResponseTooLarge, \
+    TemporaryFeedError
+from crispy.apps.feed.management.commands.update_feeds import Command as UpdateFeedsCommand
+from crispy.apps.feed.models import Feed, Entry, WorkerMetrics
+from crispy.apps.feed.records import EntryRecord, fingerprint, make_excerpt, normalize_entries
+from crispy.apps.feed.scheduling import compute_backoff, compute_check_interval, compute_priority, jitter
 from crispy.apps.feed.scraper import Scraper
+from crispy.apps.feed.transport import HttpTransport, Response, Transport, brotli
 
 
 def create_dynamic_parse_func(response):
@@ -15,8 +36,58 @@ def create_dynamic_parse_func(response):
     return test_parse_func
 
 
+def create_feed_response(title='Bola', entries=(), status=200):
+    response = feedparser.FeedParserDict()
+    response.status = status
+    response['version'] = 'rss20'
+    response['feed'] = feedparser.FeedParserDict()
+    response['feed']['title'] = title
+    response['entries'] = [feedparser.FeedParserDict(e) for e in entries]
+    return response
+
+
+RSS_DOCUMENT = b"""<?xml version="1.0"?>
+<rss version="2.0">
+    <channel>
+        <title>Bola</title>
+        <link>http://test.com</link>
+        <item>
+            <title>Entry</title>
+            <link>http://test.com/1</link>
+            <guid>1</guid>
+            <pubDate>Mon, 01 Feb 2021 10:00:00 GMT</pubDate>
+            <description>Content</description>
+        </item>
+    </channel>
+</rss>"""
+
+
+class FakeTransport(Transport):
+    def __init__(self, status=200, body=b'', headers=None):
+        super().__init__()
+        self.status = status
+        self.body = body
+        self.headers = headers or {}
+        self.requests = []
+
+    def fetch(self, url, etag=None, modified=None):
+        self.requests.append((url, etag, modified))
+        return Response(url, self.status, self.headers, self.body)
+
+
+class FailingTransport(Transport):
+    def __init__(self):
+        super().__init__()
+        self.requests = []
+
+    def fetch(self, url, etag=None, modified=None):
+        self.requests.append(url)
+        raise FetchError('Unable to fetch feed: Connection refused')
+
+
 class ScraperTestCase(BaseTestCase):
     def setUp(self):
+        super().setUp()
         self.feed = Feed(feed_url='')
 
     def test_parse_ensure_broken_feed_on_404(self):
@@ -44,6 +115,60 @@ class ScraperTestCase(BaseTestCase):
         scraper = Scraper(f, self.feed)
         self.assertEqual(response, scraper.parse(False))
 
+    def test_parse_sends_and_stores_cache_validators(self):
+        self.feed.etag = '"old"'
+        self.feed.last_modified = 'Mon, 01 Feb 2021 10:00:00 GMT'
+        requests = []
+        response = create_feed_response()
+        response['etag'] = '"new"'
+        response['modified'] = 'Tue, 02 Feb 2021 10:00:00 GMT'
+
+        def parse_func(url, etag=None, modified=None, *args):
+            requests.append((etag, modified))
+            return response
+
+        Scraper(parse_func, self.feed).parse(False)
+
+        self.assertEqual([('"old"', 'Mon, 01 Feb 2021 10:00:00 GMT')], requests)
+        self.assertEqual('"new"', self.feed.etag)
+        self.assertEqual('Tue, 02 Feb 2021 10:00:00 GMT', self.feed.last_modified)
+
+    def test_check_feed_not_modified(self):
+        response = feedparser.FeedParserDict()
+        response.status = 304
+        scraper = Scraper(create_dynamic_parse_func(response), self.feed)
+
+        self.assertEqual((False, None), scraper.check_feed())
+        self.assertTrue(scraper.not_modified)
+        self.assertIsNone(self.feed.error)
+
+    def test_parse_with_transport(self):
+        self.feed.etag = '"old"'
+        transport = FakeTransport(body=RSS_DOCUMENT, headers={'etag': '"new"'})
+        parsed_feed = Scraper(feedparser.parse, self.feed, transport).parse(False)
+
+        self.assertEqual([('', '"old"', None)], transport.requests)
+        self.assertEqual('Bola', parsed_feed.feed.title)
+        self.assertEqual(1, len(parsed_feed.entries))
+        self.assertEqual('"new"', self.feed.etag)
+
+    def test_parse_with_transport_resolves_relative_links(self):
+        self.feed.feed_url = 'http://test.com/blog/feed.xml'
+        body = RSS_DOCUMENT.replace(b'<link>http://test.com/1</link>', b'<link>/posts/1</link>') \
+            .replace(b'<description>Content</description>', b'<description>&lt;a href="2"&gt;2&lt;/a&gt;</description>')
+        parsed_feed = Scraper(feedparser.parse, self.feed, FakeTransport(body=body)).parse(False)
+
+        entry, = parsed_feed.entries
+        self.assertEqual('http://test.com/posts/1', entry.link)
+        self.assertIn('href="http://test.com/blog/2"', entry.summary)
+
+    def test_parse_with_transport_not_modified(self):
+        def parse_func(*args):
+            raise AssertionError('Not modified responses must not be parsed')
+
+        scraper = Scraper(parse_func, self.feed, FakeTransport(304))
+        self.assertEqual((False, None), scraper.check_feed())
+
     def test_find_last_updated(self):
         expected_time_raw = datetime.now() + timedelta(days=1)
         expected_time = make_aware(datetime.fromtimestamp(time.mktime(expected_time_raw.timetuple())))
@@ -54,7 +179,7 @@ class ScraperTestCase(BaseTestCase):
         ]
 
         scraper = Scraper(create_dynamic_parse_func(None), self.feed)
-        response = scraper._find_last_updated(entry_list)
+        response = scraper._find_last_updated(normalize_entries(entry_list))
         self.assertEqual(expected_time, response)
 
     def test_has_updated_future(self):
@@ -69,7 +194,7 @@ class ScraperTestCase(BaseTestCase):
 
         f = create_dynamic_parse_func(feed_dict)
         scraper = Scraper(f, self.feed)
-        self.assertTrue(scraper._has_updated(feed_dict, False))
+        self.assertTrue(scraper._has_updated(normalize_entries(feed_dict.entries), False))
 
     def test_has_updated_past(self):
         self.feed.last_updated_at = make_aware(datetime.now())
@@ -83,7 +208,840 @@ class ScraperTestCase(BaseTestCase):
 
         f = create_dynamic_parse_func(feed_dict)
         scraper = Scraper(f, self.feed)
-        self.assertFalse(scraper._has_updated(feed_dict, False))
+        self.assertFalse(scraper._has_updated(normalize_entries(feed_dict.entries), False))
+
+
+class CrawlerTestCase(BaseTestCase):
+    user = None
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='u', email='a@a.com', password='asd')
+
+    def test_run_stores_updated_feeds(self):
+        feeds = [Feed.objects.create(added_by=self.user, feed_url='http://test{}.com'.format(i), title='')
+                 for i in range(3)]
+        response = create_feed_response(entries=[
+            {'title': 'Entry', 'link': 'http://test.com/1', 'updated_parsed': datetime.now().timetuple()},
+        ])
+        with Crawler(create_dynamic_parse_func(response), FakeTransport(), concurrency=2,
+                     parse_processes=0) as crawler, \
+                self.assertLogs('crispy.apps.feed.crawler', 'INFO'):
+            self.assertEqual(3, crawler.run(Feed.objects.active()))
+            # The crawler can be reused across cycles
+            self.assertEqual(3, crawler.run(Feed.objects.active()))
+
+        for feed in feeds:
+            feed.refresh_from_db()
+            self.assertEqual('Bola', feed.title)
+            self.assertEqual(1, feed.entries.count())
+            self.assertIsNotNone(feed.next_check_at)
+            self.assertIsNone(feed.leased_until)
+
+    @override_settings(FEED_BROKEN_AFTER_FAILURES=2)
+    def test_run_marks_broken_feeds(self):
+        feed = Feed.objects.create(added_by=self.user, feed_url='http://test.com', title='title')
+        with Crawler(create_dynamic_parse_func(None), FakeTransport(404), parse_processes=0) as crawler, \
+                self.assertLogs('crispy.apps.feed.crawler', 'WARNING'):
+            self.assertEqual(1, crawler.run([feed]))
+            feed.refresh_from_db()
+            self.assertFalse(feed.broken)
+            self.assertEqual(1, feed.failure_count)
+
+            self.assertEqual(1, crawler.run([feed]))
+
+        feed.refresh_from_db()
+        self.assertTrue(feed.broken)
+        # Probed again later, in case it comes back
+        self.assertGreater(feed.next_check_at, timezone.now() + timedelta(seconds=settings.FEED_BROKEN_REPROBE_INTERVAL / 2 - 60))
+
+    def test_run_backs_off_failing_feeds(self):
+        feed = Feed.objects.create(added_by=self.user, feed_url='http://test.com', title='title')
+        with Crawler(create_dynamic_parse_func(None), FailingTransport(), parse_processes=0) as crawler, \
+                self.assertLogs('crispy.apps.feed.crawler', 'INFO'):
+            crawler.run([feed])
+            feed.refresh_from_db()
+            first_check = feed.next_check_at - feed.last_checked_at
+
+            crawler.run([feed])
+            feed.refresh_from_db()
+
+        self.assertEqual(2, feed.failure_count)
+        self.assertFalse(feed.broken)
+        self.assertIn('Unable to fetch feed', feed.error)
+        self.assertLessEqual(first_check, timedelta(seconds=settings.FEED_BACKOFF_MIN))
+        self.assertGreaterEqual(feed.next_check_at - feed.last_checked_at, timedelta(seconds=settings.FEED_BACKOFF_MIN))
+
+    def test_run_recovers_broken_feeds(self):
+        feed = Feed.objects.create(added_by=self.user, feed_url='http://test.com', title='title', broken=True,
+                                   failure_count=5, error='Not found')
+        with Crawler(create_dynamic_parse_func(create_feed_response()), FakeTransport(), parse_processes=0) as crawler, \
+                self.assertLogs('crispy.apps.feed.crawler', 'INFO'):
+            crawler.run([feed])
+
+        feed.refresh_from_db()
+        self.assertFalse(feed.broken)
+        self.assertEqual(0, feed.failure_count)
+        self.assertIsNone(feed.error)
+
+    @override_settings(CRAWLER_CIRCUIT_FAILURES=2)
+    def test_run_skips_failing_hosts(self):
+        feeds = [Feed.objects.create(added_by=self.user, feed_url='http://test.com/{}'.format(i), title=str(i))
+                 for i in range(4)]
+        other = Feed.objects.create(added_by=self.user, feed_url='http://other.com', title='other')
+        transport = FailingTransport()
+
+        with Crawler(create_dynamic_parse_func(None), transport, concurrency=1, parse_processes=0) as crawler, \
+                self.assertLogs('crispy.apps.feed.crawler', 'INFO'):
+            crawler.run(feeds)
+            crawler.run([other])
+
+        # The host's circuit opened after two failures, other hosts are still fetched
+        self.assertEqual(['http://test.com/0', 'http://test.com/1', 'http://other.com'], transport.requests)
+        for feed in feeds[2:]:
+            feed.refresh_from_db()
+            self.assertEqual(0, feed.failure_count)
+            self.assertIsNone(feed.leased_until)
+            self.assertGreater(feed.next_check_at, timezone.now() + timedelta(seconds=settings.CRAWLER_CIRCUIT_COOLDOWN - 60))
+
+    def test_run_skips_writes_when_not_modified(self):
+        feed = Feed.objects.create(added_by=self.user, feed_url='http://test.com', title='title')
+        feed.title = 'Unsaved title'
+
+        with Crawler(create_dynamic_parse_func(None), FakeTransport(304), parse_processes=0) as crawler, \
+                self.assertLogs('crispy.apps.feed.crawler', 'INFO'):
+            crawler.run([feed])
+
+        feed.refresh_from_db()
+        self.assertEqual('title', feed.title)
+        self.assertIsNotNone(feed.next_check_at)
+
+    def test_run_parses_in_processes(self):
+        feed = Feed.objects.create(added_by=self.user, feed_url='http://test.com', title='')
+
+        with Crawler(transport=FakeTransport(body=RSS_DOCUMENT), parse_processes=1) as crawler, \
+                self.assertLogs('crispy.apps.feed.crawler', 'INFO'):
+            crawler.run([feed])
+
+        feed.refresh_from_db()
+        self.assertEqual('Bola', feed.title)
+        self.assertEqual(['Entry'], [entry.title for entry in feed.entries.all()])
+
+    def test_run_completes_pending_feeds(self):
+        feed = Feed.objects.create(added_by=self.user, feed_url='http://test.com', title='',
+                                   state=constants.FEED_STATE_PENDING, requested_at=timezone.now())
+        version = get_feed_version(feed.pk)
+
+        with Crawler(transport=FakeTransport(body=RSS_DOCUMENT), parse_processes=0) as crawler, \
+                self.assertLogs('crispy.apps.feed.crawler', 'INFO'):
+            crawler.run(Feed.objects.claim('a', 10, timedelta(minutes=10), requested=True))
+
+        feed.refresh_from_db()
+        self.assertFalse(feed.pending)
+        self.assertIsNone(feed.requested_at)
+        self.assertEqual('Bola', feed.title)
+        self.assertNotEqual(version, get_feed_version(feed.pk))
+
+    def test_stopped_crawler_dispatches_nothing(self):
+        feed = Feed.objects.create(added_by=self.user, feed_url='http://test.com', title='title')
+
+        with Crawler(create_dynamic_parse_func(None), FakeTransport(), parse_processes=0) as crawler:
+            crawler.stop()
+            self.assertEqual(0, crawler.run([feed]))
+
+    # Inside the test's transaction, the connection would be closed as not in autocommit mode
+    @patch('crispy.apps.feed.management.commands.update_feeds.close_old_connections')
+    def test_update_feeds_single_cycle(self, close_old_connections):
+        with self.assertLogs('crispy.apps.feed.management.commands.update_feeds', 'INFO') as logs:
+            call_command('update_feeds', once=True, metrics_port=0)
+
+        self.assertIn('Checked 0 feeds', logs.output[0])
+        close_old_connections.assert_called_once_with()
+        # Publishes its metrics for the web processes
+        published = WorkerMetrics.objects.get()
+        self.assertEqual(UpdateFeedsCommand().worker_id, published.worker)
+        count = 'crispy_crawler_cycle_seconds_count{{worker="{}"}} {}'.format(published.worker,
+                                                                              float(metrics.CYCLE_SECONDS.count()))
+        self.assertIn(count, published.samples['crispy_crawler_cycle_seconds'])
+
+    @patch('crispy.apps.feed.management.commands.update_feeds.close_old_connections')
+    def test_update_feeds_releases_unchecked_feeds_on_stop(self, close_old_connections):
+        feeds = [Feed.objects.create(added_by=self.user, feed_url='http://test{}.com'.format(i), title=str(i))
+                 for i in range(3)]
+        Feed.objects.filter(pk=feeds[2].pk).update(leased_by='other', leased_until=timezone.now() + timedelta(minutes=10))
+        command = UpdateFeedsCommand()
+
+        def run(claimed):
+            # Stops before checking any of the claimed feeds
+            self.assertEqual(2, len(claimed))
+            command.stopping.set()
+            return 0
+
+        command.crawler = Mock(run=Mock(side_effect=run))
+        with self.assertLogs('crispy.apps.feed.management.commands.update_feeds', 'INFO') as logs:
+            command.run_cycle(10)
+
+        self.assertIn('Released 2 unchecked feeds', logs.output[0])
+        self.assertEqual([None, None, 'other'], [feed.leased_by for feed in Feed.objects.order_by('pk')])
+
+    @override_settings(CRAWLER_REQUEST_POLL_SECONDS=0.01)
+    def test_update_feeds_wakes_up_for_requested_feeds(self):
+        Feed.objects.create(added_by=self.user, feed_url='http://test.com', title='', requested_at=timezone.now())
+
+        started_at = time.monotonic()
+        UpdateFeedsCommand().wait(10)
+        self.assertLess(time.monotonic() - started_at, 5)
+
+
+@override_settings(FEED_CHECK_INTERVAL_MIN=60, FEED_CHECK_INTERVAL_MAX=24 * 60 * 60)
+class SchedulingTestCase(BaseTestCase):
+    user = None
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='u', email='a@a.com', password='asd')
+
+    def test_interval_follows_publishing_cadence(self):
+        now = timezone.now()
+        dates = [now - timedelta(hours=i) for i in range(10)]
+        self.assertEqual(timedelta(minutes=30), compute_check_interval(dates, dates[0], now))
+
+    def test_interval_backs_off_silent_feeds(self):
+        now = timezone.now()
+        dates = [now - timedelta(days=4, hours=i) for i in range(10)]
+        self.assertEqual(timedelta(days=1), compute_check_interval(dates, dates[0], now))
+
+    def test_interval_bounds(self):
+        now = timezone.now()
+        dates = [now - timedelta(seconds=i) for i in range(10)]
+        self.assertEqual(timedelta(minutes=1), compute_check_interval(dates, dates[0], now))
+        self.assertEqual(timedelta(days=1), compute_check_interval([], None, now))
+
+    def test_jitter(self):
+        self.assertEqual(timedelta(minutes=5), jitter(timedelta(minutes=10), lambda: 0))
+        self.assertEqual(timedelta(minutes=10), jitter(timedelta(minutes=10), lambda: 1))
+
+    @override_settings(FEED_BACKOFF_MIN=60, FEED_BACKOFF_MAX=600)
+    def test_backoff_doubles_up_to_maximum(self):
+        self.assertEqual([timedelta(seconds=s) for s in (60, 120, 240, 480, 600, 600)],
+                         [compute_backoff(count, lambda: 1) for count in (1, 2, 3, 4, 5, 1000)])
+
+    def test_circuit_breaker(self):
+        now = [0.0]
+        breaker = CircuitBreaker(2, 60, clock=lambda: now[0])
+
+        breaker.record_failure('a.com')
+        self.assertTrue(breaker.allow('a.com'))
+        breaker.record_failure('a.com')
+        self.assertFalse(breaker.allow('a.com'))
+        self.assertTrue(breaker.allow('b.com'))
+        self.assertEqual(60, breaker.retry_after('a.com'))
+
+        # A single probe once the cooldown is over, a failure opens the circuit again
+        now[0] = 60
+        self.assertTrue(breaker.allow('a.com'))
+        self.assertFalse(breaker.allow('a.com'))
+        breaker.record_failure('a.com')
+        self.assertFalse(breaker.allow('a.com'))
+
+        now[0] = 120
+        self.assertTrue(breaker.allow('a.com'))
+        breaker.record_success('a.com')
+        self.assertTrue(breaker.allow('a.com'))
+        self.assertTrue(breaker.allow('a.com'))
+
+    def test_due_feeds(self):
+        now = timezone.now()
+        never_checked = Feed.objects.create(added_by=self.user, feed_url='http://1.com', title='1')
+        overdue = Feed.objects.create(added_by=self.user, feed_url='http://2.com', title='2',
+                                      next_check_at=now - timedelta(minutes=1))
+        Feed.objects.create(added_by=self.user, feed_url='http://3.com', title='3',
+                            next_check_at=now + timedelta(minutes=1))
+        Feed.objects.create(added_by=self.user, feed_url='http://4.com', title='4', broken=True)
+
+        self.assertEqual([never_checked, overdue], list(Feed.objects.due(now)))
+
+    def test_claim_leases_due_feeds(self):
+        now = timezone.now()
+        lease = timedelta(minutes=10)
+        feeds = [Feed.objects.create(added_by=self.user, feed_url='http://{}.com'.format(i), title=str(i))
+                 for i in range(3)]
+
+        claimed = Feed.objects.claim('a', 2, lease, now)
+        self.assertEqual(2, len(claimed))
+        self.assertEqual(['a', 'a'], [feed.leased_by for feed in claimed])
+
+        # Leased feeds are skipped by other crawlers
+        self.assertEqual([feeds[2]], Feed.objects.claim('b', 2, lease, now))
+        self.assertEqual([], Feed.objects.claim('b', 2, lease, now))
+
+        # Expired leases are claimed again
+        self.assertEqual(3, len(Feed.objects.claim('b', 5, lease, now + lease)))
+
+    def test_claim_requested_feeds(self):
+        now = timezone.now()
+        lease = timedelta(minutes=10)
+        Feed.objects.create(added_by=self.user, feed_url='http://1.com', title='1')
+        later = Feed.objects.create(added_by=self.user, feed_url='http://2.com', title='2',
+                                    requested_at=now, next_check_at=now + lease)
+        sooner = Feed.objects.create(added_by=self.user, feed_url='http://3.com', title='3',
+                                     requested_at=now - timedelta(minutes=1), next_check_at=now + lease)
+
+        self.assertEqual([sooner, later], Feed.objects.claim('a', 5, lease, now, requested=True))
+        self.assertFalse(Feed.objects.requested().unleased(now).exists())
+
+    def test_request_check(self):
+        now = timezone.now()
+        window = timedelta(minutes=1)
+        feed = Feed.objects.create(added_by=self.user, feed_url='http://test.com', title='title')
+        Feed.objects.filter(pk=feed.pk).update(last_checked_at=now - window / 2)
+
+        # Checked within the window
+        self.assertFalse(Feed.objects.request_check(feed.pk, window, now))
+
+        later = now + window
+        self.assertTrue(Feed.objects.request_check(feed.pk, window, later))
+        # Already requested
+        self.assertFalse(Feed.objects.request_check(feed.pk, window, later))
+
+        # Being checked
+        Feed.objects.claim('a', 1, timedelta(minutes=10), later, requested=True)
+        Feed.objects.filter(pk=feed.pk).update(requested_at=None)
+        self.assertFalse(Feed.objects.request_check(feed.pk, window, later))
+
+    @override_settings(FEED_POPULAR_BOOKMARKS=10, FEED_READ_WINDOW_SECONDS=60 * 60)
+    def test_priority(self):
+        now = timezone.now()
+        self.assertEqual(0, compute_priority(0, None, now))
+        self.assertEqual(0, compute_priority(0, now - timedelta(hours=2), now))
+        self.assertEqual(1, compute_priority(0, now, now))
+        self.assertEqual(2, compute_priority(1, now, now))
+        self.assertEqual(3, compute_priority(10, now, now))
+
+    @override_settings(CRAWLER_PRIORITY_WEIGHTS={1: 3, 0: 1}, CRAWLER_STARVATION_SECONDS=60 * 60)
+    def test_claim_by_lane(self):
+        now = timezone.now()
+        lease = timedelta(minutes=10)
+
+        def create_feeds(name, count, **fields):
+            return [Feed.objects.create(added_by=self.user, feed_url='http://{}{}.com'.format(name, i), title=name,
+                                        **fields)
+                    for i in range(count)]
+
+        # Unpopular feeds are due first, and the starving ones are the most overdue
+        starving = create_feeds('starving', 1, next_check_at=now - timedelta(hours=2))
+        unpopular = create_feeds('unpopular', 4, next_check_at=now - timedelta(minutes=30))
+        popular = create_feeds('popular', 4, priority=1, next_check_at=now - timedelta(minutes=10))
+        requested = create_feeds('requested', 1, requested_at=now, next_check_at=now + lease)
+        broken = create_feeds('broken', 1, broken=True, next_check_at=now - timedelta(minutes=5))
+        create_feeds('resting', 1, broken=True, next_check_at=now + timedelta(days=1))
+
+        claimed = Feed.objects.claim_by_lane('a', 6, lease, now)
+        self.assertEqual(requested + starving + popular[:3] + unpopular[:1], claimed)
+
+        # Shares left unused go to the other due feeds, then to the broken feeds to probe again
+        claimed = Feed.objects.claim_by_lane('a', 6, lease, now)
+        self.assertEqual(popular[3:] + unpopular[1:] + broken, claimed)
+
+    def test_schedule_next_check(self):
+        feed = Feed.objects.create(added_by=self.user, feed_url='http://test.com', title='title')
+        feed.last_checked_at = timezone.now()
+        Entry.objects.bulk_create([Entry(feed=feed, date=feed.last_checked_at - timedelta(hours=2 * i))
+                                   for i in range(5)])
+        feed.last_updated_at = feed.last_checked_at
+        feed.schedule_next_check()
+
+        self.assertEqual(feed.last_checked_at + timedelta(hours=1), feed.next_check_at)
+
+
+class FeedEntriesTestCase(BaseTestCase):
+    user = None
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='u', email='a@a.com', password='asd')
+
+    def setUp(self):
+        super().setUp()
+        self.feed = Feed.objects.create(added_by=self.user, feed_url='http://test.com', title='title')
+
+    def _raw_entries(self, count, date=None, **extra):
+        date = date or datetime.now()
+        return [dict({'title': 'Entry {}'.format(i), 'link': 'http://test.com/{}'.format(i),
+                      'updated_parsed': (date - timedelta(minutes=i)).timetuple()}, **extra)
+                for i in range(count)]
+
+    def test_update_entries_creates_and_updates(self):
+        self.feed.update_feed_entries(self._raw_entries(3, datetime.now() - timedelta(days=1)))
+        self.assertEqual(3, self.feed.entries.count())
+
+        entries = self._raw_entries(4, content=[{'value': 'New content'}])
+        self.feed.update_feed_entries(entries)
+
+        self.assertEqual(4, self.feed.entries.count())
+        self.assertEqual(4, self.feed.entries.filter(content='New content').count())
+
+    def test_update_entries_skips_unchanged_entries(self):
+        entries = self._raw_entries(3)
+        self.feed.update_feed_entries(entries)
+
+        # Already ingested entries don't reach the database
+        with self.assertNumQueries(0):
+            self.feed.update_feed_entries(entries)
+
+    def test_update_entries_query_count_is_constant(self):
+        with self.assertNumQueries(5):
+            self.feed.update_feed_entries(self._raw_entries(10))
+
+        feed = Feed.objects.create(added_by=self.user, feed_url='http://other.com', title='title')
+        with self.assertNumQueries(5):
+            feed.update_feed_entries(self._raw_entries(90))
+
+    def test_update_entries_counts_entries(self):
+        self.feed.update_feed_entries(self._raw_entries(3, datetime.now() - timedelta(days=1)))
+        self.feed.update_feed_entries(self._raw_entries(4))
+        self.assertEqual(4, self.feed.entry_count)
+
+        # Saving a stale instance doesn't overwrite the counter
+        stale = Feed.objects.get(pk=self.feed.pk)
+        self.feed.update_feed_entries(self._raw_entries(1, title='New', link='http://test.com/new'))
+        stale.title = 'Stale'
+        stale.save()
+
+        self.feed.refresh_from_db()
+        self.assertEqual((5, 5), (self.feed.entry_count, self.feed.entries.count()))
+
+    def test_update_entries_only_builds_written_entries(self):
+        records = normalize_entries(self._raw_entries(3))
+        self.feed.update_feed_entries(records)
+
+        new_record = EntryRecord({'title': 'New', 'link': 'http://test.com/new'}, timezone.now())
+        with patch.object(Entry.objects, 'bulk_create', wraps=Entry.objects.bulk_create) as bulk_create:
+            self.feed.update_feed_entries(records + [new_record])
+
+        created, = bulk_create.call_args[0]
+        self.assertEqual(['New'], [entry.title for entry in created])
+
+    def test_update_entries_bumps_republished_entries(self):
+        self.feed.update_feed_entries(self._raw_entries(1, datetime.now() - timedelta(days=1)))
+        self.feed.update_feed_entries(self._raw_entries(1))
+
+        entry = self.feed.entries.get()
+        self.assertGreater(entry.date, timezone.now() - timedelta(hours=1))
+
+    def test_update_entries_skips_ingested_entries(self):
+        entries = self._raw_entries(100, datetime.now() - timedelta(hours=1))
+        self.feed.update_feed_entries(entries)
+        self.assertEqual(100, len(self.feed.seen_keys))
+
+        # Only the new entry is looked up and inserted
+        new_entry = self._raw_entries(1, title='New', link='http://test.com/new')
+        with self.assertNumQueries(5):
+            self.feed.update_feed_entries(new_entry + entries)
+
+        self.assertEqual(101, self.feed.entries.count())
+
+    def test_update_entries_updates_republished_ingested_entries(self):
+        entries = self._raw_entries(2, datetime.now() - timedelta(hours=1))
+        self.feed.update_feed_entries(entries)
+
+        # Same keys, but a new date
+        self.feed.update_feed_entries(self._raw_entries(2, content=[{'value': 'New content'}]))
+        self.assertEqual(2, self.feed.entries.filter(content='New content').count())
+
+    def test_update_entries_keeps_undated_entries_dates(self):
+        entries = [{'title': 'Entry {}'.format(i), 'link': 'http://test.com/{}'.format(i)} for i in range(2)]
+        self.feed.update_feed_entries(entries)
+        dates = list(self.feed.entries.order_by('pk').values_list('date', flat=True))
+
+        # Undated entries are dated with the check, unchanged ones aren't rewritten with a new date,
+        # which would reorder them and outdate the cache
+        version = get_feed_version(self.feed.pk)
+        self.feed.update_feed_entries(entries)
+        self.assertEqual(dates, list(self.feed.entries.order_by('pk').values_list('date', flat=True)))
+        self.assertEqual(version, get_feed_version(self.feed.pk))
+
+    @override_settings(FEED_SEEN_KEYS_SIZE=2)
+    def test_seen_keys_are_bounded(self):
+        self.feed.update_feed_entries(self._raw_entries(5))
+        self.assertEqual(2, len(self.feed.seen_keys))
+
+    @override_settings(FEED_RECENT_ENTRIES=2)
+    def test_recent_entries_are_cached_until_ingestion(self):
+        self.feed.update_feed_entries(self._raw_entries(3, datetime.now() - timedelta(hours=1)))
+        self.assertEqual(['Entry 0', 'Entry 1'], [entry['title'] for entry in get_recent_entries(self.feed.pk)])
+
+        with self.assertNumQueries(0):
+            get_recent_entries(self.feed.pk)
+
+        self.feed.update_feed_entries(self._raw_entries(1, title='New', link='http://test.com/new'))
+        self.assertEqual(['New', 'Entry 0'], [entry['title'] for entry in get_recent_entries(self.feed.pk)])
+
+    def test_update_entries_without_identifier(self):
+        self.feed.update_feed_entries([{'updated_parsed': datetime.now().timetuple()}])
+
+        self.assertIn('Entry error', self.feed.error)
+        self.assertEqual(0, self.feed.entries.count())
+
+
+class EntryRecordTestCase(BaseTestCase):
+    def test_normalization(self):
+        date = datetime(2021, 2, 1, 10, 30)
+        record = EntryRecord({'title': 'Entry', 'link': 'http://test.com/1', 'summary': 'Summary',
+                              'published_parsed': date.timetuple(), 'author': 'Author'}, timezone.now())
+
+        self.assertEqual(make_aware(date), record.date)
+        self.assertTrue(record.dated)
+        self.assertEqual(('guid', 'http://test.com/1'), record.key)
+        self.assertEqual(('Entry', 'Summary', 'Author'), (record.title, record.content, record.author))
+        self.assertEqual(fingerprint(Entry(**record.values())), record.fingerprint)
+
+    def test_undated_entries(self):
+        now = timezone.now()
+        record, = normalize_entries([{'title': 'Entry', 'content': [{'value': 'Content'}]}], now)
+
+        self.assertEqual((now, False), (record.date, record.dated))
+        self.assertEqual(('title', 'Entry', now), record.key)
+        self.assertEqual('Content', record.content)
+
+    def test_fingerprint_covers_content(self):
+        first, second = normalize_entries([{'link': 'http://test.com/1', 'summary': 'a'},
+                                           {'link': 'http://test.com/1', 'summary': 'b'}])
+
+        self.assertEqual(first.key, second.key)
+        self.assertNotEqual(first.fingerprint, second.fingerprint)
+
+    def test_excerpt(self):
+        self.assertEqual('Hello & welcome', make_excerpt('<p>Hello &amp; <b>welcome</b></p><script>x()</script>'))
+        self.assertEqual('Plain text', make_excerpt('  Plain\n text '))
+
+        excerpt = make_excerpt('<p>{}</p>'.format('word ' * 100), length=50)
+        self.assertLessEqual(len(excerpt), 50)
+        self.assertTrue(excerpt.endswith('word\u2026'))
+
+    def test_excerpt_is_stored(self):
+        user = User.objects.create(username='u')
+        feed = Feed.objects.create(added_by=user, feed_url='http://test.com', title='title')
+        feed.update_feed_entries([{'link': 'http://test.com/1', 'summary': '<p>Summary</p>'}])
+
+        self.assertEqual('Summary', feed.entries.get().excerpt)
+
+    def test_records_are_passed_through(self):
+        records = normalize_entries([{'link': 'http://test.com/1'}])
+        self.assertIs(records[0], normalize_entries(records)[0])
+
+
+class QueryPlanTestCase(BaseTestCase):
+    feeds = None
+
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create(username='u', email='a@a.com', password='asd')
+        Feed.objects.bulk_create([
+            Feed(added_by=user, feed_url='http://test{}.com'.format(i), title='Feed {}'.format(i),
+                 broken=i % 10 == 0, next_check_at=timezone.now() + timedelta(minutes=i - 50))
+            for i in range(100)
+        ])
+        cls.feeds = list(Feed.objects.order_by('pk'))
+        now = timezone.now()
+        Entry.objects.bulk_create([
+            Entry(feed=feed, title='Entry {}'.format(i), url='http://test.com/{}/{}'.format(feed.pk, i),
+                  guid='{}-{}'.format(feed.pk, i), date=now - timedelta(hours=i))
+            for feed in cls.feeds for i in range(50)
+        ])
+
+    def test_feed_entries(self):
+        self.assertNoSequentialScan(Entry.objects.filter(feed=self.feeds[1])[:12])
+
+    def test_recent_entries(self):
+        self.assertNoSequentialScan(Entry.objects.recent(self.feeds[1].pk, 10))
+
+    def test_existing_entries_lookup(self):
+        records = normalize_entries([{'link': 'http://test.com/1'}, {'title': 'Entry 1'},
+                                     {'guid': '1-1', 'link': 'http://test.com/2'}])
+        self.assertNoSequentialScan(self.feeds[1]._existing_entries(records))
+
+    def test_due_feeds(self):
+        self.assertNoSequentialScan(Feed.objects.due()[:500])
+
+    def test_due_feeds_by_priority(self):
+        plan = self.assertNoSequentialScan(Feed.objects.due().filter(priority=1)[:500])
+        self.assertIn('feed_lane_idx', plan)
+
+    def test_requested_feeds(self):
+        plan = self.assertNoSequentialScan(Feed.objects.requested().unleased()[:500])
+        self.assertIn('feed_requested_idx', plan)
+
+    def test_reprobe_due_feeds(self):
+        plan = self.assertNoSequentialScan(Feed.objects.reprobe_due()[:500])
+        self.assertIn('feed_reprobe_idx', plan)
+
+    def test_feed_list(self):
+        self.assertNoSequentialScan(Feed.objects.all()[:10])
+
+
+class FeedRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.client_address[1], dict(self.headers)))
+
+        if self.path == '/redirect':
+            self.send_response(301)
+            self.send_header('Location', '/feed')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif self.path == '/slow':
+            # Trickles its body, a byte at a time
+            self.send_response(200)
+            self.send_header('Content-Length', '20')
+            self.end_headers()
+            try:
+                for _ in range(20):
+                    self.wfile.write(b' ')
+                    self.wfile.flush()
+                    time.sleep(.1)
+            except OSError:
+                pass
+        elif self.path == '/corrupt':
+            body = b'Not gzipped'
+            self.send_response(200)
+            self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path in ('/large', '/bomb', '/brotli-bomb'):
+            body = b' ' * 10000
+            self.send_response(200)
+            if self.path == '/bomb':
+                body = gzip.compress(body)
+                self.send_header('Content-Encoding', 'gzip')
+            elif self.path == '/brotli-bomb':
+                body = brotli.compress(body * 200)
+                self.send_header('Content-Encoding', 'br')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.headers.get('If-None-Match') == '"1"':
+            self.send_response(304)
+            self.end_headers()
+        else:
+            body = gzip.compress(RSS_DOCUMENT)
+            self.send_response(200)
+            self.send_header('ETag', '"1"')
+            self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+
+class HttpTransportTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FeedRequestHandler)
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self.transport = HttpTransport(1, 1, 2)
+
+    def tearDown(self):
+        self.transport.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_fetch_decompresses_and_reuses_connections(self):
+        first = self.transport.fetch(self.url + '/feed')
+        second = self.transport.fetch(self.url + '/feed', etag='"1"')
+
+        self.assertEqual((200, RSS_DOCUMENT, '"1"'), (first.status, first.body, first.headers['etag']))
+        self.assertEqual((304, b''), (second.status, second.body))
+        self.assertIn('gzip', self.server.requests[0][2]['Accept-Encoding'])
+        # Both requests went through the same connection
+        self.assertEqual(self.server.requests[0][1], self.server.requests[1][1])
+
+    def test_fetch_follows_redirects(self):
+        response = self.transport.fetch(self.url + '/redirect')
+
+        self.assertEqual(200, response.status)
+        self.assertEqual(self.url + '/feed', response.url)
+
+    def test_fetch_network_error(self):
+        with self.assertRaises(FetchError):
+            self.transport.fetch('http://127.0.0.1:1/feed')
+
+    @override_settings(CRAWLER_CIRCUIT_FAILURES=1)
+    def test_fetch_invalid_encoding(self):
+        with self.assertRaises(InvalidEncoding):
+            self.transport.fetch(self.url + '/corrupt')
+
+        # The host answered, its circuit stays closed
+        feed = Feed.objects.create(added_by=User.objects.create(username='u'), feed_url=self.url + '/corrupt', title='')
+        with Crawler(feedparser.parse, self.transport, parse_processes=0) as crawler, \
+                self.assertLogs('crispy.apps.feed.crawler', 'INFO'):
+            crawler.run([feed])
+            crawler.run([feed])
+        self.assertEqual(3, len(self.server.requests))
+        self.assertTrue(crawler.breaker.allow('127.0.0.1'))
+
+    def test_fetch_deadline(self):
+        transport = HttpTransport(1, 1, 2, total_timeout=.5)
+        started_at = time.monotonic()
+        try:
+            with self.assertRaises(FetchTimeout):
+                transport.fetch(self.url + '/slow')
+        finally:
+            watchdog = transport._deadlines._thread
+            transport.close()
+
+        # Each byte came in time, the whole body didn't
+        self.assertLess(time.monotonic() - started_at, 1.5)
+        # Closing the transport stops the watchdog
+        self.assertFalse(watchdog.is_alive())
+
+    def test_fetch_max_body_size(self):
+        transport = HttpTransport(1, 1, 2, max_body_size=5000)
+        try:
+            self.assertEqual(RSS_DOCUMENT, transport.fetch(self.url + '/feed').body)
+            with self.assertRaises(ResponseTooLarge):
+                transport.fetch(self.url + '/large')
+            # Small once compressed, too large once decompressed
+            with self.assertRaises(ResponseTooLarge):
+                transport.fetch(self.url + '/bomb')
+            # Oversized responses don't leave their connection in the pool
+            self.assertEqual(RSS_DOCUMENT, transport.fetch(self.url + '/feed').body)
+        finally:
+            transport.close()
+
+    @skipUnless(brotli, 'brotli is not installed')
+    def test_fetch_max_body_size_brotli(self):
+        transport = HttpTransport(1, 1, 2, max_body_size=100000)
+        try:
+            # Decompression stops as soon as the output exceeds the maximum size
+            with patch.object(transport, '_check_size', wraps=transport._check_size) as check_size:
+                with self.assertRaises(ResponseTooLarge):
+                    transport.fetch(self.url + '/brotli-bomb')
+            self.assertLess(max(call[0][0] for call in check_size.call_args_list), 1000000)
+        finally:
+            transport.close()
+
+
+class BenchmarkTestCase(BaseTestCase):
+    def test_corpus(self):
+        corpus = FeedCorpus(2, 3, entry_size=100)
+        rss, atom = [feedparser.parse(corpus.get(index)[1]) for index in range(2)]
+
+        self.assertEqual(('rss20', 3), (rss.version, len(rss.entries)))
+        self.assertEqual(('atom10', 3), (atom.version, len(atom.entries)))
+
+        etag = corpus.get(0)[0]
+        self.assertEqual([0], corpus.change(0.5, seed=1))
+        self.assertNotEqual(etag, corpus.get(0)[0])
+        self.assertEqual('Entry 3 of feed 0', feedparser.parse(corpus.get(0)[1]).entries[0].title)
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(50, percentile(values, 50))
+        self.assertEqual(99, percentile(values, 99))
+        self.assertEqual(0.0, percentile([], 50))
+
+    def test_run_benchmark(self):
+        server = BenchmarkServer(FeedCorpus(4, 3, entry_size=100))
+        server.start()
+
+        try:
+            with self.assertLogs('crispy.apps.feed.crawler', 'INFO'):
+                first, second = run_benchmark(server, cycles=2, change_rate=0.5, parse_processes=0)
+        finally:
+            server.stop()
+
+        self.assertEqual((4, 4), (first['feeds'], first['updated']))
+        self.assertEqual((2, 2), (second['updated'], second['not_modified']))
+        self.assertEqual(12, Entry.objects.count() - 2)
+        self.assertGreater(first['peak_rss_kb'], 0)
+
+    def test_run_benchmark_is_bound_by_concurrency(self):
+        server = BenchmarkServer(FeedCorpus(8, 1, entry_size=100), latency=.2)
+        server.start()
+
+        try:
+            with self.assertLogs('crispy.apps.feed.crawler', 'INFO'):
+                run_benchmark(server, cycles=1, concurrency=8, parse_processes=0)
+        finally:
+            server.stop()
+
+        # Feeds share a host, yet aren't bound by the per-host limit
+        self.assertGreater(server.peak_requests, settings.CRAWLER_MAX_CONNECTIONS_PER_HOST)
+
+
+class MetricsTestCase(BaseTestCase):
+    def test_counter(self):
+        counter = metrics.Counter('test_total', 'Test counter', ['status'])
+        counter.inc(status=200)
+        counter.inc(2, status=200)
+        counter.inc(status=304)
+
+        self.assertEqual(3, counter.value(status=200))
+        self.assertEqual('# HELP test_total Test counter\n# TYPE test_total counter\n'
+                         'test_total{status="200"} 3.0\ntest_total{status="304"} 1.0', counter.render())
+
+    def test_histogram(self):
+        histogram = metrics.Histogram('test_seconds', 'Test histogram', buckets=(1, 5))
+        histogram.observe(0.5)
+        histogram.observe(3)
+
+        self.assertEqual(2, histogram.count())
+        self.assertEqual(['test_seconds_bucket{le="1.0"} 1.0', 'test_seconds_bucket{le="5.0"} 2.0',
+                          'test_seconds_bucket{le="+Inf"} 2.0', 'test_seconds_sum 3.5', 'test_seconds_count 2.0'],
+                         histogram.samples())
+
+    def test_render_collected(self):
+        registry = metrics.Registry()
+        counter = registry.register(metrics.Counter('test_total', 'Test counter', ['status']))
+        histogram = registry.register(metrics.Histogram('test_seconds', 'Test histogram', buckets=(1, )))
+        counter.inc(status=200)
+        histogram.observe(0.5)
+        first = registry.collect(worker='a')
+        counter.inc(status=200)
+        second = registry.collect(worker='b')
+
+        self.assertEqual(['test_seconds_bucket{worker="a",le="1.0"} 1.0', 'test_seconds_bucket{worker="a",le="+Inf"} 1.0',
+                          'test_seconds_sum{worker="a"} 0.5', 'test_seconds_count{worker="a"} 1.0'],
+                         first['test_seconds'])
+        self.assertEqual('# HELP test_total Test counter\n# TYPE test_total counter\n'
+                         'test_total{worker="a",status="200"} 1.0\ntest_total{worker="b",status="200"} 2.0\n'
+                         '# HELP test_seconds Test histogram\n# TYPE test_seconds histogram\n'
+                         + '\n'.join(first['test_seconds'] + second['test_seconds']) + '\n',
+                         registry.render([first, second]))
+
+    def test_worker_metrics(self):
+        now = timezone.now()
+        max_age = timedelta(minutes=10)
+        WorkerMetrics.objects.publish('gone', {}, max_age, now=now - timedelta(minutes=15))
+        WorkerMetrics.objects.publish('late', {}, max_age, now=now - timedelta(minutes=5))
+        self.assertEqual(2, WorkerMetrics.objects.count())
+        self.assertEqual(['late'], [worker.worker for worker in WorkerMetrics.objects.live(max_age, now=now)])
+
+        # Replaces the crawler's previous metrics, and drops those of crawlers gone for too long
+        WorkerMetrics.objects.publish('late', {'test_total': ['test_total 1.0']}, max_age, now=now)
+        self.assertEqual({'late': {'test_total': ['test_total 1.0']}},
+                         {worker.worker: worker.samples for worker in WorkerMetrics.objects.all()})
 
+    def test_crawl_metrics(self):
+        checks = metrics.CHECKS.value(outcome='updated')
+        inserted = metrics.ENTRIES.value(operation='inserted')
+        fetches = metrics.FETCH_SECONDS.count()
 
+        user = User.objects.create(username='metrics')
+        feed = Feed.objects.create(added_by=user, feed_url='http://test.com/feed', title='')
+        with Crawler(feedparser.parse, FakeTransport(body=RSS_DOCUMENT), parse_processes=0) as crawler:
+            with self.assertLogs('crispy.apps.feed.crawler', 'INFO'):
+                crawler.run([feed])
 
+        self.assertEqual(checks + 1, metrics.CHECKS.value(outcome='updated'))
+        self.assertEqual(inserted + Entry.objects.filter(feed=feed).count(),
+                         metrics.ENTRIES.value(operation='inserted'))
+        self.assertEqual(fetches + 1, metrics.FETCH_SECONDS.count())
+        self.assertIn('crispy_feed_checks_total{outcome="updated"}', metrics.REGISTRY.render())
@@ -0,0 +1,426 @@
+import abc
+import heapq
+import http.client
+import itertools
+import socket
+import ssl
+import threading
+import time
+import zlib
+from collections import defaultdict
+from typing import Dict, NamedTuple, Optional, Tuple
+from urllib.parse import urljoin, urlsplit
+
+import feedparser
+
+from crispy.apps.feed.exceptions import FetchError, FetchTimeout, InvalidEncoding, ResponseTooLarge, \
+    TemporaryFeedError
+
+try:
+    import brotli
+    # Older versions can't bound their output, see HttpTransport._decompress_brotli
+    if not hasattr(brotli.Decompressor, 'can_accept_more_data'):
+        brotli = None
+except ImportError:
+    brotli = None
+
+
+class Response(NamedTuple):
+    """
+    A downloaded feed document
+    """
+    url: str
+    status: int
+    headers: Dict[str, str]
+    body: bytes
+
+
+class Transport(abc.ABC):
+    """
+    Downloads feeds without parsing them.
+    Error statuses are returned as responses, network errors raise FetchError.
+    """
+
+    def __init__(self, agent: str = feedparser.USER_AGENT) -> None:
+        self.agent = agent
+
+    def _build_headers(self, etag: Optional[str], modified: Optional[str]) -> Dict[str, str]:
+        headers = {
+            'User-Agent': self.agent,
+            'Accept': feedparser.http.ACCEPT_HEADER,
+        }
+
+        if etag:
+            headers['If-None-Match'] = etag
+        if modified:
+            headers['If-Modified-Since'] = modified
+
+        return headers
+
+    @abc.abstractmethod
+    def fetch(self, url: str, etag: Optional[str] = None, modified: Optional[str] = None) -> Response:
+        """
+        Downloads a feed, conditionally on the given cache validators
+        :param url: Feed URL
+        :param etag: E-Tag of the previous response
+        :param modified: Last-Modified header of the previous response
+        :return: A Response
+        """
+
+    def close(self) -> None:
+        """
+        Releases any resource held by the transport
+        """
+
+
+HostKey = Tuple[str, str, int]
+
+
+class Deadlines(object):
+    """
+    Shuts down the sockets of connections still in use past their deadline, from a background
+    thread, so that a blocked read returns however the server trickles its response.
+    Socket timeouts alone only bound each read.
+    """
+
+    def __init__(self) -> None:
+        self._condition = threading.Condition()
+        self._heap = []  # (deadline, id, connection) of the watched connections, by deadline
+        self._watched = {}  # type: Dict[int, http.client.HTTPConnection]
+        self._ids = itertools.count()
+        self._thread = None  # type: Optional[threading.Thread]
+        self._stopped = None  # type: Optional[threading.Event]
+
+    def watch(self, connection: http.client.HTTPConnection, deadline: float) -> int:
+        """
+        Shuts down the connection's socket at the deadline, unless unwatched before
+        :return: An id to unwatch the connection with
+        """
+        with self._condition:
+            watch_id = next(self._ids)
+            self._watched[watch_id] = connection
+            heapq.heappush(self._heap, (deadline, watch_id, connection))
+            if self._thread is None:
+                self._stopped = threading.Event()
+                self._thread = threading.Thread(target=self._run, args=(self._stopped, ), name='fetch-deadlines',
+                                                daemon=True)
+                self._thread.start()
+            self._condition.notify()
+            return watch_id
+
+    def unwatch(self, watch_id: int) -> None:
+        with self._condition:
+            self._watched.pop(watch_id, None)
+
+    def stop(self) -> None:
+        """
+        Stops watching, and the background thread. Watching again starts a new one.
+        """
+        with self._condition:
+            thread, self._thread = self._thread, None
+            if thread is None:
+                return
+            self._stopped.set()
+            self._heap.clear()
+            self._watched.clear()
+            self._condition.notify()
+
+        thread.join()
+
+    def _run(self, stopped: threading.Event) -> None:
+        with self._condition:
+            while not stopped.is_set():
+                # Drops the connections unwatched in the meantime
+                while self._heap and self._heap[0][1] not in self._watched:
+                    heapq.heappop(self._heap)
+
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+
+                deadline, watch_id, connection = self._heap[0]
+                remaining = deadline - time.monotonic()
+                if remaining > 0:
+                    self._condition.wait(remaining)
+                    continue
+
+                heapq.heappop(self._heap)
+                del self._watched[watch_id]
+                sock = connection.sock
+                if sock is not None:
+                    try:
+                        sock.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+
+
+class HttpTransport(Transport):
+    """
+    HTTP transport keeping connections alive and pooled per host.
+
+    At most `max_connections_per_host` requests run against a host at once, waiting up to
+    `connect_timeout` for a free slot. Responses are requested compressed (gzip, deflate, and
+    brotli when the brotli package is installed) and redirects are followed.
+
+    A fetch, redirects included, ends with FetchTimeout once `total_timeout` is over, however
+    slowly the server trickles its response. Bodies are read in chunks and a fetch ends with
+    ResponseTooLarge as soon as its body, compressed or not, exceeds `max_body_size` bytes.
+    """
+    REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+    MAX_REDIRECTS = 5
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, connect_timeout: float, read_timeout: float, max_connections_per_host: int,
+                 total_timeout: Optional[float] = None, max_body_size: Optional[int] = None,
+                 agent: str = feedparser.USER_AGENT) -> None:
+        super().__init__(agent)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_connections_per_host = max_connections_per_host
+        self.total_timeout = total_timeout
+        self.max_body_size = max_body_size
+        self._deadlines = Deadlines()
+        self._ssl_context = ssl.create_default_context()
+        self._lock = threading.Lock()
+        self._idle = defaultdict(list)  # type: Dict[HostKey, list]
+        self._slots = {}  # type: Dict[HostKey, threading.BoundedSemaphore]
+
+    @staticmethod
+    def host_key(url: str) -> HostKey:
+        """
+        Returns the (scheme, host, port) connections to the given URL are pooled by
+        """
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise TemporaryFeedError('Unsupported URL: {}'.format(url))
+
+        return parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80)
+
+    def _build_headers(self, etag: Optional[str], modified: Optional[str]) -> Dict[str, str]:
+        headers = super()._build_headers(etag, modified)
+        headers['Accept-Encoding'] = 'gzip, deflate, br' if brotli else 'gzip, deflate'
+        return headers
+
+    def _host_slot(self, key: HostKey) -> threading.BoundedSemaphore:
+        with self._lock:
+            if key not in self._slots:
+                self._slots[key] = threading.BoundedSemaphore(self.max_connections_per_host)
+            return self._slots[key]
+
+    def _remaining(self, timeout: float, deadline: Optional[float]) -> float:
+        """
+        Returns the given timeout, shortened to what's left before the deadline
+        :raise FetchTimeout: once the deadline is over
+        """
+        if deadline is None:
+            return timeout
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise FetchTimeout('Fetch took longer than {}s'.format(self.total_timeout))
+        return min(timeout, remaining)
+
+    def _check_deadline(self, deadline: Optional[float]) -> None:
+        """
+        :raise FetchTimeout: once the deadline is over
+        """
+        self._remaining(0, deadline)
+
+    def _get_connection(self, key: HostKey,
+                        deadline: Optional[float]) -> Tuple[http.client.HTTPConnection, bool]:
+        """
+        Returns an idle connection to the host if there's one, or a new one
+        :return: The connection and whether it has been reused
+        """
+        with self._lock:
+            if self._idle[key]:
+                return self._idle[key].pop(), True
+
+        scheme, host, port = key
+        timeout = self._remaining(self.connect_timeout, deadline)
+        if scheme == 'https':
+            connection = http.client.HTTPSConnection(host, port, timeout=timeout, context=self._ssl_context)
+        else:
+            connection = http.client.HTTPConnection(host, port, timeout=timeout)
+
+        connection.connect()
+        return connection, False
+
+    def _release_connection(self, key: HostKey, connection: http.client.HTTPConnection,
+                            response: http.client.HTTPResponse) -> None:
+        if response.will_close:
+            connection.close()
+            return
+
+        with self._lock:
+            if len(self._idle[key]) < self.max_connections_per_host:
+                self._idle[key].append(connection)
+                return
+
+        connection.close()
+
+    def _check_size(self, size: int) -> None:
+        if self.max_body_size is not None and size > self.max_body_size:
+            raise ResponseTooLarge('Feed larger than {} bytes'.format(self.max_body_size))
+
+    def _decompress(self, body: bytes, wbits: int) -> bytes:
+        # Bounds the output, a small compressed body can expand to gigabytes
+        decompressor = zlib.decompressobj(wbits)
+        if self.max_body_size is None:
+            return decompressor.decompress(body) + decompressor.flush()
+
+        decoded = decompressor.decompress(body, self.max_body_size + 1)
+        self._check_size(len(decoded) + len(decompressor.unconsumed_tail))
+        return decoded + decompressor.flush()
+
+    def _decode(self, body: bytes, encoding: str) -> bytes:
+        encoding = encoding.strip().lower()
+
+        if encoding in ('gzip', 'x-gzip'):
+            return self._decompress(body, 16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            try:
+                return self._decompress(body, zlib.MAX_WBITS)
+            except zlib.error:
+                # Some servers send raw deflate streams, without zlib headers
+                return self._decompress(body, -zlib.MAX_WBITS)
+        elif encoding == 'br' and brotli:
+            try:
+                return self._decompress_brotli(body)
+            except brotli.error as e:
+                raise ValueError('Invalid brotli stream: {}'.format(e))
+
+        return body
+
+    def _decompress_brotli(self, body: bytes) -> bytes:
+        if self.max_body_size is None:
+            return brotli.decompress(body)
+
+        # Output is produced a bounded buffer at a time, and checked as it grows
+        decompressor = brotli.Decompressor()
+        chunks = []
+        size = 0
+        chunk = decompressor.process(body, output_buffer_limit=self.max_body_size + 1)
+        while True:
+            size += len(chunk)
+            self._check_size(size)
+            chunks.append(chunk)
+            if decompressor.is_finished():
+                return b''.join(chunks)
+            if decompressor.can_accept_more_data():
+                raise ValueError('Truncated brotli stream')
+            chunk = decompressor.process(b'', output_buffer_limit=self.max_body_size + 1 - size)
+
+    def _read_body(self, connection: http.client.HTTPConnection, response: http.client.HTTPResponse,
+                   deadline: Optional[float]) -> bytes:
+        """
+        Reads a response body chunk by chunk, within the deadline and the maximum body size
+        """
+        if response.length is not None:
+            # Too large bodies are rejected without reading them
+            self._check_size(response.length)
+
+        chunks = []
+        size = 0
+        while True:
+            connection.sock.settimeout(self._remaining(self.read_timeout, deadline))
+            chunk = response.read(self.CHUNK_SIZE)
+            if not chunk:
+                body = b''.join(chunks)
+                if response.length:
+                    # Cut short, e.g. by the deadline
+                    self._check_deadline(deadline)
+                    raise http.client.IncompleteRead(body, response.length)
+                return body
+
+            size += len(chunk)
+            self._check_size(size)
+            chunks.append(chunk)
+
+    def _send(self, key: HostKey, path: str, headers: Dict[str, str],
+              deadline: Optional[float]) -> Tuple[http.client.HTTPResponse, bytes]:
+        connection, reused = self._get_connection(key, deadline)
+        watch_id = self._deadlines.watch(connection, deadline) if deadline is not None else None
+
+        try:
+            connection.sock.settimeout(self._remaining(self.read_timeout, deadline))
+            connection.request('GET', path, headers=headers)
+            response = connection.getresponse()
+            body = self._read_body(connection, response, deadline)
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            connection.close()
+            self._check_deadline(deadline)
+            if not reused:
+                raise
+            # The server closed the idle connection, retry on another one
+            return self._send(key, path, headers, deadline)
+        except (http.client.HTTPException, OSError):
+            connection.close()
+            # Reading from a socket shut down by the deadline fails in various ways
+            self._check_deadline(deadline)
+            raise
+        except BaseException:
+            connection.close()
+            raise
+        finally:
+            if watch_id is not None:
+                self._deadlines.unwatch(watch_id)
+
+        self._release_connection(key, connection, response)
+        return response, body
+
+    def _request(self, url: str, headers: Dict[str, str], deadline: Optional[float]) -> Response:
+        key = self.host_key(url)
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        slot = self._host_slot(key)
+        if not slot.acquire(timeout=self._remaining(self.connect_timeout, deadline)):
+            raise TemporaryFeedError('Too many concurrent requests to {}'.format(key[1]))
+
+        try:
+            response, body = self._send(key, path, headers, deadline)
+        finally:
+            slot.release()
+
+        response_headers = {}
+        for name, value in response.getheaders():
+            name = name.lower()
+            response_headers[name] = '{}, {}'.format(response_headers[name], value) \
+                if name in response_headers else value
+
+        try:
+            body = self._decode(body, response_headers.get('content-encoding', ''))
+        except (ValueError, zlib.error) as e:
+            # The host answered, this doesn't count against it as a FetchError would
+            raise InvalidEncoding('Unable to decode feed: {}'.format(e))
+        return Response(url, response.status, response_headers, body)
+
+    def fetch(self, url: str, etag: Optional[str] = None, modified: Optional[str] = None) -> Response:
+        headers = self._build_headers(etag, modified)
+        deadline = time.monotonic() + self.total_timeout if self.total_timeout is not None else None
+
+        try:
+            for _ in range(self.MAX_REDIRECTS + 1):
+                response = self._request(url, headers, deadline)
+                if response.status not in self.REDIRECT_STATUSES or 'location' not in response.headers:
+                    return response
+                url = urljoin(url, response.headers['location'])
+        except socket.timeout as e:
+            raise FetchTimeout('Timed out fetching feed: {}'.format(e))
+        except (http.client.HTTPException, OSError, ValueError) as e:
+            raise FetchError('Unable to fetch feed: {}'.format(e))
+
+        raise TemporaryFeedError('Too many redirects')
+
+    def close(self) -> None:
+        self._deadlines.stop()
+
+        with self._lock:
+            connections = [connection for idle in self._idle.values() for connection in idle]
+            self._idle.clear()
+
+        for connection in connections:
+            connection.close()
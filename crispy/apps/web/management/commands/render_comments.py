@@ -0,0 +1,36 @@
+from django.core.management import BaseCommand
+
+from crispy.apps.web.models import Comment
+
+
+class Command(BaseCommand):
+    help = 'Renders the Markdown of comments to HTML again, e.g. after changing MARKDOWN_DEUX_STYLES.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--missing', action='store_true',
+                            help='Only renders the comments that have never been rendered')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of comments written at once')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        comments = Comment.objects.only('id', 'content').order_by('pk')
+        if options['missing']:
+            comments = comments.filter(content_html='')
+
+        batch = []
+        count = 0
+        for comment in comments.iterator(chunk_size=batch_size):
+            comment.render()
+            batch.append(comment)
+
+            if len(batch) == batch_size:
+                Comment.objects.bulk_update(batch, ['content_html'])
+                count += len(batch)
+                batch = []
+
+        if batch:
+            Comment.objects.bulk_update(batch, ['content_html'])
+            count += len(batch)
+
+        self.stdout.write('Rendered {} comments'.format(count))
@@ -0,0 +1,36 @@
+# Generated by Django 3.1.5 on 2026-10-18 20:03
+
+from django.db import migrations, models
+from django.db.models import Min
+
+
+def remove_duplicate_bookmarks(apps, schema_editor):
+    """
+    Keeps the oldest bookmark of each user and feed, so that they can be made unique
+    """
+    Bookmark = apps.get_model('web', 'Bookmark')
+    duplicates = Bookmark.objects.values('user', 'feed').annotate(first_id=Min('id'), count=models.Count('id')) \
+        .filter(count__gt=1)
+
+    for duplicate in duplicates:
+        Bookmark.objects.filter(user=duplicate['user'], feed=duplicate['feed']) \
+            .exclude(id=duplicate['first_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('web', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['entry', '-date'], name='comment_entry_date_idx'),
+        ),
+        migrations.RunPython(remove_duplicate_bookmarks, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='bookmark',
+            constraint=models.UniqueConstraint(fields=('user', 'feed'), name='bookmark_unique_user_feed'),
+        ),
+    ]
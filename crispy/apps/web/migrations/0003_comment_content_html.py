@@ -0,0 +1,38 @@
+# Generated by Django 3.1.5 on 2026-10-18 20:16
+
+from django.db import migrations, models
+from markdown_deux import markdown
+
+BATCH_SIZE = 1000
+
+
+def render_comments(apps, schema_editor):
+    Comment = apps.get_model('web', 'Comment')
+    batch = []
+
+    for comment in Comment.objects.only('id', 'content').iterator(chunk_size=BATCH_SIZE):
+        comment.content_html = markdown(comment.content)
+        batch.append(comment)
+
+        if len(batch) == BATCH_SIZE:
+            Comment.objects.bulk_update(batch, ['content_html'])
+            batch = []
+
+    if batch:
+        Comment.objects.bulk_update(batch, ['content_html'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('web', '0002_read_path_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='content_html',
+            field=models.TextField(blank=True, editable=False, verbose_name='Rendered comment'),
+        ),
+        migrations.RunPython(render_comments, migrations.RunPython.noop),
+    ]
@@ -1,20 +1,73 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from markdown_deux import markdown
+
+from crispy.apps.feed import cache
+from crispy.apps.feed.models import Entry, Feed
 
 
 class Comment(models.Model):
     user = models.ForeignKey('auth.User', on_delete=models.CASCADE)
     entry = models.ForeignKey('feed.Entry', related_name='comments', on_delete=models.CASCADE)
     content = models.TextField(verbose_name='Comment')
+    # Rendered when saved, see render_comments to render existing comments again
+    content_html = models.TextField(blank=True, editable=False, verbose_name='Rendered comment')
     date = models.DateTimeField(auto_now_add=True)
 
     class Meta:
         ordering = ('-date', )
+        indexes = [
+            models.Index(fields=['entry', '-date'], name='comment_entry_date_idx'),
+        ]
+
+    def render(self) -> None:
+        """
+        Renders the Markdown content to HTML, with markdown_deux's default style
+        """
+        self.content_html = markdown(self.content)
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'content' in update_fields:
+            self.render()
+            if update_fields is not None:
+                kwargs['update_fields'] = set(update_fields) | {'content_html'}
+
+        if not self._state.adding:
+            return super().save(*args, **kwargs)
+
+        # Counts new comments on their entry, in the same transaction
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            Entry.objects.filter(pk=self.entry_id).update(comment_count=F('comment_count') + 1)
+            # Loads the entry's feed id only, not the whole entry
+            feed_id = Entry.objects.values_list('feed_id', flat=True).get(pk=self.entry_id)
+
+        # The feed's cached pages show the comment counts
+        cache.invalidate_feed(feed_id)
 
 
 class Bookmark(models.Model):
     user = models.ForeignKey('auth.User', on_delete=models.CASCADE)
     feed = models.ForeignKey('feed.Feed', related_name='bookmarks', db_index=True, on_delete=models.CASCADE)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'feed'], name='bookmark_unique_user_feed'),
+        ]
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            return super().save(*args, **kwargs)
+
+        # Counts bookmarks on their feed, in the same transaction. The feed's crawl priority
+        # follows at its next check
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            Feed.objects.filter(pk=self.feed_id).update(bookmark_count=F('bookmark_count') + 1)
+
     @staticmethod
     def get_bookmark(user, feed):
         return Bookmark.objects.filter(user=user, feed=feed).first()
@@ -22,3 +75,19 @@ class Bookmark(models.Model):
     @staticmethod
     def user_has_bookmark(user, feed):
         return bool(Bookmark.get_bookmark(user, feed))
+
+
+# Deleted rows are uncounted by signals, which fire for every deleted instance, also on queryset and
+# cascade deletes, in the deletion's transaction. Rows of a cascade-deleted parent may already be gone
+
+
+@receiver(post_delete, sender=Comment)
+def uncount_comment(sender, instance: Comment, **kwargs):
+    Entry.objects.filter(pk=instance.entry_id, comment_count__gt=0).update(comment_count=F('comment_count') - 1)
+    for feed_id in Entry.objects.filter(pk=instance.entry_id).values_list('feed_id', flat=True):
+        cache.invalidate_feed(feed_id)
+
+
+@receiver(post_delete, sender=Bookmark)
+def uncount_bookmark(sender, instance: Bookmark, **kwargs):
+    Feed.objects.filter(pk=instance.feed_id, bookmark_count__gt=0).update(bookmark_count=F('bookmark_count') - 1)
@@ -0,0 +1,169 @@
+import base64
+import binascii
+import json
+from typing import Any, List, Optional, Sequence, Tuple
+
+from django.core.exceptions import ValidationError
+from django.core.paginator import InvalidPage
+from django.db.models import Q, QuerySet
+from django.http import Http404
+
+
+class KeysetPage(object):
+    """
+    A page of a KeysetPaginator. Mirrors the parts of Django's Page used by templates.
+    """
+    keyset = True
+
+    def __init__(self, object_list: List, paginator: 'KeysetPaginator', has_next: bool, has_previous: bool) -> None:
+        self.object_list = object_list
+        self.paginator = paginator
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self) -> bool:
+        return self._has_next
+
+    def has_previous(self) -> bool:
+        return self._has_previous
+
+    def has_other_pages(self) -> bool:
+        return self._has_next or self._has_previous
+
+    @property
+    def next_token(self) -> Optional[str]:
+        return self.paginator.encode_token(self.object_list[-1], False) if self._has_next else None
+
+    @property
+    def previous_token(self) -> Optional[str]:
+        return self.paginator.encode_token(self.object_list[0], True) if self._has_previous else None
+
+
+class KeysetPaginator(object):
+    """
+    Paginates a queryset by seeking past the last row of the previous page, rather than by
+    offset, so that every page costs the same whatever its depth. Rows are ordered by
+    `ordering`, which must be unique (end with the primary key) and backed by an index.
+
+    Pages are addressed by opaque tokens. There's no page count, only an optional
+    estimated number of rows, `count`.
+    """
+
+    def __init__(self, queryset: QuerySet, per_page: int, ordering: Sequence[str] = ('-date', '-id'),
+                 count: Optional[int] = None) -> None:
+        self.queryset = queryset
+        self.per_page = per_page
+        self.ordering = tuple(ordering)
+        self.count = count
+
+    @property
+    def fields(self) -> List[str]:
+        return [field.lstrip('-') for field in self.ordering]
+
+    def encode_token(self, obj: Any, backwards: bool) -> str:
+        """
+        Returns the token of the page after (or before, going backwards) the given row
+        """
+        # Dates keep their microseconds, unlike with DjangoJSONEncoder
+        values = [getattr(obj, field) for field in self.fields]
+        values = [value.isoformat() if hasattr(value, 'isoformat') else value for value in values]
+        data = json.dumps({'v': values, 'b': backwards}, separators=(',', ':'))
+        return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+    def decode_token(self, token: str) -> Tuple[List, bool]:
+        """
+        Returns the row values and direction of a token
+        :raise InvalidPage: on invalid tokens
+        """
+        try:
+            data = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+            if len(data['v']) != len(self.fields):
+                raise ValueError('Incomplete token')
+            values = [self.queryset.model._meta.get_field(field).to_python(value)
+                      for field, value in zip(self.fields, data['v'])]
+            if None in values:
+                raise ValueError('Incomplete token')
+            return values, bool(data['b'])
+        except (binascii.Error, ValueError, TypeError, KeyError, ValidationError):
+            raise InvalidPage('Invalid page token')
+
+    def _seek(self, values: List, backwards: bool) -> Q:
+        """
+        Returns the condition selecting the rows after (or before) the given values, in order.
+        The first field is also bounded on its own, for the index to serve it as a range.
+        """
+        lookups = []
+        for field in self.ordering:
+            descending = field.startswith('-')
+            lookups.append('gt' if descending == backwards else 'lt')
+
+        fields = self.fields
+        seek = Q()
+        for index in reversed(range(len(fields))):
+            strict = Q(**{'{}__{}'.format(fields[index], lookups[index]): values[index]})
+            seek = strict if index == len(fields) - 1 else strict | (Q(**{fields[index]: values[index]}) & seek)
+
+        bound = Q(**{'{}__{}e'.format(fields[0], lookups[0]): values[0]})
+        return bound & seek
+
+    def page(self, token: Optional[str] = None) -> KeysetPage:
+        """
+        Returns the page addressed by a token, the first one without a token
+        :raise InvalidPage: on invalid tokens
+        """
+        queryset = self.queryset.order_by(*self.ordering)
+        backwards = False
+
+        if token:
+            values, backwards = self.decode_token(token)
+            queryset = queryset.filter(self._seek(values, backwards))
+            if backwards:
+                queryset = queryset.reverse()
+
+        object_list = list(queryset[:self.per_page + 1])
+        has_more = len(object_list) > self.per_page
+        object_list = object_list[:self.per_page]
+
+        if backwards:
+            object_list.reverse()
+            return KeysetPage(object_list, self, True, has_more)
+
+        return KeysetPage(object_list, self, has_more, bool(token))
+
+
+class KeysetPaginationMixin(object):
+    """
+    ListView mixin paginating with a KeysetPaginator. The page token is read from the
+    `cursor` query parameter.
+    """
+    cursor_kwarg = 'cursor'
+    keyset_ordering = ('-date', '-id')
+
+    def get_estimated_count(self) -> Optional[int]:
+        """
+        Returns the estimated number of rows shown alongside the pages, if any
+        """
+        return None
+
+    def get_page(self, paginator: KeysetPaginator, token: Optional[str]) -> KeysetPage:
+        """
+        Returns the page addressed by a token, e.g. from a cache
+        :raise InvalidPage: on invalid tokens
+        """
+        return paginator.page(token)
+
+    def paginate_queryset(self, queryset, page_size):
+        paginator = KeysetPaginator(queryset, page_size, self.keyset_ordering, self.get_estimated_count())
+
+        try:
+            page = self.get_page(paginator, self.request.GET.get(self.cursor_kwarg))
+        except InvalidPage as e:
+            raise Http404(str(e))
+
+        return paginator, page, page.object_list, page.has_other_pages()
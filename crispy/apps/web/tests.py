@@ -1,12 +1,23 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+from io import StringIO
+from unittest import mock
+from unittest.mock import patch
 
 from django.contrib.auth.models import User, AnonymousUser
+from django.core.management import call_command
+from django.core.paginator import InvalidPage
+from django.db import IntegrityError, connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 
 from crispy.apps.core.tests import BaseTestCase
-from crispy.apps.feed.models import Feed, Entry
+from crispy.apps.feed import cache, constants, metrics
+from crispy.apps.feed.models import Feed, Entry, WorkerMetrics
 from crispy.apps.web.forms.comment import CommentForm
-from crispy.apps.web.models import Comment
+from crispy.apps.web.models import Bookmark, Comment
+from crispy.apps.web.pagination import KeysetPaginator
 from crispy.apps.web.views.entries import EntryDetailView
 from crispy.apps.web.views.feeds import FeedDetailView, NewFeedView
 
@@ -24,6 +35,27 @@ class TestOtherViews(BaseTestCase):
     def test_logout(self):
         self._test_view_for_status_code('logout', status_code=200)
 
+    @override_settings(CRAWLER_METRICS_TOKEN='secret')
+    def test_metrics(self):
+        metrics.CYCLE_FEEDS.inc(0)
+        WorkerMetrics.objects.publish('crawler', metrics.REGISTRY.collect(worker='crawler'), timedelta(minutes=10))
+        url = reverse('metrics')
+
+        self.assertEqual(403, self.client.get(url).status_code)
+        self.assertEqual(403, self.client.get(url, HTTP_AUTHORIZATION='Bearer other').status_code)
+        self.client.force_login(User.objects.create(username='u', email='a@a.com'))
+        self.assertEqual(403, self.client.get(url).status_code)
+        self.client.logout()
+
+        # Serves the metrics the crawlers published, to scrapers with the token and to staff users
+        response = self.client.get(url, HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(200, response.status_code)
+        self.assertIn(b'# TYPE crispy_feed_checks_total counter', response.content)
+        self.assertIn(b'crispy_crawler_cycle_feeds_total{worker="crawler"}', response.content)
+
+        self.client.force_login(User.objects.create(username='staff', email='s@a.com', is_staff=True))
+        self.assertEqual(response.content, self.client.get(url).content)
+
 
 class TestFeedViews(BaseTestCase):
     user = None
@@ -49,9 +81,129 @@ class TestFeedViews(BaseTestCase):
 
         self.assertEqual(200, response.status_code)
 
+    def test_new_feed_view_post(self):
+        self.client.force_login(self.user)
+
+        with patch('crispy.apps.feed.scraper.Scraper.check_feed') as check_feed, \
+                CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('new_feed'), {'feed_url': 'http://new.com/feed'})
+
+        # The feed is only saved, the crawlers fetch it
+        check_feed.assert_not_called()
+        self.assertEqual(1, len([query for query in queries if query['sql'].startswith('INSERT')]))
+        feed = Feed.objects.get(feed_url='http://new.com/feed')
+        self.assertRedirects(response, reverse('feed_detail', kwargs={'pk': feed.pk}), fetch_redirect_response=False)
+        self.assertTrue(feed.pending)
+        self.assertIsNotNone(feed.requested_at)
+        self.assertEqual(self.user, feed.added_by)
+
+    def test_pending_feed_details(self):
+        feed = Feed.objects.create(added_by=self.user, feed_url='http://new.com/feed', title='',
+                                   state=constants.FEED_STATE_PENDING, requested_at=timezone.now())
+        url = reverse('feed_detail', kwargs={'pk': feed.pk})
+
+        response = self.client.get(url)
+        self.assertContains(response, 'Waiting for this feed to be fetched')
+        self.assertContains(response, 'http-equiv="refresh"')
+
+        # The progress isn't cached
+        Feed.objects.filter(pk=feed.pk).update(leased_until=timezone.now() + timedelta(minutes=1))
+        response = self.client.get(url)
+        self.assertContains(response, 'Fetching this feed for the first time')
+
+    def test_feed_update_queues_a_single_check(self):
+        Feed.objects.filter(pk=self.feed.pk).update(last_checked_at=timezone.now() - timedelta(hours=1))
+        url = reverse('feed_update', kwargs={'pk': self.feed.pk})
+
+        with patch('crispy.apps.feed.scraper.Scraper.check_feed') as check_feed:
+            response = self.client.get(url, follow=True)
+        check_feed.assert_not_called()
+        self.assertContains(response, 'Checking for updates...')
+        self.assertContains(response, 'Waiting for this feed to be checked')
+        self.feed.refresh_from_db()
+        requested_at = self.feed.requested_at
+        self.assertIsNotNone(requested_at)
+
+        # Requests made in the meantime share the queued check
+        response = self.client.get(url, follow=True)
+        self.assertContains(response, 'Already checking for updates...')
+        self.feed.refresh_from_db()
+        self.assertEqual(requested_at, self.feed.requested_at)
+
+    def test_feed_update_is_rate_limited(self):
+        Feed.objects.filter(pk=self.feed.pk).update(last_checked_at=timezone.now())
+
+        response = self.client.get(reverse('feed_update', kwargs={'pk': self.feed.pk}), follow=True)
+        self.assertContains(response, 'Checked for updates recently')
+        self.feed.refresh_from_db()
+        self.assertIsNone(self.feed.requested_at)
+
+    def test_reads_raise_the_crawl_priority(self):
+        Bookmark.objects.create(user=self.user, feed=self.feed)
+        self.client.get(reverse('feed_detail', kwargs={'pk': self.feed.pk}))
+
+        self.feed.refresh_from_db()
+        self.assertEqual(1, self.feed.bookmark_count)
+        self.assertIsNotNone(self.feed.last_read_at)
+        self.assertEqual(2, self.feed.priority)
+
+    def test_bookmarks_are_counted(self):
+        self.client.force_login(self.user)
+        url = reverse('toggle_feed_bookmark', kwargs={'pk': self.feed.pk})
+
+        self.client.get(url)
+        self.feed.refresh_from_db()
+        self.assertEqual(1, self.feed.bookmark_count)
+
+        self.client.get(url)
+        self.feed.refresh_from_db()
+        self.assertEqual(0, self.feed.bookmark_count)
+
+    def test_deleted_bookmarks_are_uncounted(self):
+        users = [User.objects.create(username=str(i), email='{}@a.com'.format(i)) for i in range(3)]
+        for user in users:
+            Bookmark.objects.create(user=user, feed=self.feed)
+
+        # Queryset and cascade deletes
+        Bookmark.objects.filter(user=users[0]).delete()
+        users[1].delete()
+        self.feed.refresh_from_db()
+        self.assertEqual(1, self.feed.bookmark_count)
+
     def test_feed_list(self):
         self._test_view_for_status_code('feed_list')
 
+    def test_user_feed_lists(self):
+        other = User.objects.create(username='o', email='o@a.com', password='asd')
+        Feed.objects.create(added_by=other, feed_url='http://other.com', title='other')
+        Bookmark.objects.create(user=other, feed=self.feed)
+        # The listing of all feeds is cached, the user's listings aren't
+        self.client.get(reverse('feed_list'))
+
+        self.client.force_login(other)
+        response = self.client.get(reverse('my_feed_list'))
+        self.assertEqual(200, response.status_code)
+        self.assertContains(response, 'http://other.com')
+        self.assertNotContains(response, 'http://test.com')
+
+        response = self.client.get(reverse('bookmarked_feed_list'))
+        self.assertEqual(200, response.status_code)
+        self.assertContains(response, 'http://test.com')
+        self.assertNotContains(response, 'http://other.com')
+
+    def test_feed_pages_defer_seen_keys(self):
+        Feed.objects.filter(pk=self.feed.pk).update(seen_keys=['key'] * 100)
+        Bookmark.objects.create(user=self.user, feed=self.feed)
+        self.client.force_login(self.user)
+
+        # Neither loaded nor cached along with the feeds
+        for name in ('feed_list', 'my_feed_list', 'bookmarked_feed_list'):
+            feeds = self.client.get(reverse(name)).context['object_list']
+            self.assertEqual([self.feed.pk], [feed.pk for feed in feeds])
+            self.assertIn('seen_keys', feeds[0].get_deferred_fields())
+        response = self.client.get(reverse('feed_detail', kwargs={'pk': self.feed.pk}))
+        self.assertIn('seen_keys', response.context['feed'].get_deferred_fields())
+
     def test_feed_details(self):
         self._test_view_for_status_code('feed_detail', {'pk': self.feed.pk})
 
@@ -73,6 +225,140 @@ class TestFeedViews(BaseTestCase):
         self.assertFalse(context['has_bookmark'])
         self.assertEqual(self.feed, context['object'])
 
+    def test_feed_list_query_count_is_constant(self):
+        with self.assertNumQueries(2):
+            self.client.get(reverse('feed_list'))
+
+        Feed.objects.bulk_create([Feed(added_by=self.user, feed_url='http://test{}.com'.format(i), title='Feed')
+                                  for i in range(9)])
+        cache.invalidate_feed_list()
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('feed_list'))
+        self.assertContains(response, '<td>0</td>', count=10)
+
+    def test_feed_list_is_cached_until_feeds_change(self):
+        self.client.get(reverse('feed_list'))
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('feed_list'))
+        self.assertContains(response, 'http://test.com')
+
+        Feed.objects.create(added_by=self.user, feed_url='http://new.com', title='New')
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('feed_list'))
+        self.assertContains(response, 'http://new.com')
+
+    def test_feed_details_query_count_is_constant(self):
+        Entry.objects.create(feed=self.feed, date=timezone.now(), title='Entry')
+        # Feed with its user, entries page, recent entries, and the read of the feed
+        with self.assertNumQueries(4):
+            self.client.get(reverse('feed_detail', kwargs={'pk': self.feed.pk}))
+
+        Entry.objects.bulk_create([Entry(feed=self.feed, date=timezone.now(), title='Entry {}'.format(i),
+                                         comment_count=i)
+                                   for i in range(12)])
+        cache.invalidate_feed(self.feed.pk)
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('feed_detail', kwargs={'pk': self.feed.pk}))
+        self.assertContains(response, '<td>11</td>')
+
+    def test_feed_details_are_cached_until_ingestion(self):
+        url = reverse('feed_detail', kwargs={'pk': self.feed.pk})
+        self.feed._update_entries([{'title': 'First', 'link': 'http://test.com/1',
+                                    'published_parsed': (2021, 1, 1, 0, 0, 0)}])
+        self.client.get(url)
+
+        # Anonymous users don't reach the database
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertContains(response, 'First')
+
+        # Signed in users only look up their bookmark
+        self.client.force_login(self.user)
+        with self.assertNumQueries(3):
+            self.client.get(url)
+        self.client.logout()
+
+        self.feed._update_entries([{'title': 'Second', 'link': 'http://test.com/2',
+                                    'published_parsed': (2021, 1, 2, 0, 0, 0)}])
+        with self.assertNumQueries(3):
+            response = self.client.get(url)
+        self.assertContains(response, 'Second')
+
+    def test_feed_details_are_outdated_by_comments(self):
+        entry = Entry.objects.create(feed=self.feed, date=timezone.now(), title='Entry')
+        url = reverse('feed_detail', kwargs={'pk': self.feed.pk})
+        self.client.get(url)
+
+        Comment.objects.create(entry=entry, user=self.user, content='comment')
+        response = self.client.get(url)
+        self.assertContains(response, '<td>1</td>')
+
+
+class TestKeysetPagination(BaseTestCase):
+    feed = None
+
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create(username='u', email='a@a.com', password='asd')
+        cls.feed = Feed.objects.create(added_by=user, feed_url='http://test.com', title='title', entry_count=30)
+        date = timezone.now()
+        # Pairs of entries share a date, so that pages split ties
+        Entry.objects.bulk_create([
+            Entry(feed=cls.feed, date=date - timedelta(minutes=i // 2), title='Entry {}'.format(i))
+            for i in range(30)
+        ])
+
+    def _titles(self, page):
+        return [entry.title for entry in page.object_list]
+
+    def test_walk_forward_and_back(self):
+        paginator = KeysetPaginator(Entry.objects.filter(feed=self.feed), 12)
+        expected = list(Entry.objects.order_by('-date', '-id').values_list('title', flat=True))
+
+        first = paginator.page()
+        second = paginator.page(first.next_token)
+        third = paginator.page(second.next_token)
+
+        self.assertEqual(expected, self._titles(first) + self._titles(second) + self._titles(third))
+        self.assertEqual((False, True), (first.has_previous(), first.has_next()))
+        self.assertEqual((True, True), (second.has_previous(), second.has_next()))
+        self.assertEqual((True, False), (third.has_previous(), third.has_next()))
+
+        self.assertEqual(self._titles(second), self._titles(paginator.page(third.previous_token)))
+        back = paginator.page(second.previous_token)
+        self.assertEqual(self._titles(first), self._titles(back))
+        self.assertFalse(back.has_previous())
+
+    def test_page_query_count_is_constant(self):
+        paginator = KeysetPaginator(Entry.objects.filter(feed=self.feed), 5)
+        page = paginator.page()
+        while page.has_next():
+            with self.assertNumQueries(1):
+                page = paginator.page(page.next_token)
+
+    def test_invalid_token(self):
+        paginator = KeysetPaginator(Entry.objects.filter(feed=self.feed), 12)
+        for token in ('garbage', 'e30', paginator.page().next_token[:-4]):
+            with self.assertRaises(InvalidPage):
+                paginator.page(token)
+
+        response = self.client.get(reverse('feed_detail', kwargs={'pk': self.feed.pk}), {'cursor': 'garbage'})
+        self.assertEqual(404, response.status_code)
+
+    def test_feed_detail_defers_content(self):
+        response = self.client.get(reverse('feed_detail', kwargs={'pk': self.feed.pk}))
+        for entry in response.context['entry_list']:
+            self.assertIn('content', entry.get_deferred_fields())
+
+    def test_feed_detail_pages(self):
+        url = reverse('feed_detail', kwargs={'pk': self.feed.pk})
+        response = self.client.get(url)
+        self.assertContains(response, '30 in total')
+
+        response = self.client.get(url, {'cursor': response.context['page_obj'].next_token})
+        self.assertEqual(12, len(response.context['entry_list']))
+        self.assertTrue(response.context['page_obj'].has_previous())
+
 
 class TestEntryViews(BaseTestCase):
     user = None
@@ -87,6 +373,105 @@ class TestEntryViews(BaseTestCase):
         cls.entry = Entry.objects.create(feed=cls.feed, date=datetime.utcnow(), title='title', content='content')
         cls.comment = Comment.objects.create(entry=cls.entry, user=cls.user, content='comment')
 
+    def test_comments_are_counted(self):
+        Comment.objects.create(entry=self.entry, user=self.user, content='another comment')
+
+        self.entry.refresh_from_db()
+        self.assertEqual(2, self.entry.comment_count)
+
+    def test_comments_outdate_their_feed(self):
+        version = cache.get_feed_version(self.feed.pk)
+        with CaptureQueriesContext(connection) as queries:
+            Comment.objects.create(entry_id=self.entry.pk, user=self.user, content='another comment')
+
+        self.assertNotEqual(version, cache.get_feed_version(self.feed.pk))
+        # The entry isn't loaded, only its feed id
+        selects = [query['sql'] for query in queries if query['sql'].startswith('SELECT')]
+        self.assertEqual(1, len(selects))
+        self.assertIn('"feed_id" FROM "feed_entry"', selects[0])
+
+    def test_deleted_comments_are_uncounted(self):
+        other = User.objects.create(username='o', email='o@a.com')
+        for user in (self.user, other, other):
+            Comment.objects.create(entry=self.entry, user=user, content='another comment')
+        version = cache.get_feed_version(self.feed.pk)
+
+        # Instance, queryset and cascade deletes
+        Comment.objects.get(pk=self.comment.pk).delete()
+        Comment.objects.filter(user=self.user).delete()
+        other.delete()
+        self.entry.refresh_from_db()
+        self.assertEqual(0, self.entry.comment_count)
+        # The feed's cached pages show the comment counts
+        self.assertNotEqual(version, cache.get_feed_version(self.feed.pk))
+
+        # Comments deleted along with their entry
+        Comment.objects.create(entry=self.entry, user=self.user, content='another comment')
+        Entry.objects.get(pk=self.entry.pk).delete()
+        self.assertFalse(Comment.objects.exists())
+
+    def test_comments_are_rendered_when_saved(self):
+        self.assertEqual('<p>comment</p>\n', self.comment.content_html)
+
+        self.comment.content = '*edited*'
+        self.comment.save(update_fields=['content'])
+
+        self.comment.refresh_from_db()
+        self.assertEqual('<p><em>edited</em></p>\n', self.comment.content_html)
+
+    def test_posted_comments_are_rendered(self):
+        self.client.force_login(self.user)
+        self.client.post(reverse('entry_detail', kwargs={'pk': self.entry.pk}), {'content': '**posted**'})
+
+        comment = Comment.objects.filter(entry=self.entry).first()
+        self.assertEqual('<p><strong>posted</strong></p>\n', comment.content_html)
+
+    def test_entry_view_outputs_stored_html(self):
+        Comment.objects.filter(pk=self.comment.pk).update(content_html='<p>stored</p>')
+
+        with mock.patch('crispy.apps.web.models.markdown') as markdown:
+            response = self.client.get(reverse('entry_detail', kwargs={'pk': self.entry.pk}))
+
+        markdown.assert_not_called()
+        self.assertContains(response, '<p>stored</p>')
+
+    def test_render_comments_command(self):
+        Comment.objects.filter(pk=self.comment.pk).update(content_html='')
+        out = StringIO()
+
+        call_command('render_comments', '--missing', stdout=out)
+
+        self.comment.refresh_from_db()
+        self.assertEqual('<p>comment</p>\n', self.comment.content_html)
+        self.assertIn('Rendered 1 comments', out.getvalue())
+
+        call_command('render_comments', '--missing', stdout=out)
+        self.assertIn('Rendered 0 comments', out.getvalue())
+
+    def test_entry_view_query_count_is_constant(self):
+        url = reverse('entry_detail', kwargs={'pk': self.entry.pk})
+        self.client.force_login(self.user)
+
+        # Session, user, entry with its feed, comments with their users, and the read of the feed
+        with self.assertNumQueries(5):
+            response = self.client.get(url)
+        self.assertContains(response, 'id="comment-', count=1)
+
+        # Reads are only recorded once in a while
+        with self.assertNumQueries(4):
+            self.client.get(url)
+
+        for i in range(99):
+            user = User.objects.create(username='user{}'.format(i))
+            Comment.objects.create(entry=self.entry, user=user, content='comment')
+
+        with mock.patch.object(EntryDetailView, 'paginate_by', 100):
+            with self.assertNumQueries(4):
+                response = self.client.get(url)
+        self.assertContains(response, 'id="comment-', count=100)
+        self.assertContains(response, 'user98')
+        self.assertContains(response, self.feed.title)
+
     def test_entry_view(self):
         self._test_view_for_status_code('entry_detail', url_kwargs={'pk': self.entry.pk})
 
@@ -106,3 +491,43 @@ class TestEntryViews(BaseTestCase):
         self.assertEqual(self.entry, context['object'])
         self.assertIsInstance(context['comment_form'], CommentForm)
         self.assertEqual(self.comment, context['comment_list'][0])
+
+
+class TestQueryPlans(BaseTestCase):
+    users = None
+    entries = None
+
+    @classmethod
+    def setUpTestData(cls):
+        User.objects.bulk_create([User(username='u{}'.format(i)) for i in range(50)])
+        cls.users = list(User.objects.order_by('pk'))
+        feed = Feed.objects.create(added_by=cls.users[0], feed_url='http://test.com', title='title')
+        Entry.objects.bulk_create([Entry(feed=feed, date=timezone.now(), title='Entry {}'.format(i))
+                                   for i in range(50)])
+        cls.entries = list(Entry.objects.order_by('pk'))
+
+        feeds = [Feed(added_by=cls.users[0], feed_url='http://test{}.com'.format(i), title='Feed {}'.format(i))
+                 for i in range(50)]
+        Feed.objects.bulk_create(feeds)
+        Bookmark.objects.bulk_create([Bookmark(user=user, feed=feed)
+                                      for user in cls.users for feed in Feed.objects.all()[:20]])
+        Comment.objects.bulk_create([Comment(user=user, entry=entry, content='comment')
+                                     for user in cls.users[:20] for entry in cls.entries])
+
+    def test_deep_entry_page(self):
+        paginator = KeysetPaginator(Entry.objects.filter(feed=self.entries[0].feed_id), 12)
+        values, _ = paginator.decode_token(paginator.encode_token(self.entries[-12], False))
+        plan = self.assertNoSequentialScan(paginator.queryset.filter(paginator._seek(values, False))
+                                           .order_by(*paginator.ordering)[:13])
+        self.assertIn('entry_feed_date_idx', plan)
+
+    def test_entry_comments(self):
+        self.assertNoSequentialScan(Comment.objects.filter(entry=self.entries[1])[:10])
+
+    def test_bookmark_lookup(self):
+        self.assertNoSequentialScan(Bookmark.objects.filter(user=self.users[1], feed=self.entries[0].feed_id))
+
+    def test_bookmarks_are_unique(self):
+        bookmark = Bookmark.objects.first()
+        with self.assertRaises(IntegrityError):
+            Bookmark.objects.create(user=bookmark.user, feed=bookmark.feed)
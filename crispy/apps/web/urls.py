@@ -21,6 +21,7 @@ from . import views
 
 urlpatterns = [
     path(r'', views.HomeView.as_view(), name="home"),
+    path(r'metrics/', views.MetricsView.as_view(), name="metrics"),
 
     # Auth
     path(r'accounts/login/', LoginView.as_view(template_name='auth/login.html'), name="login"),
@@ -9,9 +9,10 @@ from django.views.generic.list import ListView
 from crispy.apps.feed.models import Entry
 from crispy.apps.web.forms.comment import CommentForm
 from crispy.apps.web.models import Comment
+from crispy.apps.web.pagination import KeysetPaginationMixin
 
 
-class EntryDetailView(ListView, DetailView):
+class EntryDetailView(KeysetPaginationMixin, ListView, DetailView):
     # We subclass ListView to paginate entries, and overwrite the ListView's MultipleObjectMixin with
     # DetailView to get a single feed entry in get_context_data
     model = Entry
@@ -19,10 +20,27 @@ class EntryDetailView(ListView, DetailView):
     template_name = 'feed/entry_detail.html'
 
     def get_queryset(self):
-        return Comment.objects.filter(entry__id=self.kwargs.get(self.pk_url_kwarg))
+        # Loads the comments' users along with them, for the template to show
+        return (Comment.objects.filter(entry_id=self.kwargs.get(self.pk_url_kwarg))
+                .select_related('user')
+                .only('id', 'date', 'content_html', 'entry_id', 'user__id', 'user__username'))
+
+    def get_entry(self):
+        """
+        Returns the entry along with its feed, in a single query
+        """
+        return (Entry.objects.select_related('feed')
+                .only('id', 'date', 'title', 'content', 'author', 'url', 'comment_count',
+                      'feed__id', 'feed__title', 'feed__alternate_title', 'feed__bookmark_count')
+                .filter(pk=self.kwargs.get(self.pk_url_kwarg)).first())
+
+    def get_estimated_count(self):
+        return self.object.comment_count if self.object else None
 
     def get_context_data(self, **kwargs):
-        self.object = Entry.objects.filter(pk=self.kwargs.get(self.pk_url_kwarg)).first()
+        self.object = self.get_entry()
+        if self.object:
+            self.object.feed.record_read()
         context = super(EntryDetailView, self).get_context_data()
         context['entry'] = self.object
         context['comment_form'] = CommentForm(initial={'entry': self.object.id})
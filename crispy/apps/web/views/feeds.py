@@ -1,17 +1,22 @@
-import feedparser
+from datetime import timedelta
+
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
+from django.core.paginator import Page
 from django.shortcuts import redirect
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.decorators import method_decorator
 from django.views.generic.detail import DetailView
 from django.views.generic.edit import FormView
 from django.views.generic.list import ListView
 
+from crispy.apps.feed import cache, constants
 from crispy.apps.feed.models import Feed, Entry
-from crispy.apps.feed.scraper import Scraper
 from crispy.apps.web.forms.new_feed import NewFeedForm
 from crispy.apps.web.models import Bookmark
+from crispy.apps.web.pagination import KeysetPage, KeysetPaginationMixin
 
 
 @method_decorator(login_required, name='dispatch')
@@ -36,17 +41,14 @@ class NewFeedView(FormView):
         return context
 
     def form_valid(self, form):
+        # The feed is saved as pending and checked by the crawlers, ahead of the due feeds
         feed = form.save(commit=False)
-        scraper = Scraper(feedparser.parse, feed)
-        updated, parsed_feed = scraper.check_feed()
-
-        if updated:
-            feed.update_feed_data(parsed_feed)
-            feed.save()
-            feed.update_feed_entries(parsed_feed.entries)
-
+        feed.state = constants.FEED_STATE_PENDING
+        feed.request_check()
         feed.save()
 
+        messages.info(self.request, 'The feed will be fetched in a moment')
+
         # Sets success URL to the feed's detail page
         self.success_url = reverse('feed_detail', kwargs={'pk': feed.pk})
 
@@ -55,8 +57,30 @@ class NewFeedView(FormView):
 
 class FeedListView(ListView):
     model = Feed
+    queryset = Feed.objects.for_listing()
     paginate_by = 10
 
+    def paginate_queryset(self, queryset, page_size):
+        # Pages are cached until a feed is added or updated
+        def load_page():
+            paginator, page, object_list, is_paginated = super(FeedListView, self).paginate_queryset(queryset,
+                                                                                                    page_size)
+            return paginator.count, page.number, list(object_list)
+
+        page_number = self.request.GET.get(self.page_kwarg) or 1
+        count, number, object_list = cache.get_or_set(cache.feed_list_key('page', page_number), load_page)
+
+        paginator = self.get_paginator(queryset, page_size)
+        paginator.count = count
+        page = Page(object_list, number, paginator)
+        return paginator, page, object_list, page.has_other_pages()
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['feed_list_version'] = cache.get_feed_list_version()
+        context['page_cache_seconds'] = settings.FEED_PAGE_CACHE_SECONDS
+        return context
+
 
 @method_decorator(login_required, name='dispatch')
 class MyFeedListView(ListView):
@@ -64,10 +88,10 @@ class MyFeedListView(ListView):
     paginate_by = 10
 
     def get_queryset(self):
-        return Feed.objects.from_user(self.request.user)
+        return Feed.objects.for_listing().from_user(self.request.user)
 
 
-class FeedDetailView(ListView, DetailView):
+class FeedDetailView(KeysetPaginationMixin, ListView, DetailView):
     # We subclass ListView to paginate entries, and overwrite the ListView's MultipleObjectMixin with
     # DetailView to get a single feed entry in get_context_data
     model = Feed
@@ -75,13 +99,47 @@ class FeedDetailView(ListView, DetailView):
     template_name = 'feed/feed_detail.html'
 
     def get_queryset(self):
-        return Entry.objects.filter(feed__id=self.kwargs.get(self.pk_url_kwarg))
+        return Entry.objects.for_listing().filter(feed__id=self.kwargs.get(self.pk_url_kwarg))
+
+    def get_estimated_count(self):
+        return self.object.entry_count if self.object else None
+
+    def get_feed(self):
+        """
+        Returns the feed, cached until its entries change
+        """
+        feed_id = self.kwargs.get(self.pk_url_kwarg)
+        feeds = Feed.objects.for_listing().select_related('added_by').filter(pk=feed_id)
+        feed = cache.get_or_set(cache.feed_key(feed_id, 'feed'), lambda: feeds.first())
+
+        # Feeds awaiting a check show its progress, which isn't cached
+        if feed is not None and feed.awaiting_check:
+            feed = feeds.first()
+
+        return feed
+
+    def get_page(self, paginator, token):
+        # Pages are cached until the feed's entries change
+        def load_page():
+            page = paginator.page(token)
+            return page.object_list, page.has_next(), page.has_previous()
+
+        key = cache.feed_key(self.kwargs.get(self.pk_url_kwarg), 'entries', token or '')
+        object_list, has_next, has_previous = cache.get_or_set(key, load_page)
+        return KeysetPage(object_list, paginator, has_next, has_previous)
 
     def get_context_data(self, **kwargs):
-        self.object = Feed.objects.filter(pk=self.kwargs.get(self.pk_url_kwarg)).first()
+        self.object = self.get_feed()
+        if self.object:
+            self.object.record_read()
         context = super().get_context_data()
         context['feed'] = self.object
         context['entry_list'] = context['object_list']
+        context['recent_entries'] = cache.get_recent_entries(self.kwargs.get(self.pk_url_kwarg))
+        context['feed_version'] = cache.get_feed_version(self.kwargs.get(self.pk_url_kwarg))
+        context['page_cache_seconds'] = settings.FEED_PAGE_CACHE_SECONDS
+        context['checking'] = bool(self.object and self.object.leased_until and
+                                   self.object.leased_until > timezone.now())
         context['has_bookmark'] = False
 
         if self.request.user and self.request.user.is_authenticated:
@@ -92,19 +150,24 @@ class FeedDetailView(ListView, DetailView):
 
 class FeedUpdateView(DetailView):
     model = Feed
+    queryset = Feed.objects.for_listing()
 
     def get(self, request, *args, **kwargs):
+        """
+        Queues a check of the feed for the crawlers, see update_feeds. Checks are rate limited
+        by FEED_REFRESH_WINDOW_SECONDS and requests made during a check share it.
+        """
         feed = self.get_object()
-        scraper = Scraper(feedparser.parse, feed)
-        updated, parsed_feed = scraper.check_feed()
-
-        if updated:
-            feed.update_feed_data(parsed_feed)
-            feed.update_feed_entries(parsed_feed.entries)
-            feed.save()
-            messages.success(request, 'Found new updates. Enjoy!')
+        window = timedelta(seconds=settings.FEED_REFRESH_WINDOW_SECONDS)
+
+        if Feed.objects.request_check(feed.pk, window):
+            # The feed's page shows the progress of the check
+            cache.invalidate_feed(feed.pk)
+            messages.info(request, 'Checking for updates...')
+        elif feed.awaiting_check or (feed.leased_until and feed.leased_until > timezone.now()):
+            messages.info(request, 'Already checking for updates...')
         else:
-            messages.info(request, 'Nothing new yet...')
+            messages.info(request, 'Checked for updates recently, nothing new yet...')
 
         return redirect(reverse('feed_detail', kwargs={'pk': feed.pk}))
 
@@ -112,15 +175,13 @@ class FeedUpdateView(DetailView):
 @method_decorator(login_required, name='dispatch')
 class ToggleBookmarkView(DetailView):
     model = Feed
+    queryset = Feed.objects.for_listing()
 
     def get(self, request, *args, **kwargs):
         feed = self.get_object()
-        bookmark = Bookmark.get_bookmark(user=self.request.user, feed=feed)
+        bookmark, created = Bookmark.objects.get_or_create(user=self.request.user, feed=feed)
 
-        if not bookmark:
-            bookmark = Bookmark(user=self.request.user, feed=feed)
-            bookmark.save()
-        else:
+        if not created:
             bookmark.delete()
 
         return redirect(reverse('feed_detail', kwargs={'pk': feed.pk}))
@@ -132,4 +193,4 @@ class BookmarkedFeedsView(ListView):
     paginate_by = 10
 
     def get_queryset(self):
-        return Feed.objects.from_user_bookmarks(self.request.user)
+        return Feed.objects.for_listing().from_user_bookmarks(self.request.user)
@@ -1,11 +1,18 @@
+import hmac
+from datetime import timedelta
+
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import login, authenticate
 from django.contrib.auth.forms import UserCreationForm
+from django.http import HttpResponse, HttpResponseForbidden
 from django.shortcuts import redirect
 from django.urls import reverse
-from django.views.generic.base import TemplateView
+from django.views.generic.base import TemplateView, View
 from django.views.generic.edit import FormView
 
+from crispy.apps.feed import metrics
+from crispy.apps.feed.models import WorkerMetrics
 from crispy.apps.web.forms.register import CrispyUserRegistration
 
 
@@ -37,3 +44,26 @@ class HomeView(TemplateView):
             return redirect(reverse('feed_list'))
         else:
             return super().get(request, *args, **kwargs)
+
+
+class MetricsView(View):
+    """
+    Exposes the crawl metrics the crawlers published, in the Prometheus text format, to staff users
+    and to scrapers holding the metrics token
+    """
+
+    def has_access(self, request) -> bool:
+        if request.user.is_staff:
+            return True
+
+        token = settings.CRAWLER_METRICS_TOKEN
+        authorization = request.headers.get('Authorization', '')
+        return bool(token) and hmac.compare_digest(authorization.encode(), 'Bearer {}'.format(token).encode())
+
+    def get(self, request, *args, **kwargs):
+        if not self.has_access(request):
+            return HttpResponseForbidden()
+
+        workers = WorkerMetrics.objects.live(timedelta(seconds=settings.CRAWLER_METRICS_MAX_AGE))
+        body = metrics.REGISTRY.render(worker.samples for worker in workers)
+        return HttpResponse(body, content_type=metrics.CONTENT_TYPE)
@@ -11,3 +11,19 @@ DATABASES = {
         'PORT': 5432,
     }
 }
+
+# Crawler metrics are scraped from the other containers
+CRAWLER_METRICS_HOST = '0.0.0.0'
+
+# Keeps database connections open between requests and crawl cycles
+CONN_MAX_AGE = 600
+
+# Shared by the web and crawler containers, so that ingestion outdates the cached pages.
+# Memcached evicts the least recently used entries once full, e.g. pages of outdated versions
+CACHES = {
+    'default': {
+        'BACKEND': 'djpymemcache.backend.PyMemcacheCache',
+        'LOCATION': 'memcached:11211',
+        'TIMEOUT': FEED_PAGE_CACHE_SECONDS,
+    }
+}
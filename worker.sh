@@ -1,6 +1,3 @@
 #!/usr/bin/env bash
-while true
-do
-    python manage.py update_feeds
-    sleep 10
-done
+# update_feeds is a long-running daemon; exec so it receives SIGTERM from docker directly
+exec python manage.py update_feeds 10